@@ -1,8 +1,69 @@
 # main.py
-from fastapi import FastAPI
+import asyncio
+import base64
+import io
+import json
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+from sd_batcher import create_batcher_from_env
+
+
+# 服务启动时加载一次 SD 模型（设置环境变量 SD_MODEL 才会启用文生图接口）
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    batcher = create_batcher_from_env()
+    if batcher is not None:
+        await batcher.start()
+    app.state.batcher = batcher
+    yield
+    if batcher is not None:
+        await batcher.stop()
+
 
 # 创建 FastAPI 应用实例
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+class Txt2ImgRequest(BaseModel):
+    prompt: str
+    height: int = 512
+    width: int = 512
+    steps: int = 30
+    scale: float = 7.5
+    seed: Optional[int] = None
+
+
+class Txt2ImgStreamRequest(Txt2ImgRequest):
+    preview_every: int = 5
+
+
+def _png_bytes(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _jpeg_bytes(img, quality: int = 70) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _get_batcher():
+    batcher = getattr(app.state, "batcher", None)
+    if batcher is None:
+        raise HTTPException(status_code=503, detail="文生图服务未启用，请设置环境变量 SD_MODEL 后重启")
+    return batcher
+
 
 # 定义根路径接口（访问 http://localhost:8000 时触发）
 @app.get("/")
@@ -12,4 +73,72 @@ def read_root():
 # 定义带参数的接口（可选，用于测试更多功能）
 @app.get("/greet/{name}")
 def greet(name: str):
-    return {"message": f"Hello {name}! 你成功访问了容器内的服务"}
\ No newline at end of file
+    return {"message": f"Hello {name}! 你成功访问了容器内的服务"}
+
+
+# 文生图接口：请求会被短暂攒批，参数相同（尺寸/步数/引导系数）的请求合并成一次推理
+@app.post("/txt2img")
+async def txt2img(req: Txt2ImgRequest):
+    batcher = _get_batcher()
+    img, info = await batcher.submit(req.prompt, req.height, req.width, req.steps, req.scale, req.seed)
+    data = await asyncio.to_thread(_png_bytes, img)
+    return Response(content=data, media_type="image/png", headers={"X-Batch-Size": str(info.batch_size)})
+
+
+# 流式文生图（Server-Sent Events）：每 preview_every 步推送一张低分辨率预览图
+# 预览由潜空间线性投影得到，不经过 VAE 解码；客户端断开连接或调用取消接口会提前终止生成
+# 事件依次为 start(job_id) -> preview(step/steps/image) ... -> done(image) 或 error
+@app.get("/txt2img/stream")
+async def txt2img_stream(req: Txt2ImgStreamRequest = Depends()):
+    batcher = _get_batcher()
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    # 在推理线程中调用：编码预览图后投递回事件循环
+    def on_preview(step, total, img):
+        data = base64.b64encode(_jpeg_bytes(img)).decode("ascii")
+        loop.call_soon_threadsafe(events.put_nowait, {"step": step, "steps": total, "image": data})
+
+    job = batcher.new_request(req.prompt, req.height, req.width, req.steps, req.scale, req.seed,
+                              preview_every=req.preview_every, on_preview=on_preview)
+
+    async def stream():
+        task = asyncio.create_task(batcher.run_request(job))
+        try:
+            yield _sse("start", {"job_id": job.job_id, "steps": req.steps})
+            while not task.done():
+                getter = asyncio.create_task(events.get())
+                done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield _sse("preview", getter.result())
+                else:
+                    getter.cancel()
+            try:
+                img, info = task.result()
+            except Exception as e:
+                yield _sse("error", {"job_id": job.job_id, "detail": str(e) or type(e).__name__})
+                return
+            data = base64.b64encode(await asyncio.to_thread(_png_bytes, img)).decode("ascii")
+            yield _sse("done", {"job_id": job.job_id, "batch_size": info.batch_size, "image": data})
+        finally:
+            # 客户端断开时生成器被关闭，取消任务以节省算力
+            if not task.done():
+                job.cancel_event.set()
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# 取消排队中或正在生成的流式任务
+@app.post("/txt2img/{job_id}/cancel")
+def txt2img_cancel(job_id: str):
+    if not _get_batcher().cancel(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在或已结束")
+    return {"job_id": job_id, "cancelled": True}
+
+
+# 按批大小统计吞吐量与 p95 延迟
+@app.get("/txt2img/stats")
+def txt2img_stats():
+    return _get_batcher().stats.snapshot()
@@ -0,0 +1,287 @@
+"""
+sd_batcher.py
+
+Dynamic micro-batching front end for the local Stable Diffusion v1.5 pipeline in
+../text2image/local_sd_v1_5_text2img.py.
+
+The pipeline is loaded once. Incoming requests are held for a few milliseconds
+and requests with the same (height, width, steps, scale) are merged into a single
+batched pipeline call, so N concurrent requests cost one batched UNet pass per
+denoising step instead of N. Per-batch-size throughput and p95 latency are kept
+for the /txt2img/stats endpoint.
+
+Requests can ask for live previews (latent_preview.py: a linear latent-to-RGB
+projection every N steps, no VAE decode) and can be cancelled by job id; a batch
+stops early once every request in it has been cancelled.
+"""
+import asyncio
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+T2I_DIR = os.environ.get(
+    "T2I_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "text2image"),
+)
+
+
+def import_sd_module():
+    """Import local_sd_v1_5_text2img from the text2image folder (needs torch/diffusers)."""
+    t2i_dir = os.path.abspath(T2I_DIR)
+    if t2i_dir not in sys.path:
+        sys.path.insert(0, t2i_dir)
+    import local_sd_v1_5_text2img as sd
+    return sd
+
+
+class GenerationRequest:
+    def __init__(self, prompt: str, height: int, width: int, steps: int, scale: float, seed: Optional[int], future: asyncio.Future,
+                 preview_every: int = 0, on_preview: Optional[Callable] = None):
+        self.job_id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.height = height
+        self.width = width
+        self.steps = steps
+        self.scale = scale
+        self.seed = seed
+        self.future = future
+        # on_preview(step, total_steps, image) is called from the worker thread
+        self.preview_every = preview_every
+        self.on_preview = on_preview
+        self.cancel_event = threading.Event()
+        self.enqueued_at = time.perf_counter()
+        self.batch_size = 0
+
+    @property
+    def key(self) -> Tuple[int, int, int, float]:
+        return (self.height, self.width, self.steps, self.scale)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[idx]
+
+
+class BatchStats:
+    """Per-batch-size counters: batches, requests, busy time and request latencies."""
+
+    def __init__(self, window: int = 1000):
+        self.started_at = time.perf_counter()
+        self.window = window
+        self.batches: Dict[int, int] = defaultdict(int)
+        self.requests: Dict[int, int] = defaultdict(int)
+        self.busy_seconds: Dict[int, float] = defaultdict(float)
+        self.latencies: Dict[int, deque] = defaultdict(lambda: deque(maxlen=self.window))
+        self.cancelled = 0
+
+    def record(self, batch_size: int, batch_seconds: float, latencies: List[float]):
+        self.batches[batch_size] += 1
+        self.requests[batch_size] += len(latencies)
+        self.busy_seconds[batch_size] += batch_seconds
+        self.latencies[batch_size].extend(latencies)
+
+    def snapshot(self) -> dict:
+        per_size = {}
+        for size in sorted(self.batches):
+            busy = self.busy_seconds[size]
+            lats = list(self.latencies[size])
+            per_size[str(size)] = {
+                "batches": self.batches[size],
+                "requests": self.requests[size],
+                "mean_batch_ms": round(1000.0 * busy / self.batches[size], 1),
+                "throughput_rps": round(self.requests[size] / busy, 3) if busy > 0 else 0.0,
+                "p50_latency_ms": round(1000.0 * percentile(lats, 50), 1),
+                "p95_latency_ms": round(1000.0 * percentile(lats, 95), 1),
+            }
+        total = sum(self.requests.values())
+        uptime = time.perf_counter() - self.started_at
+        all_lats = [lat for lats in self.latencies.values() for lat in lats]
+        return {
+            "total_requests": total,
+            "uptime_s": round(uptime, 1),
+            "throughput_rps": round(total / uptime, 3) if uptime > 0 else 0.0,
+            "p95_latency_ms": round(1000.0 * percentile(all_lats, 95), 1),
+            "cancelled": self.cancelled,
+            "by_batch_size": per_size,
+        }
+
+
+class MicroBatcher:
+    """Collects requests for max_wait_ms and runs compatible ones as one pipeline call.
+
+    The pipeline is not thread-safe, so batches run one at a time on a single worker
+    thread; requests that arrive while a batch is running are batched together next.
+    """
+
+    def __init__(self, pipe, device, max_batch_size: int = 4, max_wait_ms: float = 10.0, sd_module=None):
+        self.pipe = pipe
+        self.device = device
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.sd = sd_module or import_sd_module()
+        # Importable once the text2image folder is on sys.path (import_sd_module)
+        import latent_preview
+        self.preview = latent_preview
+        self.stats = BatchStats()
+        self.jobs: Dict[str, GenerationRequest] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd-batch")
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    def new_request(self, prompt: str, height: int = 512, width: int = 512, steps: int = 30, scale: float = 7.5, seed: Optional[int] = None,
+                    preview_every: int = 0, on_preview: Optional[Callable] = None) -> GenerationRequest:
+        loop = asyncio.get_running_loop()
+        return GenerationRequest(prompt, height, width, steps, scale, seed, loop.create_future(), preview_every, on_preview)
+
+    async def run_request(self, req: GenerationRequest):
+        """Queue a request from new_request() and wait for its image. Returns (PIL image, req)."""
+        self.jobs[req.job_id] = req
+        try:
+            await self._queue.put(req)
+            img = await req.future
+        finally:
+            self.jobs.pop(req.job_id, None)
+        return img, req
+
+    async def submit(self, prompt: str, height: int = 512, width: int = 512, steps: int = 30, scale: float = 7.5, seed: Optional[int] = None):
+        """Queue one request and wait for its image. Returns (PIL image, GenerationRequest)."""
+        return await self.run_request(self.new_request(prompt, height, width, steps, scale, seed))
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running request; returns False for unknown/finished jobs."""
+        req = self.jobs.get(job_id)
+        if req is None:
+            return False
+        req.cancel_event.set()
+        return True
+
+    async def _collect(self) -> List[GenerationRequest]:
+        first = await self._queue.get()
+        pending = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        # Anything that queued up while the previous batch was running joins too
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        return pending
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self._collect()
+            groups: Dict[tuple, List[GenerationRequest]] = defaultdict(list)
+            for req in pending:
+                groups[req.key].append(req)
+            for group in groups.values():
+                for i in range(0, len(group), self.max_batch_size):
+                    batch = group[i:i + self.max_batch_size]
+                    await self._run_batch(loop, batch)
+
+    async def _run_batch(self, loop, batch: List[GenerationRequest]):
+        live = []
+        for req in batch:
+            if req.cancel_event.is_set() or req.future.done():
+                self._fail(req, self.preview.GenerationCancelled("cancelled before start"))
+            else:
+                live.append(req)
+        batch = live
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            images = await loop.run_in_executor(self._executor, self._generate, batch)
+        except self.preview.GenerationCancelled as e:
+            for req in batch:
+                self._fail(req, e)
+            return
+        except Exception as e:
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(e)
+            return
+        finished = time.perf_counter()
+        latencies = []
+        for req, img in zip(batch, images):
+            req.batch_size = len(batch)
+            latencies.append(finished - req.enqueued_at)
+            if not req.future.done():
+                req.future.set_result(img)
+        self.stats.record(len(batch), finished - started, latencies)
+
+    def _fail(self, req: GenerationRequest, exc: Exception):
+        self.stats.cancelled += 1
+        if not req.future.done():
+            req.future.set_exception(exc)
+
+    def _generate(self, batch: List[GenerationRequest]):
+        first = batch[0]
+        prompts = [req.prompt for req in batch]
+
+        def on_preview(index, step, total, img):
+            callback = batch[index].on_preview
+            if callback is not None:
+                callback(step, total, img)
+
+        # Always installed: besides previews it polls for cancellation every step
+        callback = self.preview.PreviewCallback(
+            first.steps, [req.preview_every if req.on_preview else 0 for req in batch], on_preview,
+            cancelled=lambda index: batch[index].cancel_event.is_set(),
+        )
+        return self.sd.generate_images(
+            self.pipe, prompts, first.height, first.width, first.steps, first.scale,
+            self.device, seeds=[req.seed for req in batch], callback_on_step_end=callback,
+        )
+
+
+def create_batcher_from_env() -> Optional[MicroBatcher]:
+    """Load the SD pipeline named by $SD_MODEL and wrap it in a MicroBatcher.
+
+    Returns None when SD_MODEL is not set so the demo app still starts without torch.
+    """
+    model = os.environ.get("SD_MODEL")
+    if not model:
+        return None
+    sd = import_sd_module()
+    device = sd.choose_device(os.environ.get("SD_DEVICE"))
+    lowvram = os.environ.get("SD_LOWVRAM", "0") == "1"
+    print(f"Loading SD pipeline from {model} on {device} ...", flush=True)
+    pipe = sd.get_pipeline(model, device, trust_remote_code=False, lowvram=lowvram)
+    if os.environ.get("SD_DISABLE_SAFETY", "0") == "1":
+        # Keeps pipe._original_safety_checker so other users of the shared registry pipeline can restore it
+        sd.configure_safety(pipe, True)
+    return MicroBatcher(
+        pipe,
+        device,
+        max_batch_size=int(os.environ.get("SD_MAX_BATCH", "4")),
+        max_wait_ms=float(os.environ.get("SD_MAX_WAIT_MS", "10")),
+        sd_module=sd,
+    )
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+benchmark_stages.py
+
+Per-stage latency benchmark for the local text2image pipelines.
+
+Each run is split into: tokenize, text_encode, every denoising step (timed through
+callback_on_step_end), vae_decode, safety_checker, postprocess and save. Results
+are written to JSON (full detail) and CSV (one row per stage / step).
+
+Targets:
+  sd15      local_sd_v1_5_text2img.load_pipeline
+  text2img  local_text2img.load_pipeline
+  flux      local_flux_text2img.load_flux_pipeline
+
+--tiny swaps the real weights for tiny randomly initialized models of the same
+architecture, so the harness runs offline on CPU (CI, diffusers upgrade checks).
+The tiny pipelines are saved to a temporary model folder and loaded through each
+target's own loader, so sd15 and text2img still exercise their own loading code:
+  python benchmark_stages.py --tiny --targets sd15,flux --steps 4 --runs 3
+  python benchmark_stages.py --targets sd15 --sd15-model G:/AIModels/.../stable-diffusion-v1-5 --device cuda
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import tempfile
+import time
+from typing import Optional
+
+import torch
+
+from perf_utils import StepTimer, sync
+
+TARGETS = ("sd15", "text2img", "flux")
+STAGES = ("tokenize", "text_encode", "denoise", "vae_decode", "safety_checker", "postprocess", "save")
+
+
+def tiny_tokenizer(bos: str, eos: str, pad: str, unk: str, max_length: int):
+    """Small in-memory word-level tokenizer standing in for CLIP/T5 (no downloads)."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {bos: 0, pad: 1, eos: 2, unk: 3}
+    for i, word in enumerate("a an the of on in at with and photo portrait castle lighthouse sunset city night forest".split()):
+        vocab[word] = 4 + i
+    tok = Tokenizer(models.WordLevel(vocab=vocab, unk_token=unk))
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    tok.post_processor = processors.TemplateProcessing(
+        single=f"{bos} $A {eos}", special_tokens=[(bos, vocab[bos]), (eos, vocab[eos])],
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tok, bos_token=bos, eos_token=eos, pad_token=pad,
+                                   unk_token=unk, model_max_length=max_length)
+
+
+def _tiny_clip_text_encoder():
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    return CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, pad_token_id=1, hidden_size=32, intermediate_size=37,
+        layer_norm_eps=1e-05, num_attention_heads=4, num_hidden_layers=2, vocab_size=1000,
+        max_position_embeddings=77,
+    ))
+
+
+def _tiny_safety_checker():
+    from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+    from transformers import CLIPConfig, CLIPImageProcessor
+
+    config = CLIPConfig(
+        text_config={"hidden_size": 32, "intermediate_size": 37, "num_attention_heads": 4, "num_hidden_layers": 2},
+        vision_config={"hidden_size": 32, "intermediate_size": 37, "num_attention_heads": 4, "num_hidden_layers": 2,
+                       "image_size": 32, "patch_size": 4},
+        projection_dim=32,
+    )
+    processor = CLIPImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32})
+    return StableDiffusionSafetyChecker(config).eval(), processor
+
+
+def build_tiny_sd_pipeline():
+    """Randomly initialized SD-architecture pipeline (UNet/VAE/CLIP/safety checker)."""
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=1, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"], up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+    )
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                              clip_sample=False, set_alpha_to_one=False)
+    try:
+        safety_checker, feature_extractor = _tiny_safety_checker()
+    except Exception as e:
+        print(f"Tiny safety checker unavailable ({e}); safety stage will be skipped.")
+        safety_checker, feature_extractor = None, None
+    return StableDiffusionPipeline(
+        vae=vae, text_encoder=_tiny_clip_text_encoder(),
+        tokenizer=tiny_tokenizer("<|startoftext|>", "<|endoftext|>", "<pad>", "<unk>", 77),
+        unet=unet, scheduler=scheduler, safety_checker=safety_checker, feature_extractor=feature_extractor,
+        requires_safety_checker=False,
+    )
+
+
+def build_tiny_flux_pipeline():
+    """Randomly initialized FLUX-architecture pipeline (transformer/VAE/CLIP/T5)."""
+    from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxPipeline, FluxTransformer2DModel
+    from transformers import T5Config, T5EncoderModel
+
+    torch.manual_seed(0)
+    transformer = FluxTransformer2DModel(
+        patch_size=1, in_channels=4, num_layers=1, num_single_layers=1, attention_head_dim=16,
+        num_attention_heads=2, joint_attention_dim=32, pooled_projection_dim=32, axes_dims_rope=[4, 4, 8],
+    )
+    vae = AutoencoderKL(
+        sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+        latent_channels=1, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+        shift_factor=0.0609, scaling_factor=1.5035,
+    )
+    text_encoder_2 = T5EncoderModel(T5Config(d_model=32, d_kv=8, d_ff=37, num_layers=2, num_heads=4,
+                                             vocab_size=1000, pad_token_id=1, eos_token_id=2))
+    return FluxPipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(), vae=vae,
+        text_encoder=_tiny_clip_text_encoder(),
+        tokenizer=tiny_tokenizer("<|startoftext|>", "<|endoftext|>", "<pad>", "<unk>", 77),
+        text_encoder_2=text_encoder_2,
+        tokenizer_2=tiny_tokenizer("<s>", "</s>", "<pad>", "<unk>", 32),
+        transformer=transformer,
+    )
+
+
+def save_tiny_model(target: str, root: str) -> str:
+    """Write the tiny pipeline for target as a diffusers folder under root (once per architecture)."""
+    kind = "flux" if target == "flux" else "sd"
+    path = os.path.join(root, f"tiny-{kind}")
+    if not os.path.isdir(path):
+        pipe = build_tiny_flux_pipeline() if kind == "flux" else build_tiny_sd_pipeline()
+        pipe.save_pretrained(path)
+    return path
+
+
+def load_target(target: str, model: Optional[str], device: torch.device):
+    if not model:
+        raise SystemExit(f"--{target}-model is required unless --tiny is given")
+    if target == "flux":
+        import local_flux_text2img as script
+        return script.load_flux_pipeline(model, device, trust_remote_code=True)
+    if target == "text2img":
+        import local_text2img as script
+        return script.load_pipeline(model, device)
+    import local_sd_v1_5_text2img as script
+    return script.load_pipeline(model, device, trust_remote_code=False, lowvram=False)
+
+
+class StageClock:
+    """Accumulates synchronized wall time per named stage."""
+
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def time(self, name: str):
+        sync(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sync(self.device)
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+@torch.no_grad()
+def run_sd_stages(pipe, prompt: str, size: int, steps: int, scale: float, device: torch.device, seed: int, out_dir: str, run: int) -> dict:
+    clock = StageClock(device)
+    tok = pipe.tokenizer
+    with clock.time("tokenize"):
+        ids = tok(prompt, padding="max_length", max_length=tok.model_max_length, truncation=True, return_tensors="pt").input_ids
+        uncond_ids = tok("", padding="max_length", max_length=tok.model_max_length, truncation=True, return_tensors="pt").input_ids
+    with clock.time("text_encode"):
+        prompt_embeds = pipe.text_encoder(ids.to(device))[0]
+        negative_embeds = pipe.text_encoder(uncond_ids.to(device))[0] if scale > 1.0 else None
+
+    timer = StepTimer(device)
+    with clock.time("denoise"):
+        timer.start()
+        latents = pipe(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds, height=size, width=size,
+                       num_inference_steps=steps, guidance_scale=scale, output_type="latent",
+                       generator=torch.Generator(device=device).manual_seed(seed), callback_on_step_end=timer).images
+    with clock.time("vae_decode"):
+        image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    has_nsfw = None
+    if getattr(pipe, "safety_checker", None) is not None:
+        with clock.time("safety_checker"):
+            image, has_nsfw = pipe.run_safety_checker(image, device, prompt_embeds.dtype)
+    do_denormalize = [True] * image.shape[0] if has_nsfw is None else [not x for x in has_nsfw]
+    with clock.time("postprocess"):
+        images = pipe.image_processor.postprocess(image, output_type="pil", do_denormalize=do_denormalize)
+    with clock.time("save"):
+        images[0].save(os.path.join(out_dir, f"run{run}.png"))
+    return {"stages": clock.stages, "denoise_steps": timer.step_seconds}
+
+
+@torch.no_grad()
+def run_flux_stages(pipe, prompt: str, size: int, steps: int, scale: float, device: torch.device, seed: int, out_dir: str, run: int) -> dict:
+    clock = StageClock(device)
+    max_seq = min(512, pipe.tokenizer_2.model_max_length)
+    with clock.time("tokenize"):
+        clip_ids = pipe.tokenizer(prompt, padding="max_length", max_length=pipe.tokenizer.model_max_length,
+                                  truncation=True, return_tensors="pt").input_ids
+        t5_ids = pipe.tokenizer_2(prompt, padding="max_length", max_length=max_seq, truncation=True,
+                                  return_tensors="pt").input_ids
+    with clock.time("text_encode"):
+        pooled = pipe.text_encoder(clip_ids.to(device), output_hidden_states=False).pooler_output
+        prompt_embeds = pipe.text_encoder_2(t5_ids.to(device), output_hidden_states=False)[0]
+        pooled = pooled.to(pipe.text_encoder.dtype)
+        prompt_embeds = prompt_embeds.to(pipe.text_encoder_2.dtype)
+
+    timer = StepTimer(device)
+    with clock.time("denoise"):
+        timer.start()
+        latents = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled, height=size, width=size,
+                       num_inference_steps=steps, guidance_scale=scale, output_type="latent", max_sequence_length=max_seq,
+                       generator=torch.Generator(device=device).manual_seed(seed), callback_on_step_end=timer).images
+    with clock.time("vae_decode"):
+        latents = pipe._unpack_latents(latents, size, size, pipe.vae_scale_factor)
+        latents = latents / pipe.vae.config.scaling_factor + pipe.vae.config.shift_factor
+        image = pipe.vae.decode(latents, return_dict=False)[0]
+    with clock.time("postprocess"):
+        images = pipe.image_processor.postprocess(image, output_type="pil")
+    with clock.time("save"):
+        images[0].save(os.path.join(out_dir, f"run{run}.png"))
+    return {"stages": clock.stages, "denoise_steps": timer.step_seconds}
+
+
+def benchmark_target(target: str, model: Optional[str], device: torch.device, tiny: bool, size: int, steps: int, scale: float, runs: int, warmup: int, prompt: str, out_dir: str) -> dict:
+    start = time.perf_counter()
+    pipe = load_target(target, model, device)
+    load_s = time.perf_counter() - start
+    if hasattr(pipe, "set_progress_bar_config"):
+        pipe.set_progress_bar_config(disable=True)
+    runner = run_flux_stages if target == "flux" else run_sd_stages
+    target_dir = os.path.join(out_dir, target)
+    os.makedirs(target_dir, exist_ok=True)
+
+    results = []
+    for run in range(warmup + runs):
+        res = runner(pipe, prompt, size, steps, scale, device, seed=run, out_dir=target_dir, run=run)
+        res["stages"]["total"] = sum(res["stages"].values())
+        if run >= warmup:
+            res["run"] = run - warmup
+            results.append(res)
+        print(f"[{target}] run {run}{' (warmup)' if run < warmup else ''}: "
+              + ", ".join(f"{k}={v:.3f}s" for k, v in res["stages"].items()))
+    return {"target": target, "model": "tiny-random" if tiny else model, "load_s": load_s,
+            "pipeline_class": type(pipe).__name__, "runs": results}
+
+
+def summarize(result: dict) -> dict:
+    summary = {}
+    for stage in list(STAGES) + ["total"]:
+        values = [r["stages"][stage] for r in result["runs"] if stage in r["stages"]]
+        if values:
+            summary[stage] = sum(values) / len(values)
+    steps = [s for r in result["runs"] for s in r["denoise_steps"]]
+    if steps:
+        summary["mean_step"] = sum(steps) / len(steps)
+    return summary
+
+
+def write_csv(path: str, results: list):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["target", "run", "stage", "step", "seconds"])
+        for result in results:
+            for r in result["runs"]:
+                for stage, seconds in r["stages"].items():
+                    writer.writerow([result["target"], r["run"], stage, "", f"{seconds:.6f}"])
+                for i, seconds in enumerate(r["denoise_steps"]):
+                    writer.writerow([result["target"], r["run"], "denoise_step", i, f"{seconds:.6f}"])
+
+
+def environment_info(device: torch.device) -> dict:
+    info = {"python": platform.python_version(), "torch": torch.__version__, "device": str(device),
+            "platform": platform.platform(), "threads": torch.get_num_threads()}
+    try:
+        import diffusers
+        import transformers
+        info["diffusers"] = diffusers.__version__
+        info["transformers"] = transformers.__version__
+    except Exception:
+        pass
+    if device.type == "cuda":
+        info["gpu"] = torch.cuda.get_device_name(device)
+    return info
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-stage latency benchmark for text2image pipelines")
+    parser.add_argument("--targets", type=str, default="sd15", help=f"Comma-separated subset of {','.join(TARGETS)}")
+    parser.add_argument("--tiny", action="store_true", help="Use tiny randomly initialized models (offline, CPU friendly)")
+    parser.add_argument("--sd15-model", type=str, default="")
+    parser.add_argument("--text2img-model", type=str, default="")
+    parser.add_argument("--flux-model", type=str, default="")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--size", type=int, default=None, help="Image size (default 64 with --tiny, else 512)")
+    parser.add_argument("--steps", type=int, default=None, help="Denoising steps (default 4 with --tiny, else 20)")
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--prompt", type=str, default="a photo of a castle at sunset")
+    parser.add_argument("--out-json", type=str, default="bench_stages.json")
+    parser.add_argument("--out-csv", type=str, default="bench_stages.csv")
+    parser.add_argument("--images-dir", type=str, default="", help="Where benchmark images are saved (default: temp dir)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    size = args.size or (64 if args.tiny else 512)
+    steps = args.steps or (4 if args.tiny else 20)
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = [t for t in targets if t not in TARGETS]
+    if unknown:
+        raise SystemExit(f"Unknown target(s): {unknown}; expected {TARGETS}")
+    models = {"sd15": args.sd15_model, "text2img": args.text2img_model, "flux": args.flux_model}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images_dir = args.images_dir or tmp
+        if args.tiny:
+            # Built and saved before timing; load_s then covers the script loader reading the tiny folder
+            models = {t: save_tiny_model(t, tmp) for t in targets}
+        results = [
+            benchmark_target(t, models[t], device, args.tiny, size, steps, args.scale, args.runs, args.warmup, args.prompt, images_dir)
+            for t in targets
+        ]
+
+    for result in results:
+        result["summary"] = summarize(result)
+        print(f"\n{result['target']} ({result['pipeline_class']}, load {result['load_s']:.2f}s) mean seconds per stage:")
+        for stage, seconds in result["summary"].items():
+            print(f"  {stage:<15} {seconds:.4f}")
+
+    report = {"env": environment_info(device), "size": size, "steps": steps, "scale": args.scale,
+              "tiny": args.tiny, "results": results}
+    with open(args.out_json, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    write_csv(args.out_csv, results)
+    print(f"\nWrote {args.out_json} and {args.out_csv}")
+
+
+if __name__ == "__main__":
+    main()
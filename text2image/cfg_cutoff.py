@@ -0,0 +1,134 @@
+"""
+cfg_cutoff.py
+
+Classifier-free guidance truncation (--cfg-cutoff / --cfg-cutoff-threshold).
+
+With guidance_scale > 1 every step runs the UNet on a doubled batch (unconditional
++ conditional). Late steps mostly refine detail and the guidance term barely moves
+them, so once the cutoff is reached the callback keeps only the conditional half of
+prompt_embeds and sets the pipeline's guidance scale to 0: the remaining steps run
+at batch size 1 per image.
+
+The cutoff triggers after a fraction of the steps and/or once the relative guidance
+delta ||eps_cond - eps_uncond|| / ||eps_cond||, measured by a UNet forward hook,
+drops below a threshold. Step times on both sides of the cutoff give the time saved.
+"""
+import time
+from typing import Callable, Optional
+
+from perf_utils import sync
+
+
+class CfgCutoffSettings:
+    def __init__(self):
+        self.fraction: Optional[float] = None
+        self.threshold: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.fraction is not None or self.threshold is not None
+
+
+SETTINGS = CfgCutoffSettings()
+
+
+def set_cfg_cutoff(fraction: Optional[float] = None, threshold: Optional[float] = None):
+    if fraction is not None and not 0.0 <= fraction <= 1.0:
+        raise ValueError(f"--cfg-cutoff must be between 0 and 1, got {fraction}")
+    SETTINGS.fraction = fraction
+    SETTINGS.threshold = threshold
+
+
+class CfgCutoff:
+    """callback_on_step_end that drops the unconditional branch once the cutoff is reached.
+
+    Wraps an optional inner callback (called first). Call close() after the pipeline
+    call to remove the UNet hook.
+    """
+
+    def __init__(self, pipe, total_steps: int, fraction: Optional[float], threshold: Optional[float], inner: Optional[Callable] = None):
+        self.total_steps = total_steps
+        self.cutoff_step = int(round(total_steps * fraction)) if fraction is not None else None
+        self.threshold = threshold
+        self.inner = inner
+        self.cut_at: Optional[int] = None
+        self.last_delta: Optional[float] = None
+        self.full_step_s = []
+        self.cut_step_s = []
+        self._last = None
+        self._hook = None
+        if threshold is not None and getattr(pipe, "unet", None) is not None:
+            self._hook = pipe.unet.register_forward_hook(self._measure)
+
+    def _measure(self, module, args, output):
+        if self.cut_at is not None:
+            return
+        noise = output[0] if isinstance(output, tuple) else output.sample
+        if noise.shape[0] % 2:
+            return
+        uncond, cond = noise.float().chunk(2)
+        self.last_delta = float((cond - uncond).norm() / (cond.norm() + 1e-8))
+
+    def pipe_kwargs(self, tensor_inputs=None) -> dict:
+        inputs = list(tensor_inputs or ())
+        inputs += [name for name in ("latents", "prompt_embeds") if name not in inputs]
+        return {"callback_on_step_end": self, "callback_on_step_end_tensor_inputs": inputs}
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        if self.inner is not None:
+            callback_kwargs = self.inner(pipe, step, timestep, callback_kwargs)
+        device = callback_kwargs["latents"].device if "latents" in callback_kwargs else None
+        if device is not None:
+            sync(device)
+        now = time.perf_counter()
+        if self._last is not None:
+            # The first step also carries prompt encoding, so timing starts from its end
+            (self.full_step_s if self.cut_at is None else self.cut_step_s).append(now - self._last)
+        self._last = now
+
+        done = step + 1
+        if self.cut_at is None and done < self.total_steps and (
+                (self.cutoff_step is not None and done >= self.cutoff_step)
+                or (self.threshold is not None and self.last_delta is not None and self.last_delta < self.threshold)):
+            embeds = callback_kwargs.get("prompt_embeds")
+            if embeds is not None and embeds.shape[0] % 2 == 0 and pipe.do_classifier_free_guidance:
+                # Conditional embeddings are the second half of the CFG batch
+                callback_kwargs["prompt_embeds"] = embeds.chunk(2)[-1]
+                pipe._guidance_scale = 0.0
+                self.cut_at = done
+        return callback_kwargs
+
+    @property
+    def saved_s(self) -> Optional[float]:
+        """Estimated seconds saved for the whole batch (None when it cannot be measured)."""
+        if self.cut_at is None or not self.full_step_s or not self.cut_step_s:
+            return None
+        full = sum(self.full_step_s) / len(self.full_step_s)
+        cut = sum(self.cut_step_s) / len(self.cut_step_s)
+        return (full - cut) * (self.total_steps - self.cut_at)
+
+    def report(self, batch_size: int = 1) -> str:
+        if self.cut_at is None:
+            delta = f" (last guidance delta {self.last_delta:.3f})" if self.last_delta is not None else ""
+            return f"CFG cutoff not reached in {self.total_steps} steps{delta}"
+        saved = self.saved_s
+        timing = ""
+        if saved is not None:
+            full = sum(self.full_step_s) / len(self.full_step_s)
+            cut = sum(self.cut_step_s) / len(self.cut_step_s)
+            timing = f": ~{saved / max(1, batch_size):.2f}s saved per image ({full:.2f}s/step with CFG, {cut:.2f}s/step without)"
+        return f"CFG cutoff after step {self.cut_at}/{self.total_steps}{timing}"
+
+    def close(self):
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+
+
+def make_cfg_cutoff(pipe, steps: int, scale: float, pipe_kwargs: dict) -> Optional[CfgCutoff]:
+    """Install a CfgCutoff into pipe_kwargs (chaining any callback already there) when enabled."""
+    if not SETTINGS.enabled or scale <= 1.0:
+        return None
+    cutoff = CfgCutoff(pipe, steps, SETTINGS.fraction, SETTINGS.threshold, inner=pipe_kwargs.get("callback_on_step_end"))
+    pipe_kwargs.update(cutoff.pipe_kwargs(pipe_kwargs.get("callback_on_step_end_tensor_inputs")))
+    return cutoff
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+cpu_profile.py
+
+CPU inference profiles for the local diffusion scripts.
+
+"default" keeps the plain float32 path. "fast" applies, where supported:
+- intra-op / inter-op thread counts (and CPU affinity when cores are given)
+- channels_last memory format for the UNet and VAE
+- bfloat16 autocast when the CPU has native bf16 kernels
+- torch.compile of the UNet / transformer with a persistent Inductor cache
+
+The profile is process-wide: scripts call set_cpu_profile() from main(), the
+registry getters (get_pipeline / get_flux_pipeline) call apply_cpu_profile() on
+freshly loaded pipelines, and pipeline calls are wrapped in inference_context(pipe).
+
+Benchmark (seconds per denoising step, default vs fast, each in a fresh process):
+  python cpu_profile.py bench --model G:/AIModels/.../stable-diffusion-v1-5 --steps 10
+"""
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+import torch
+
+from perf_utils import StepTimer, format_table
+
+PROFILES = ("default", "fast")
+DEFAULT_COMPILE_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "t2i_inductor")
+
+
+class CpuProfileSettings:
+    def __init__(self):
+        self.name = "default"
+        self.threads: Optional[int] = None
+        self.interop_threads: Optional[int] = None
+        self.cores: Optional[List[int]] = None
+        self.compile = True
+        self.compile_cache_dir = DEFAULT_COMPILE_CACHE
+
+
+SETTINGS = CpuProfileSettings()
+
+
+def set_cpu_profile(name: str = "default", threads: Optional[int] = None, interop_threads: Optional[int] = None, cores: Optional[List[int]] = None, compile: bool = True, compile_cache_dir: Optional[str] = None):
+    if name not in PROFILES:
+        raise ValueError(f"Unknown CPU profile '{name}', expected one of {PROFILES}")
+    SETTINGS.name = name
+    SETTINGS.threads = threads
+    SETTINGS.interop_threads = interop_threads
+    SETTINGS.cores = cores
+    SETTINGS.compile = compile
+    if compile_cache_dir:
+        SETTINGS.compile_cache_dir = compile_cache_dir
+
+
+def parse_cores(spec: str) -> Optional[List[int]]:
+    """Parse a core list like '0-7,16-23' into [0..7, 16..23]."""
+    if not spec:
+        return None
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cores.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def bf16_supported() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def configure_threads(threads: Optional[int] = None, interop_threads: Optional[int] = None, cores: Optional[List[int]] = None) -> dict:
+    """Pin the process to cores (if given) and set torch intra/inter-op thread counts."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            print(f"Warning: could not set CPU affinity {cores}: {e}")
+    if hasattr(os, "sched_getaffinity"):
+        available = len(os.sched_getaffinity(0))
+    else:
+        available = os.cpu_count() or 1
+    intra = threads or available
+    torch.set_num_threads(intra)
+    try:
+        # Denoising is dominated by large intra-op kernels; extra inter-op threads only contend
+        torch.set_num_interop_threads(interop_threads or 1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+    return {"intra_op": torch.get_num_threads(), "inter_op": torch.get_num_interop_threads()}
+
+
+def _enable_compile_cache(cache_dir: str):
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except Exception:
+        pass
+    try:
+        import torch._dynamo
+        # Fall back to eager instead of failing the generation if a graph cannot compile
+        torch._dynamo.config.suppress_errors = True
+    except Exception:
+        pass
+
+
+def apply_cpu_profile(pipe, device: torch.device):
+    """Apply the active profile to a freshly loaded pipeline (no-op for default or non-CPU)."""
+    if SETTINGS.name == "default" or device.type != "cpu":
+        return pipe
+    threads = configure_threads(SETTINGS.threads, SETTINGS.interop_threads, SETTINGS.cores)
+    applied = [f"threads={threads['intra_op']}/{threads['inter_op']}"]
+
+    for name in ("unet", "vae"):
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            module.to(memory_format=torch.channels_last)
+            applied.append(f"{name}:channels_last")
+
+    if getattr(pipe, "_quantized", None) == "dynamic-int8":
+        # Dynamic int8 Linear kernels take float32 activations only
+        applied.append("fp32 (dynamic int8)")
+    elif bf16_supported():
+        pipe._cpu_autocast_dtype = torch.bfloat16
+        applied.append("bf16 autocast")
+    else:
+        print("CPU has no native bf16 kernels; keeping float32 compute.")
+
+    if SETTINGS.compile and hasattr(torch, "compile"):
+        _enable_compile_cache(SETTINGS.compile_cache_dir)
+        for name in ("unet", "transformer"):
+            module = getattr(pipe, name, None)
+            if isinstance(module, torch.nn.Module):
+                setattr(pipe, name, torch.compile(module))
+                applied.append(f"{name}:torch.compile")
+
+    print("CPU profile 'fast':", ", ".join(applied))
+    return pipe
+
+
+def inference_context(pipe):
+    """Autocast context for a pipeline call (bf16 on CPU when the fast profile enabled it)."""
+    dtype = getattr(pipe, "_cpu_autocast_dtype", None)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast("cpu", dtype=dtype)
+
+
+def _bench_once(pipeline: str, model: str, steps: int, size: int, profile: str, threads: Optional[int]) -> dict:
+    """Load, warm up and time one generation with the given profile in this process."""
+    set_cpu_profile(profile, threads=threads)
+    device = torch.device("cpu")
+    start = time.perf_counter()
+    if pipeline == "flux":
+        import local_flux_text2img as script
+        pipe = script.load_flux_pipeline(model, device, trust_remote_code=True)
+    elif pipeline == "text2img":
+        import local_text2img as script
+        pipe = script.load_pipeline(model, device)
+    else:
+        import local_sd_v1_5_text2img as script
+        pipe = script.load_pipeline(model, device, trust_remote_code=False, lowvram=False)
+    pipe = apply_cpu_profile(pipe, device)
+    load_s = time.perf_counter() - start
+
+    prompt = "a lighthouse on a cliff at sunset, detailed"
+    kwargs = {"height": size, "width": size, "num_inference_steps": steps}
+    start = time.perf_counter()
+    with inference_context(pipe):
+        # Warm-up pays torch.compile / oneDNN primitive creation once
+        pipe(prompt=prompt, generator=torch.Generator().manual_seed(0), **dict(kwargs, num_inference_steps=2))
+    warmup_s = time.perf_counter() - start
+
+    timer = StepTimer()
+    with inference_context(pipe):
+        timer.start()
+        pipe(prompt=prompt, generator=torch.Generator().manual_seed(0), callback_on_step_end=timer, **kwargs)
+    # The first interval also covers prompt encoding and latent setup
+    denoise = timer.step_seconds[1:] or timer.step_seconds
+    return {"profile": profile, "load_s": load_s, "warmup_s": warmup_s,
+            "s_per_step": sum(denoise) / len(denoise), "threads": torch.get_num_threads()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU profile benchmark (seconds per step)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("bench", "_run"):
+        p = sub.add_parser(name, help="Compare default vs fast CPU profile" if name == "bench" else argparse.SUPPRESS)
+        p.add_argument("--model", type=str, required=True)
+        p.add_argument("--pipeline", choices=["sd", "text2img", "flux"], default="sd")
+        p.add_argument("--steps", type=int, default=10)
+        p.add_argument("--size", type=int, default=512)
+        p.add_argument("--threads", type=int, default=None)
+        if name == "_run":
+            p.add_argument("--profile", choices=PROFILES, default="default")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "_run":
+        print(json.dumps(_bench_once(args.pipeline, args.model, args.steps, args.size, args.profile, args.threads)))
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for profile in PROFILES:
+        # Thread pools and compiled graphs are process-wide, so each profile gets its own process
+        cmd = [sys.executable, os.path.abspath(__file__), "_run", "--model", args.model, "--pipeline", args.pipeline,
+               "--steps", str(args.steps), "--size", str(args.size), "--profile", profile]
+        if args.threads:
+            cmd += ["--threads", str(args.threads)]
+        out = subprocess.run(cmd, cwd=here, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(out.stdout, out.stderr)
+            raise SystemExit(f"Benchmark run for profile '{profile}' failed")
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    base = rows[0]["s_per_step"]
+    for row in rows:
+        row["speedup"] = base / row["s_per_step"] if row["s_per_step"] else None
+    print(format_table(rows, ["profile", "threads", "load_s", "warmup_s", "s_per_step", "speedup"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+cpu_worker_pool.py
+
+Multi-process CPU generation with one copy of the model weights.
+
+The parent loads the SD pipeline once (fp32 on CPU), moves every component's
+parameters into shared memory and forks N workers. Each worker pins itself to its
+own slice of cores, sets its intra-op thread count to the slice size and pulls
+prompts from a shared queue. Weights are therefore resident once no matter how many
+workers run; only activations are per worker.
+
+Where fork is unavailable (Windows), pass a pipeline_snapshot.py bundle instead:
+spawned workers memory-map it, so the page cache still holds a single copy.
+
+Scaling report (aggregate images/min as the worker count grows):
+  python cpu_worker_pool.py --model G:/AIModels/.../stable-diffusion-v1-5 --workers 1,2,4 --num-images 8 --steps 20
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+from typing import List, Optional
+
+import torch
+
+from cpu_profile import configure_threads, parse_cores
+from perf_utils import current_rss_mb, format_table
+
+REPORT_COLUMNS = ["workers", "threads_per_worker", "images", "wall_s", "images_per_min", "speedup", "mean_image_s", "worker_private_mb"]
+
+# Set in the parent before forking; workers inherit it without copying the weights
+_POOL_PIPE = None
+
+
+def private_mb() -> Optional[float]:
+    """Private (unshared) memory of this process in MB, from /proc/self/smaps_rollup."""
+    try:
+        total = 0
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                    total += int(line.split()[1])
+        return total / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(cores: List[int], workers: int) -> List[List[int]]:
+    """Split cores into `workers` contiguous, near-equal slices."""
+    workers = max(1, min(workers, len(cores)))
+    size, extra = divmod(len(cores), workers)
+    slices, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+def share_pipeline(pipe):
+    """Move the weights of every torch module of the pipeline into shared memory."""
+    for component in (getattr(pipe, "components", None) or {}).values():
+        if isinstance(component, torch.nn.Module):
+            component.share_memory()
+    return pipe
+
+
+def _worker(rank: int, cores: List[int], model: str, tasks, results):
+    configure_threads(len(cores), 1, cores)
+    import local_sd_v1_5_text2img as sd
+    from image_writer import save_image
+
+    pipe = _POOL_PIPE
+    if pipe is None:
+        # Spawned (no fork): memory-map the snapshot bundle, shared through the page cache
+        pipe = sd.load_pipeline(model, torch.device("cpu"), trust_remote_code=False, lowvram=False)
+    if hasattr(pipe, "set_progress_bar_config"):
+        pipe.set_progress_bar_config(disable=True)
+    device = torch.device("cpu")
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        start = time.perf_counter()
+        try:
+            img = sd.generate_images(pipe, [task["prompt"]], task["height"], task["width"], task["steps"], task["scale"],
+                                     device, seeds=[task["seed"]])[0]
+            out = save_image(img, task["out"])
+            error = None
+        except Exception as e:
+            out, error = None, f"{type(e).__name__}: {e}"
+        results.put({"index": task["index"], "rank": rank, "out": out, "error": error,
+                     "seconds": time.perf_counter() - start, "private_mb": private_mb(), "rss_mb": current_rss_mb()})
+    results.put({"rank": rank, "done": True, "private_mb": private_mb()})
+
+
+def run_pool(model: str, tasks: List[dict], workers: int, cores: List[int], context) -> dict:
+    """Run all tasks on `workers` processes; returns a scaling-report row."""
+    slices = partition_cores(cores, workers)
+    task_q, result_q = context.Queue(), context.Queue()
+    for task in tasks:
+        task_q.put(task)
+    for _ in slices:
+        task_q.put(None)
+
+    start = time.perf_counter()
+    procs = [context.Process(target=_worker, args=(rank, cores_slice, model, task_q, result_q), daemon=True)
+             for rank, cores_slice in enumerate(slices)]
+    for p in procs:
+        p.start()
+
+    finished, done_workers, private = [], 0, []
+    while done_workers < len(procs):
+        try:
+            msg = result_q.get(timeout=5.0)
+        except queue.Empty:
+            if not any(p.is_alive() for p in procs):
+                break
+            continue
+        if msg.get("done"):
+            done_workers += 1
+            if msg.get("private_mb") is not None:
+                private.append(msg["private_mb"])
+            continue
+        if msg["error"]:
+            print(f"[worker {msg['rank']}] task {msg['index']} failed: {msg['error']}")
+        else:
+            finished.append(msg)
+            print(f"[worker {msg['rank']}] {msg['out']} in {msg['seconds']:.1f}s")
+    wall = time.perf_counter() - start
+    for p in procs:
+        p.join(timeout=10)
+
+    return {
+        "workers": len(slices),
+        "threads_per_worker": min(len(s) for s in slices),
+        "images": len(finished),
+        "wall_s": wall,
+        "images_per_min": 60.0 * len(finished) / wall if wall else None,
+        "mean_image_s": sum(m["seconds"] for m in finished) / len(finished) if finished else None,
+        "worker_private_mb": max(private) if private else None,
+    }
+
+
+def build_tasks(prompts: List[str], num_images: int, out_dir: str, height: int, width: int, steps: int, scale: float, seed: int) -> List[dict]:
+    tasks = []
+    for i in range(num_images):
+        tasks.append({"index": i, "prompt": prompts[i % len(prompts)], "seed": seed + i, "height": height, "width": width,
+                      "steps": steps, "scale": scale, "out": os.path.join(out_dir, f"{i:05d}.png")})
+    return tasks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi-process CPU worker pool sharing one copy of the SD weights")
+    parser.add_argument("--model", type=str, required=True, help="SD model folder (or a pipeline_snapshot.py bundle)")
+    parser.add_argument("--workers", type=str, default="1,2,4", help="Worker counts to run, e.g. '1,2,4,8'")
+    parser.add_argument("--cores", type=str, default="", help="Cores to spread workers over, e.g. '0-31' (default: all available)")
+    parser.add_argument("--prompts-file", type=str, default="", help="Text file with one prompt per line")
+    parser.add_argument("--prompt", type=str, default="a lighthouse on a cliff at sunset, detailed")
+    parser.add_argument("--num-images", type=int, default=8, help="Images per worker-count run")
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out-dir", type=str, default="worker_pool_out")
+    return parser.parse_args()
+
+
+def main():
+    global _POOL_PIPE
+    args = parse_args()
+    cores = parse_cores(args.cores) or available_cores()
+    counts = [int(n) for n in args.workers.split(",") if n.strip()]
+    prompts = [args.prompt]
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()] or prompts
+
+    from pipeline_snapshot import is_snapshot
+
+    if "fork" in mp.get_all_start_methods():
+        context = mp.get_context("fork")
+        import local_sd_v1_5_text2img as sd
+        start = time.perf_counter()
+        # No inference in the parent: a used OpenMP pool does not survive fork
+        pipe = sd.load_pipeline(args.model, torch.device("cpu"), trust_remote_code=False, lowvram=False)
+        _POOL_PIPE = share_pipeline(pipe)
+        print(f"Loaded and shared weights in {time.perf_counter() - start:.1f}s (parent RSS {current_rss_mb() or 0:.0f} MB)")
+    elif is_snapshot(args.model):
+        context = mp.get_context("spawn")
+        print("fork is not available; spawned workers will memory-map the snapshot bundle.")
+    else:
+        raise SystemExit("fork is not available on this platform: build a snapshot with pipeline_snapshot.py and pass it as --model")
+
+    rows = []
+    for n in counts:
+        out_dir = os.path.join(args.out_dir, f"workers{n}")
+        os.makedirs(out_dir, exist_ok=True)
+        tasks = build_tasks(prompts, args.num_images, out_dir, args.height, args.width, args.steps, args.scale, args.seed)
+        print(f"--- {n} worker(s) over {len(cores)} cores ---")
+        rows.append(run_pool(args.model, tasks, n, cores, context))
+
+    base = rows[0]["images_per_min"] if rows and rows[0]["images_per_min"] else None
+    for row in rows:
+        row["speedup"] = row["images_per_min"] / base if base and row["images_per_min"] else None
+    print(format_table(rows, REPORT_COLUMNS))
+    with open(os.path.join(args.out_dir, "scaling.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+dashscope_batch.py
+
+Concurrent batch client for DashScope text-to-image (qwen-image / wanx) over the
+async REST API, instead of one blocking ImageSynthesis.call per image.
+
+- prompts file: plain lines, or JSONL records such as
+    {"prompt": "a castle at dawn", "n": 3, "size": "1328*1328", "seed": 7, "out": "castle.png"}
+- up to --concurrency tasks in flight (submit -> poll -> download) under asyncio;
+  the blocking HTTP calls run in worker threads sharing one requests.Session whose
+  connection pool keeps --concurrency keep-alive connections per host
+- identical requests (same prompt / negative prompt / size / seed) are packed into
+  calls of up to the model's max n
+- throttling (HTTP 429 / Throttling.* codes) and transient errors are retried with
+  exponential backoff and jitter, honouring Retry-After; submits (paid, not idempotent)
+  are only retried when no task can have been created: throttled, or the connection
+  was never established
+- a task that returns fewer images than requested counts the missing ones as failed
+- prints images/min, calls and retries at the end; outputs that already exist are
+  skipped, so an interrupted batch can be restarted
+
+Offline test against the local mock (mock_dashscope.py), which throttles at
+--mock-rps submits per second and --mock-max-running unfinished tasks:
+  python dashscope_batch.py --prompts-file prompts.txt --mock --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from downloader import DownloadError, download, get_session
+from remote_cache import DEFAULT_ENDPOINT, REMOTE_CACHE, fingerprint, use_endpoint
+
+DEFAULT_BASE_URL = DEFAULT_ENDPOINT
+IMAGE_SYNTHESIS_PATH = "/services/aigc/text2image/image-synthesis"
+VIDEO_SYNTHESIS_PATH = "/services/aigc/video-generation/video-synthesis"
+# Largest n each model accepts per call (qwen-image always returns a single image)
+MAX_N = {"qwen-image": 1, "qwen-image-plus": 1, "wanx-v1": 4, "wan2.2-t2i-flash": 4, "wan2.2-t2i-plus": 4}
+DEFAULT_MAX_N = 4
+FINAL_STATUSES = ("SUCCEEDED", "FAILED", "CANCELED", "UNKNOWN")
+# DashScopeError code for requests that never reached the server
+CONNECT_ERROR = "ConnectError"
+
+
+class DashScopeError(Exception):
+    def __init__(self, status: int, code: str, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status} {code}: {message}")
+        self.status = status
+        self.code = code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500 or self.code.startswith("Throttling")
+
+    @property
+    def safe_to_resubmit(self) -> bool:
+        """True when a failed submit certainly created no task (a read timeout or 5xx may have)."""
+        return self.status == 429 or self.code.startswith("Throttling") or self.code == CONNECT_ERROR
+
+
+def _never_sent(e: requests.RequestException) -> bool:
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if isinstance(e, requests.ConnectionError) and e.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class DashScopeClient:
+    """Thin REST client; one pooled requests.Session shared by all worker threads."""
+
+    def __init__(self, api_key: str, base_url: str = DEFAULT_BASE_URL, pool_size: int = 8, timeout: float = 60.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+        # Result URLs are fetched through the downloader's own (credential-free) pooled session
+        get_session(pool_size)
+
+    def _json(self, method: str, path: str, **kwargs) -> dict:
+        try:
+            resp = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise DashScopeError(599, CONNECT_ERROR if _never_sent(e) else type(e).__name__, str(e)) from e
+        try:
+            payload = resp.json()
+        except ValueError:
+            payload = {"message": resp.text[:200]}
+        if resp.status_code != 200 or payload.get("code"):
+            retry_after = resp.headers.get("Retry-After")
+            raise DashScopeError(resp.status_code, str(payload.get("code") or ""), str(payload.get("message") or ""),
+                                 float(retry_after) if retry_after and retry_after.replace(".", "", 1).isdigit() else None)
+        return payload
+
+    def submit_image(self, model: str, prompt: str, n: int = 1, size: Optional[str] = None, negative_prompt: Optional[str] = None, seed: Optional[int] = None) -> str:
+        parameters = {"n": n}
+        if size:
+            parameters["size"] = size
+        if seed is not None:
+            parameters["seed"] = seed
+        body = {"model": model, "input": {"prompt": prompt}, "parameters": parameters}
+        if negative_prompt:
+            body["input"]["negative_prompt"] = negative_prompt
+        payload = self._json("POST", IMAGE_SYNTHESIS_PATH, json=body, headers={"X-DashScope-Async": "enable"})
+        return payload["output"]["task_id"]
+
+    def submit_video(self, model: str, prompt: str, size: Optional[str] = None, negative_prompt: Optional[str] = None, seed: Optional[int] = None, **parameters) -> str:
+        """Same request as VideoSynthesis.async_call; extra parameters (prompt_extend, watermark, duration) pass through."""
+        parameters = {k: v for k, v in parameters.items() if v is not None}
+        if size:
+            parameters["size"] = size
+        if seed is not None:
+            parameters["seed"] = seed
+        body = {"model": model, "input": {"prompt": prompt}, "parameters": parameters}
+        if negative_prompt:
+            body["input"]["negative_prompt"] = negative_prompt
+        payload = self._json("POST", VIDEO_SYNTHESIS_PATH, json=body, headers={"X-DashScope-Async": "enable"})
+        return payload["output"]["task_id"]
+
+    def task(self, task_id: str) -> dict:
+        return self._json("GET", f"/tasks/{task_id}")["output"]
+
+    def download(self, url: str, path: str) -> int:
+        """Fetch a result URL to path (atomic, resumable, see downloader.py); returns the byte count."""
+        try:
+            return download(url, path).size
+        except (DownloadError, requests.RequestException) as e:
+            raise DashScopeError(599, type(e).__name__, str(e)) from e
+
+    def close(self):
+        self.session.close()
+
+
+class BatchStats:
+    def __init__(self):
+        self.calls = 0
+        self.images = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self.skipped = 0
+        self.cached = 0
+        self.start = time.perf_counter()
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self.start
+        return {"images": self.images, "calls": self.calls, "skipped": self.skipped, "cached": self.cached, "failed": self.failed,
+                "retries": self.retries, "throttled": self.throttled, "mb": self.bytes / 2 ** 20, "wall_s": wall,
+                "images_per_min": 60.0 * self.images / wall if wall else None}
+
+
+def load_records(path: str, defaults: dict) -> List[dict]:
+    """Plain prompt lines or JSONL records; missing fields fall back to defaults."""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                item = json.loads(line) if line.startswith("{") else {"prompt": line}
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_no}: invalid JSON ({e})")
+                continue
+            if not item.get("prompt"):
+                print(f"Skipping line {line_no}: no prompt")
+                continue
+            rec = dict(defaults)
+            rec.update(item)
+            rec["index"] = len(records)
+            records.append(rec)
+    return records
+
+
+def output_paths(rec: dict, out_dir: str) -> List[str]:
+    n = max(1, int(rec.get("n") or 1))
+    if rec.get("out"):
+        root, ext = os.path.splitext(rec["out"])
+        return [rec["out"]] if n == 1 else [f"{root}_{k}{ext or '.png'}" for k in range(n)]
+    return [os.path.join(out_dir, f"{rec['index']:05d}_{k}.png") for k in range(n)]
+
+
+def pack_calls(records: List[dict], out_dir: str, max_n: int, stats: BatchStats, model: str, use_cache: bool = True,
+               endpoint: str = DEFAULT_BASE_URL) -> List[dict]:
+    """Group pending outputs of identical requests and split them into calls of up to max_n images.
+
+    Outputs already on disk are skipped and ones in the remote cache are copied from it;
+    only the rest are sent to the API. A seeded request for n images gets seeds seed, seed+1,
+    ... (what one n-image call returns), so each call covers a run of consecutive image
+    indexes and is sent with seed + the index of its first image.
+    """
+    groups: Dict[tuple, List[str]] = {}
+    for rec in records:
+        key = (rec["prompt"], rec.get("negative_prompt") or None, rec.get("size") or None, rec.get("seed"))
+        groups.setdefault(key, []).extend(output_paths(rec, out_dir))
+    calls = []
+    for (prompt, negative_prompt, size, seed), paths in groups.items():
+        pending, runs = 0, []
+        previous = None
+        for index, path in enumerate(paths):
+            if os.path.exists(path):
+                stats.skipped += 1
+                continue
+            pending += 1
+            # The index keeps the k-th image of a repeated request a distinct cache entry
+            fp = fingerprint("image", model, prompt, size=size, seed=seed, negative_prompt=negative_prompt, index=index,
+                             endpoint=endpoint)
+            if use_cache and REMOTE_CACHE.lookup(fp, path):
+                stats.cached += 1
+                continue
+            # Unseeded images are interchangeable; seeded ones must stay contiguous to keep their seeds
+            if not runs or (seed is not None and index != previous + 1):
+                runs.append([])
+            runs[-1].append((index, path, fp))
+            previous = index
+        chunks = [run[i:i + max_n] for run in runs for i in range(0, len(run), max_n)]
+        REMOTE_CACHE.avoided(max(0, -(-pending // max_n) - len(chunks)))
+        for chunk in chunks:
+            calls.append({"prompt": prompt, "negative_prompt": negative_prompt, "size": size,
+                          "seed": None if seed is None else seed + chunk[0][0],
+                          "outs": [path for _, path, _ in chunk], "fingerprints": [fp for _, _, fp in chunk]})
+    return calls
+
+
+async def with_backoff(stats: BatchStats, fn, *args, retries: int = 6, base_delay: float = 1.0, max_delay: float = 30.0,
+                       idempotent: bool = True, deadline: Optional[float] = None):
+    """Run a blocking client call in a worker thread, retrying throttling/transient errors.
+
+    idempotent=False (task submits) retries only errors after which no task can exist.
+    deadline (time.monotonic()) gives up instead of sleeping past it.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.to_thread(fn, *args)
+        except DashScopeError as e:
+            if not (e.retryable if idempotent else e.safe_to_resubmit) or attempt == retries:
+                raise
+            stats.retries += 1
+            if e.status == 429 or e.code.startswith("Throttling"):
+                stats.throttled += 1
+            delay = max(min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0), e.retry_after or 0.0)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+
+
+async def run_call(client: DashScopeClient, call: dict, model: str, sem: asyncio.Semaphore, stats: BatchStats, poll_interval: float, timeout: float):
+    async with sem:
+        n = len(call["outs"])
+        try:
+            task_id = await with_backoff(stats, client.submit_image, model, call["prompt"], n, call["size"],
+                                         call["negative_prompt"], call["seed"], idempotent=False)
+            stats.calls += 1
+            deadline = time.monotonic() + timeout
+            while True:
+                await asyncio.sleep(poll_interval)
+                output = await with_backoff(stats, client.task, task_id)
+                status = output.get("task_status")
+                if status in FINAL_STATUSES:
+                    break
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"task {task_id} still {status} after {timeout:.0f}s")
+            urls = [r["url"] for r in output.get("results") or [] if r.get("url")]
+            if status != "SUCCEEDED" or not urls:
+                raise RuntimeError(f"task {task_id} {status}: {output.get('message') or output.get('results')}")
+            if len(urls) < n:
+                stats.failed += n - len(urls)
+                print(f"Task {task_id} returned {len(urls)} of {n} image(s); missing: {', '.join(call['outs'][len(urls):])}")
+                n = len(urls)
+            sizes = await asyncio.gather(*(with_backoff(stats, client.download, url, path) for url, path in zip(urls, call["outs"])))
+        except Exception as e:
+            stats.failed += n
+            print(f"Failed ({n} image(s)) '{call['prompt'][:40]}': {e}")
+            return
+        for path, fp, url in zip(call["outs"], call["fingerprints"], urls):
+            REMOTE_CACHE.store(fp, path, url=url, task_id=task_id)
+        stats.images += len(sizes)
+        stats.bytes += sum(sizes)
+        print(f"Saved {', '.join(call['outs'][:len(sizes)])}")
+
+
+async def run_batch(client: DashScopeClient, calls: List[dict], model: str, concurrency: int, stats: BatchStats, poll_interval: float = 2.0, timeout: float = 600.0,
+                    max_n: int = DEFAULT_MAX_N):
+    loop = asyncio.get_running_loop()
+    # Every in-flight call may be polling or downloading up to max_n images at once
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency * (1 + max_n)))
+    sem = asyncio.Semaphore(concurrency)
+    await asyncio.gather(*(run_call(client, call, model, sem, stats, poll_interval, timeout) for call in calls))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent DashScope text-to-image batch client")
+    parser.add_argument("--prompts-file", type=str, required=True, help="Plain prompt lines or JSONL records (prompt, n, size, seed, negative_prompt, out)")
+    parser.add_argument("--out-dir", type=str, default="", help="Output directory (default: timestamped folder)")
+    parser.add_argument("--model", type=str, default="qwen-image")
+    parser.add_argument("--size", type=str, default="1328*1328")
+    parser.add_argument("--concurrency", type=int, default=4, help="Max tasks in flight (submit, poll and download)")
+    parser.add_argument("--max-n", type=int, default=None, help="Images per call when packing repeated prompts (default: the model's limit)")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--task-timeout", type=float, default=600.0)
+    parser.add_argument("--api-key", type=str, default=None, help="Default: $DASHSCOPE_API_KEY")
+    parser.add_argument("--base-url", type=str, default=os.getenv("DASHSCOPE_BASE_URL", DEFAULT_BASE_URL))
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the remote result cache: regenerate everything (results still refresh the cache)")
+    parser.add_argument("--mock", action="store_true", help="Run against an in-process mock_dashscope server (offline test)")
+    parser.add_argument("--mock-rps", type=float, default=2.0, help="--mock: submits per second before HTTP 429 (0 = unlimited)")
+    parser.add_argument("--mock-max-running", type=int, default=4, help="--mock: unfinished tasks before HTTP 429 (0 = unlimited)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    base_url, api_key, server = args.base_url, args.api_key or os.getenv("DASHSCOPE_API_KEY"), None
+    if args.mock:
+        from mock_dashscope import MockState, serve
+        server, base_url = serve(state=MockState(rps=args.mock_rps, max_running=args.mock_max_running))
+        api_key = api_key or "sk-mock"
+        print(f"Using mock DashScope at {base_url}")
+    if not api_key:
+        raise SystemExit("please provide dashscope api key (--api-key or DASHSCOPE_API_KEY).")
+    if not use_endpoint(base_url, args.mock):
+        print(f"Remote result cache off for {base_url}")
+
+    out_dir = args.out_dir or "qwen_batch_" + datetime.now().strftime("%Y%m%d-%H%M%S")
+    max_n = max(1, args.max_n or MAX_N.get(args.model, DEFAULT_MAX_N))
+    stats = BatchStats()
+    records = load_records(args.prompts_file, {"size": args.size})
+    calls = pack_calls(records, out_dir, max_n, stats, args.model, use_cache=not args.no_cache, endpoint=base_url)
+    print(f"{len(records)} prompt(s) -> {sum(len(c['outs']) for c in calls)} image(s) in {len(calls)} call(s) "
+          f"(n <= {max_n}, concurrency {args.concurrency}); {stats.skipped} already on disk, {stats.cached} from cache")
+
+    client = DashScopeClient(api_key, base_url, pool_size=args.concurrency * (1 + max_n))
+    try:
+        asyncio.run(run_batch(client, calls, args.model, max(1, args.concurrency), stats, args.poll_interval, args.task_timeout, max_n))
+    finally:
+        client.close()
+        if server is not None:
+            server.shutdown()
+
+    summary = stats.summary()
+    print(f"{summary['images']} image(s) in {summary['wall_s']:.1f}s = {summary['images_per_min'] or 0:.1f} images/min; "
+          f"{summary['calls']} call(s), {summary['retries']} retries ({summary['throttled']} throttled), "
+          f"{summary['failed']} failed, {summary['skipped']} skipped, {summary['cached']} from cache "
+          f"({REMOTE_CACHE.calls_avoided} remote call(s) avoided)")
+    summary["remote_cache"] = REMOTE_CACHE.stats()
+    REMOTE_CACHE.save_stats()
+    if os.path.isdir(out_dir):
+        with open(os.path.join(out_dir, "batch_stats.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
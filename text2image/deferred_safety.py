@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+deferred_safety.py
+
+Deferred, batched NSFW safety checking for Stable Diffusion pipelines.
+
+attach() swaps the inline safety checker for a pass-through (the same trick as
+--disable_safety) and keeps the real StableDiffusionSafetyChecker for a background
+worker. Saved images are queued with save_checked(); the worker collects up to
+batch_size images (or whatever arrived within max_wait_s), classifies them in one
+forward pass and appends a verdict per image to a safety.jsonl sidecar next to the
+image. Flagged outputs are moved into a quarantine folder once they have been written.
+If the check itself fails (feature extractor, checker or device error) the batch fails
+closed: every image is quarantined with an {"nsfw": null, "error": ...} record.
+
+Images are returned to the caller immediately; moderation completes asynchronously
+and close() drains the queue.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+
+from image_writer import get_writer
+
+SIDECAR_NAME = "safety.jsonl"
+
+
+def _passthrough_safety(images, **kwargs):
+    return images, [False] * len(images)
+
+
+class DeferredSafetyChecker:
+    def __init__(self, safety_checker, feature_extractor, device: torch.device, dtype: torch.dtype = torch.float32, batch_size: int = 8, max_wait_s: float = 0.5, quarantine_dir: Optional[str] = None):
+        self.safety_checker = safety_checker
+        self.feature_extractor = feature_extractor
+        self.device = device
+        self.dtype = dtype
+        self.batch_size = max(1, batch_size)
+        self.max_wait_s = max_wait_s
+        self.quarantine_dir = quarantine_dir
+        self.checked = 0
+        self.flagged = 0
+        self.failed = 0
+        self.batches = 0
+        self.check_seconds = 0.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name="deferred-safety", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def attach(cls, pipe, device: Optional[torch.device] = None, **kwargs) -> Optional["DeferredSafetyChecker"]:
+        """Move pipe's safety checker off the generation path; returns None if it has none."""
+        if getattr(pipe, "_deferred_safety", None) is not None:
+            return pipe._deferred_safety
+        checker = getattr(pipe, "_original_safety_checker", None) or getattr(pipe, "safety_checker", None)
+        feature_extractor = getattr(pipe, "feature_extractor", None)
+        if not isinstance(checker, torch.nn.Module) or feature_extractor is None:
+            print("Pipeline has no safety checker; deferred safety checking not enabled.")
+            return None
+        if device is None:
+            device = next(checker.parameters()).device
+        dtype = next(checker.parameters()).dtype if device.type == "cuda" else torch.float32
+        checker = checker.to(device=device, dtype=dtype)
+        deferred = cls(checker, feature_extractor, device, dtype, **kwargs)
+        pipe._original_safety_checker = checker
+        pipe.safety_checker = _passthrough_safety
+        pipe._deferred_safety = deferred
+        return deferred
+
+    def submit(self, img, write_future, on_written: Optional[Callable[[str], None]] = None):
+        """Queue one image; write_future resolves to its saved path (see ImageWriter.submit).
+
+        on_written(path) is called only for images that pass the check.
+        """
+        self._queue.put((img, write_future, on_written))
+
+    def _collect(self) -> List:
+        item = self._queue.get()
+        if item is None:
+            return [None]
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                try:
+                    self._check(batch)
+                except Exception as e:
+                    print(f"Warning: deferred safety check failed for {len(batch)} image(s): {e}")
+            if stop:
+                return
+
+    @torch.no_grad()
+    def _classify(self, images) -> List[bool]:
+        clip_input = self.feature_extractor(images=images, return_tensors="pt").pixel_values.to(self.device, self.dtype)
+        # The checker blacks out flagged entries of `images` in place; we only need the verdicts
+        placeholders = [np.zeros((1, 1, 3), dtype=np.float32) for _ in images]
+        _, has_nsfw = self.safety_checker(images=placeholders, clip_input=clip_input)
+        return [bool(nsfw) for nsfw in has_nsfw]
+
+    def _check(self, batch):
+        start = time.perf_counter()
+        error = None
+        try:
+            verdicts = self._classify([img for img, _, _ in batch])
+        except Exception as e:
+            # Fail closed: an image without a verdict is held back like a flagged one
+            error = f"{type(e).__name__}: {e}"
+            verdicts = [None] * len(batch)
+            print(f"Warning: deferred safety check failed for {len(batch)} image(s), quarantining them: {error}")
+        self.check_seconds += time.perf_counter() - start
+        self.batches += 1
+
+        for (_, write_future, on_written), nsfw in zip(batch, verdicts):
+            try:
+                path = write_future.result()
+            except Exception as e:
+                print(f"Warning: skipping safety verdict for an image that failed to save: {e}")
+                continue
+            quarantined = None
+            if nsfw is None:
+                self.failed += 1
+                quarantined = self._quarantine(path, "could not be checked")
+            else:
+                self.checked += 1
+                if nsfw:
+                    self.flagged += 1
+                    quarantined = self._quarantine(path, "flagged by the safety checker")
+                elif on_written is not None:
+                    on_written(path)
+            record = {"path": os.path.abspath(path), "nsfw": nsfw, "quarantined": quarantined,
+                      "batch_size": len(batch), "checked_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            if error is not None:
+                record["error"] = error
+            with open(os.path.join(os.path.dirname(os.path.abspath(path)), SIDECAR_NAME), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _quarantine(self, path: str, reason: str) -> Optional[str]:
+        qdir = self.quarantine_dir or os.path.join(os.path.dirname(os.path.abspath(path)), "quarantine")
+        os.makedirs(qdir, exist_ok=True)
+        target = os.path.join(qdir, os.path.basename(path))
+        try:
+            os.replace(path, target)
+            raw = os.path.splitext(path)[0] + ".npy"
+            if os.path.exists(raw):
+                os.replace(raw, os.path.splitext(target)[0] + ".npy")
+        except OSError as e:
+            print(f"Warning: could not quarantine {path}: {e}")
+            return None
+        print(f"{path} {reason}; moved to {target}")
+        return os.path.abspath(target)
+
+    def close(self):
+        """Wait for every queued image to be checked and stop the worker."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "flagged": self.flagged,
+            "failed": self.failed,
+            "batches": self.batches,
+            "mean_batch": round(self.checked / self.batches, 2) if self.batches else None,
+            "check_s": round(self.check_seconds, 3),
+        }
+
+
+def save_checked(pipe, img, path: str, on_written: Optional[Callable[[str], None]] = None) -> str:
+    """Save img through the image writer and queue it for deferred checking if pipe has it.
+
+    on_written(path) runs once the file exists, or after it passed the deferred safety
+    check when that is enabled (so flagged images never reach e.g. the result cache).
+    """
+    writer = get_writer()
+    future = writer.submit(img, path)
+    deferred = getattr(pipe, "_deferred_safety", None)
+    if deferred is not None:
+        deferred.submit(img, future, on_written)
+    elif on_written is not None:
+        future.add_done_callback(lambda f: f.exception() is None and on_written(f.result()))
+    return writer.output_path(path)
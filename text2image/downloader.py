@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+downloader.py
+
+Shared download path for remote generation results (DashScope image URLs, video MP4s).
+
+- streams 1 MB chunks straight to <path>.part and renames it into place only once
+  complete, so a partial file never appears under the final name
+- resumes an interrupted .part with an HTTP Range request (retrying with backoff); the
+  part files are only reused for the same object: <path>.part.json records the URL,
+  size and ETag / Last-Modified, ranged requests carry If-Range, and every 206 must
+  start at the requested offset
+- splits large files into parallel ranged segments (<path>.part0, .part1, ...,
+  each resumable on its own) and joins them at the end
+- verifies the size against Content-Range / Content-Length (or expected_size) and,
+  when given, the SHA-256
+- returns throughput metrics (MB, seconds, MB/s, resumed bytes, segments)
+
+The size probe is a GET of bytes=0-0 rather than HEAD, because pre-signed OSS URLs
+are only valid for the method they were signed for.
+
+  python downloader.py URL out.mp4 --segments 4
+  python downloader.py selftest     # resume / segments / checksum against a local stand-in server
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1 << 20
+MIN_SEGMENT_BYTES = 8 << 20
+TIMEOUT = (10, 60)  # connect, read
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class DownloadResult:
+    def __init__(self, path: str, size: int, transferred: int, resumed: int, seconds: float, segments: int, sha256: Optional[str]):
+        self.path = path
+        self.size = size
+        self.transferred = transferred
+        self.resumed = resumed
+        self.seconds = seconds
+        self.segments = segments
+        self.sha256 = sha256
+
+    @property
+    def mb_per_s(self) -> Optional[float]:
+        return self.transferred / 2 ** 20 / self.seconds if self.seconds else None
+
+    def as_dict(self) -> dict:
+        return {"path": self.path, "mb": self.size / 2 ** 20, "transferred_mb": self.transferred / 2 ** 20,
+                "resumed_mb": self.resumed / 2 ** 20, "seconds": self.seconds, "mb_per_s": self.mb_per_s,
+                "segments": self.segments, "sha256": self.sha256}
+
+    def __str__(self):
+        rate = f"{self.mb_per_s:.1f} MB/s" if self.mb_per_s is not None else "-"
+        resumed = f", resumed {self.resumed / 2 ** 20:.1f} MB" if self.resumed else ""
+        return f"{self.path}: {self.size / 2 ** 20:.1f} MB in {self.seconds:.1f}s ({rate}, {self.segments} segment(s){resumed})"
+
+
+def get_session(pool_size: int = 16) -> requests.Session:
+    """Process-wide keep-alive session for downloads (no API credentials attached)."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=0)
+            _SESSION.mount("http://", adapter)
+            _SESSION.mount("https://", adapter)
+        return _SESSION
+
+
+def probe(session: requests.Session, url: str) -> Tuple[Optional[int], bool, dict]:
+    """(total size or None, whether byte ranges are supported, ETag / Last-Modified validators)."""
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT) as resp:
+        validators = {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+        if resp.status_code == 206:
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            return (int(total) if total.isdigit() else None), True, validators
+        if resp.status_code == 200:
+            length = resp.headers.get("Content-Length")
+            return (int(length) if length and length.isdigit() else None), False, validators
+        raise DownloadError(f"HTTP {resp.status_code} for {url}", retryable=resp.status_code >= 500)
+
+
+def if_range_value(validators: dict) -> Optional[str]:
+    """Validator for If-Range: a strong ETag, else Last-Modified (weak ETags are not allowed)."""
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def _prepare_parts(part_path: str, url: str, total: Optional[int], validators: dict, segments: int):
+    """Keep existing part files only if they were written for the same object and layout."""
+    # Pre-signed URLs get a new query string on every signing; with a validator the path is enough
+    source = {"url": url.split("?")[0] if if_range_value(validators) else url, "size": total, "segments": segments, **validators}
+    meta_path = part_path + ".json"
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if previous != source:
+        for stale in glob.glob(glob.escape(part_path) + "*"):
+            os.remove(stale)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(source, f)
+
+
+def _remove_parts(part_path: str):
+    for leftover in glob.glob(glob.escape(part_path) + "*"):
+        os.remove(leftover)
+
+
+def _fetch_range(session: requests.Session, url: str, part_path: str, start: int, end: Optional[int], ranged: bool, counter: list,
+                 retries: int, if_range: Optional[str] = None):
+    """Fill part_path with bytes [start, end] (end inclusive, None = to EOF), resuming from its current length."""
+    for attempt in range(retries + 1):
+        have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if end is not None and have >= end - start + 1:
+            return
+        headers = {}
+        if ranged and (have or start or end is not None):
+            headers["Range"] = f"bytes={start + have}-{'' if end is None else end}"
+            if if_range:
+                headers["If-Range"] = if_range
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+                if resp.status_code == 200 and headers:
+                    raise DownloadError("remote object changed or server ignored the Range request", retryable=False)
+                if resp.status_code == 200:
+                    have = 0  # full body: start the part over
+                elif resp.status_code == 206:
+                    content_range = resp.headers.get("Content-Range", "")
+                    first = content_range[len("bytes "):].partition("-")[0]
+                    if not content_range.startswith("bytes ") or not first.isdigit() or int(first) != start + have:
+                        raise DownloadError(f"Content-Range {content_range!r} does not start at byte {start + have}", retryable=False)
+                else:
+                    raise DownloadError(f"HTTP {resp.status_code} for {url}", retryable=resp.status_code >= 500)
+                with open(part_path, "ab" if have else "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        counter[0] += len(chunk)
+            have = os.path.getsize(part_path)
+            if end is None or have >= end - start + 1:
+                return
+            raise DownloadError(f"connection closed after {have} of {end - start + 1} bytes")
+        except (requests.RequestException, DownloadError) as e:
+            if attempt == retries or not getattr(e, "retryable", True):
+                raise DownloadError(f"{os.path.basename(part_path)}: {e}", retryable=False) from e
+            delay = min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"Download interrupted ({e}); resuming in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url: str, path: str, session: Optional[requests.Session] = None, segments: int = 4, expected_size: Optional[int] = None,
+             expected_sha256: Optional[str] = None, retries: int = 4, min_segment_bytes: int = MIN_SEGMENT_BYTES) -> DownloadResult:
+    """Download url to path (atomically, resumable, optionally segmented and verified)."""
+    session = session or get_session()
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part_path = path + ".part"
+    start_time = time.perf_counter()
+    counter = [0]
+
+    total, ranged, validators = probe(session, url)
+    if expected_size is not None and total is not None and total != expected_size:
+        raise DownloadError(f"server reports {total} bytes, expected {expected_size}", retryable=False)
+    total = total if total is not None else expected_size
+    n = max(1, min(segments, total // min_segment_bytes)) if ranged and total else 1
+    _prepare_parts(part_path, url, total, validators, n)
+    if_range = if_range_value(validators)
+
+    if n == 1:
+        resumed = os.path.getsize(part_path) if ranged and os.path.exists(part_path) else 0
+        _fetch_range(session, url, part_path, 0, total - 1 if total else None, ranged, counter, retries, if_range)
+    else:
+        bounds = [(i * total // n, (i + 1) * total // n - 1) for i in range(n)]
+        seg_paths = [f"{part_path}{i}" for i in range(n)]
+        resumed = sum(os.path.getsize(p) for p in seg_paths if os.path.exists(p))
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            futures = [pool.submit(_fetch_range, session, url, p, s, e, True, counter, retries, if_range) for p, (s, e) in zip(seg_paths, bounds)]
+            for future in futures:
+                future.result()
+        with open(part_path, "wb") as out:
+            for p in seg_paths:
+                with open(p, "rb") as f:
+                    shutil.copyfileobj(f, out, CHUNK_SIZE)
+        for p in seg_paths:
+            os.remove(p)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        _remove_parts(part_path)
+        raise DownloadError(f"size mismatch: got {size} bytes, expected {total}")
+    sha = file_sha256(part_path) if expected_sha256 else None
+    if expected_sha256 and sha != expected_sha256.lower():
+        _remove_parts(part_path)
+        raise DownloadError(f"sha256 mismatch: got {sha}, expected {expected_sha256}")
+    os.replace(part_path, path)
+    os.remove(part_path + ".json")
+    return DownloadResult(path, size, counter[0], resumed, time.perf_counter() - start_time, n, sha)
+
+
+def serve_bytes(data: bytes, drop_after: int = 0):
+    """Local stand-in: serve data at /file with Range support; the first response is cut after
+    drop_after bytes (0 = never). Returns (server, url)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {"dropped": False}
+    etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            start, end, status = 0, len(data) - 1, 200
+            spec = self.headers.get("Range", "")
+            if self.headers.get("If-Range", etag) != etag:
+                spec = ""  # changed object: send it whole
+            if spec.startswith("bytes="):
+                first, _, last = spec[len("bytes="):].partition("-")
+                start, end, status = int(first), int(last) if last else len(data) - 1, 206
+            body = data[start:end + 1]
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            self.end_headers()
+            if drop_after and not state["dropped"] and len(body) > drop_after:
+                state["dropped"] = True
+                self.wfile.write(body[:drop_after])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/file"
+
+
+def selftest(out_dir: str, mb: int = 24):
+    data = os.urandom(mb << 20)
+    sha = hashlib.sha256(data).hexdigest()
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    for name, segments, drop_after in (("single", 1, 0), ("single+resume", 1, 5 << 20), ("segmented", 4, 0), ("segmented+resume", 4, 3 << 20)):
+        server, url = serve_bytes(data, drop_after)
+        try:
+            result = download(url, os.path.join(out_dir, f"{name}.bin"), session=requests.Session(), segments=segments,
+                              expected_sha256=sha, retries=2)
+        finally:
+            server.shutdown()
+        with open(result.path, "rb") as f:
+            ok = f.read() == data
+        print(f"{name:<18} {'ok' if ok else 'MISMATCH':<8} {result}")
+        results.append(ok)
+    # An interrupted download of another object must not be resumed into this one
+    other = os.urandom(len(data))
+    server, url = serve_bytes(other, drop_after=5 << 20)
+    try:
+        download(url, os.path.join(out_dir, "replaced.bin"), session=requests.Session(), segments=1, retries=0)
+    except DownloadError:
+        pass
+    finally:
+        server.shutdown()
+    server, url = serve_bytes(data)
+    try:
+        result = download(url, os.path.join(out_dir, "replaced.bin"), session=requests.Session(), segments=1, expected_sha256=sha)
+    finally:
+        server.shutdown()
+    print(f"{'replaced-object':<18} {'ok' if result.resumed == 0 else 'RESUMED':<8} {result}")
+    results.append(result.resumed == 0)
+    if not all(results):
+        raise SystemExit("selftest failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable, segmented, verified download (or 'selftest')")
+    parser.add_argument("url", help="URL to fetch, or 'selftest' to run against a local stand-in server")
+    parser.add_argument("out", nargs="?", default="", help="Output path (selftest: output directory)")
+    parser.add_argument("--segments", type=int, default=4, help="Parallel ranged segments for large files")
+    parser.add_argument("--sha256", type=str, default=None, help="Expected SHA-256 of the file")
+    parser.add_argument("--size", type=int, default=None, help="Expected size in bytes")
+    args = parser.parse_args()
+    if args.url == "selftest":
+        selftest(args.out or "download_selftest")
+        return
+    print(download(args.url, args.out or os.path.basename(args.url.split("?")[0]) or "download.bin",
+                   segments=args.segments, expected_size=args.size, expected_sha256=args.sha256))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+embedding_cache.py
+
+Bounded LRU cache for CLIP text-encoder outputs of Stable Diffusion pipelines.
+
+Entries are keyed by (model, prompt, negative prompt, max_len, cfg) and hold the
+(prompt_embeds, negative_prompt_embeds) pair, so repeated prompts skip both the
+tokenizer and the text encoder and feed prompt_embeds straight to the pipeline.
+The model part is the caller's key for the encoder that produced them: weights
+identity plus device, dtype and quantization mode.
+"""
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import torch
+
+
+class PromptEmbeddingCache:
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def resize(self, max_entries: int):
+        with self._lock:
+            self.max_entries = max_entries
+            while len(self._entries) > max(0, max_entries):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def get_or_encode(self, pipe, model: str, prompt: str, negative_prompt: Optional[str], max_len: int, device: torch.device, do_cfg: bool, prepare: Optional[Callable[[str], str]] = None):
+        """Return cached (prompt_embeds, negative_prompt_embeds) or encode and store them.
+
+        prepare is applied to the prompt only on a miss (e.g. tokenizer truncation);
+        negative_prompt_embeds is None when classifier-free guidance is off.
+        """
+        key = (model, prompt, negative_prompt or "", max_len, do_cfg)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        text = prepare(prompt) if prepare is not None else prompt
+        entry = encode_prompt(pipe, text, negative_prompt, device, do_cfg)
+        if self.enabled:
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+
+@torch.no_grad()
+def encode_prompt(pipe, prompt: str, negative_prompt: Optional[str], device: torch.device, do_cfg: bool):
+    """Run the pipeline's own prompt encoder for a single prompt."""
+    if hasattr(pipe, "encode_prompt"):
+        prompt_embeds, negative_embeds = pipe.encode_prompt(
+            prompt, device, 1, do_cfg, negative_prompt=negative_prompt,
+        )
+    else:
+        # diffusers < 0.22 only has _encode_prompt, which returns [uncond, cond] concatenated
+        embeds = pipe._encode_prompt(prompt, device, 1, do_cfg, negative_prompt=negative_prompt)
+        if do_cfg:
+            negative_embeds, prompt_embeds = embeds.chunk(2)
+        else:
+            prompt_embeds, negative_embeds = embeds, None
+    return prompt_embeds, (negative_embeds if do_cfg else None)
+
+
+# Process-wide cache shared by all generate() calls; resize(0) disables it
+EMBED_CACHE = PromptEmbeddingCache()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+fast_cache.py
+
+DeepCache-style feature reuse for the SD 1.x / 2.x UNet (--fast-cache).
+
+High-level UNet features change slowly between adjacent denoising steps. Every
+`interval` steps the UNet runs in full and the input of its last (outermost) up
+block is cached. On the steps in between only the shallow path runs: conv_in, the
+first down block, the last up block (fed the cached deep features plus fresh skip
+connections) and the output head. The skipped blocks are where nearly all the UNet
+FLOPs are spent.
+
+A new generation is detected when the timestep goes up again, which forces a full
+step, so no state leaks between calls.
+
+Benchmark (wall time per image and similarity to interval 1 = full computation):
+  python fast_cache.py bench --model G:/AIModels/.../stable-diffusion-v1-5 --intervals 1,2,3,5 --steps 30
+"""
+import argparse
+import json
+import os
+from typing import Optional
+
+import torch
+
+from perf_utils import Timer, format_table, image_similarity
+
+
+class FastCacheSettings:
+    def __init__(self):
+        self.interval = 1
+
+
+SETTINGS = FastCacheSettings()
+
+
+def set_fast_cache(interval: int = 1):
+    SETTINGS.interval = max(1, int(interval))
+
+
+class _CacheState:
+    def __init__(self, unet, interval: int):
+        self.unet = unet
+        self.interval = interval
+        self.feature: Optional[torch.Tensor] = None
+        self.last_t: Optional[float] = None
+        self.step = 0
+        self.full_steps = 0
+        self.cached_steps = 0
+        self.previous_forward = None
+        self.forward_patch = None
+        self.hook = unet.up_blocks[-2].register_forward_hook(self._capture)
+
+    def _capture(self, module, args, output):
+        self.feature = output[0] if isinstance(output, tuple) else output
+
+    def _timesteps(self, timestep, sample):
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor([timestep], device=sample.device)
+        elif timestep.dim() == 0:
+            timestep = timestep[None].to(sample.device)
+        return timestep.expand(sample.shape[0])
+
+    def forward(self, original_forward, sample, timestep, encoder_hidden_states, *args, **kwargs):
+        t = float(torch.as_tensor(timestep).max())
+        if self.last_t is not None and t > self.last_t:
+            # Timesteps only decrease within a generation: this is a new one
+            self.step = 0
+            self.feature = None
+        self.last_t = t
+
+        full = (self.step % self.interval == 0 or self.feature is None or self.feature.shape[0] != sample.shape[0]
+                or args or kwargs.get("down_block_additional_residuals") is not None)
+        self.step += 1
+        if full:
+            self.full_steps += 1
+            return original_forward(sample, timestep, encoder_hidden_states, *args, **kwargs)
+        self.cached_steps += 1
+        return self._shallow(sample, timestep, encoder_hidden_states, **kwargs)
+
+    def _shallow(self, sample, timestep, encoder_hidden_states, timestep_cond=None, attention_mask=None,
+                 cross_attention_kwargs=None, encoder_attention_mask=None, return_dict: bool = True, **unused):
+        unet = self.unet
+        t_emb = unet.time_proj(self._timesteps(timestep, sample)).to(dtype=sample.dtype)
+        emb = unet.time_embedding(t_emb, timestep_cond)
+
+        sample = unet.conv_in(sample)
+        residuals = (sample,)
+        down = unet.down_blocks[0]
+        if getattr(down, "has_cross_attention", False):
+            sample, res = down(hidden_states=sample, temb=emb, encoder_hidden_states=encoder_hidden_states,
+                               attention_mask=attention_mask, cross_attention_kwargs=cross_attention_kwargs,
+                               encoder_attention_mask=encoder_attention_mask)
+        else:
+            sample, res = down(hidden_states=sample, temb=emb)
+        residuals += res
+
+        up = unet.up_blocks[-1]
+        # The outermost up block consumes the earliest skip connections (conv_in + first down block resnets)
+        skips = residuals[:len(up.resnets)]
+        if getattr(up, "has_cross_attention", False):
+            sample = up(hidden_states=self.feature, temb=emb, res_hidden_states_tuple=skips,
+                        encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs,
+                        attention_mask=attention_mask, encoder_attention_mask=encoder_attention_mask)
+        else:
+            sample = up(hidden_states=self.feature, temb=emb, res_hidden_states_tuple=skips)
+
+        if unet.conv_norm_out is not None:
+            sample = unet.conv_act(unet.conv_norm_out(sample))
+        sample = unet.conv_out(sample)
+        if not return_dict:
+            return (sample,)
+        from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput  # type: ignore[import]
+        return UNet2DConditionOutput(sample=sample)
+
+
+def supports_fast_cache(unet) -> Optional[str]:
+    """None if the UNet layout is supported, else the reason it is not."""
+    if hasattr(unet, "_orig_mod"):
+        return "the UNet is torch.compile'd (use --cpu-profile default)"
+    if not hasattr(unet, "up_blocks") or len(getattr(unet, "up_blocks", [])) < 2:
+        return "not a UNet2DConditionModel"
+    if getattr(unet, "class_embedding", None) is not None or getattr(unet, "add_embedding", None) is not None:
+        return "UNets with class/added embeddings (e.g. SDXL) are not supported"
+    return None
+
+
+def enable_fast_cache(pipe, interval: int):
+    """Patch pipe.unet to reuse deep features for interval - 1 of every interval steps."""
+    disable_fast_cache(pipe)
+    if interval <= 1:
+        return None
+    unet = pipe.unet
+    reason = supports_fast_cache(unet)
+    if reason is not None:
+        print(f"--fast-cache disabled: {reason}.")
+        return None
+    state = _CacheState(unet, interval)
+    original_forward = unet.forward
+    # Keep any instance-level forward already installed (e.g. accelerate offload hooks) to restore later
+    state.previous_forward = unet.__dict__.get("forward")
+
+    def forward(sample, timestep, encoder_hidden_states, *args, **kwargs):
+        return state.forward(original_forward, sample, timestep, encoder_hidden_states, *args, **kwargs)
+
+    unet.forward = forward
+    state.forward_patch = forward
+    pipe._fast_cache = state
+    return state
+
+
+def disable_fast_cache(pipe):
+    state = getattr(pipe, "_fast_cache", None)
+    if state is None:
+        return
+    state.hook.remove()
+    unet = state.unet
+    if unet.__dict__.get("forward") is state.forward_patch:
+        if state.previous_forward is not None:
+            unet.forward = state.previous_forward
+        else:
+            del unet.forward
+    pipe._fast_cache = None
+
+
+def apply_fast_cache(pipe):
+    """Bring pipe in line with SETTINGS.interval (no-op when already matching)."""
+    state = getattr(pipe, "_fast_cache", None)
+    current = state.interval if state is not None else 1
+    if current != SETTINGS.interval:
+        enable_fast_cache(pipe, SETTINGS.interval)
+    return pipe
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="--fast-cache benchmark: speedup and similarity vs full UNet")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("bench", help="Time each reuse interval against interval 1 (full computation)")
+    p.add_argument("--model", type=str, required=True)
+    p.add_argument("--intervals", type=str, default="1,2,3,5")
+    p.add_argument("--prompt", type=str, default="a lighthouse on a cliff at sunset, detailed")
+    p.add_argument("--steps", type=int, default=30)
+    p.add_argument("--size", type=int, default=512)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--runs", type=int, default=2, help="Timed runs per interval (after one warm-up)")
+    p.add_argument("--device", type=str, default=None)
+    p.add_argument("--out-dir", type=str, default="fast_cache_bench")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    import local_sd_v1_5_text2img as sd
+
+    device = sd.choose_device(args.device)
+    pipe = sd.load_pipeline(args.model, device, trust_remote_code=False, lowvram=False)
+    pipe.set_progress_bar_config(disable=True)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    intervals = sorted({max(1, int(n)) for n in args.intervals.split(",") if n.strip()} | {1})
+    rows, reference = [], None
+    for interval in intervals:
+        state = enable_fast_cache(pipe, interval)
+        kwargs = {"prompt": args.prompt, "height": args.size, "width": args.size, "num_inference_steps": args.steps}
+        pipe(generator=torch.Generator(device=device).manual_seed(args.seed), **dict(kwargs, num_inference_steps=2))
+        times = []
+        for _ in range(max(1, args.runs)):
+            with Timer(device) as timer:
+                image = pipe(generator=torch.Generator(device=device).manual_seed(args.seed), **kwargs).images[0]
+            times.append(timer.seconds)
+        out = os.path.join(args.out_dir, f"interval{interval}.png")
+        image.save(out)
+        if interval == 1:
+            reference = image
+        row = {"interval": interval, "s_per_image": sum(times) / len(times), "out": out,
+               "full_steps": state.full_steps if state else None, "cached_steps": state.cached_steps if state else None}
+        row.update(image_similarity(reference, image))
+        rows.append(row)
+    disable_fast_cache(pipe)
+
+    base = rows[0]["s_per_image"]
+    for row in rows:
+        row["speedup"] = base / row["s_per_image"] if row["s_per_image"] else None
+    print(format_table(rows, ["interval", "s_per_image", "speedup", "psnr_db", "cosine", "out"]))
+    with open(os.path.join(args.out_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
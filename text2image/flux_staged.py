@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+flux_staged.py
+
+Staged FLUX execution: only the components the current stage needs are resident.
+
+  1. text_encode  load CLIP + T5 text encoders, encode the prompt, free them
+  2. denoise      load the transformer, denoise to packed latents, free it
+  3. vae_decode   load the VAE, unpack + decode the latents
+
+Peak memory is now roughly max(T5, transformer, VAE + activations) instead of
+their sum, at the cost of reading each component from disk on every call (so this
+mode bypasses the pipeline registry). Each stage's components go through the same
+--quantize (including the quantized disk cache) and --cpu-profile handling as
+load_flux_pipeline(). Each stage reports load/run time, peak memory
+(CUDA peak allocated, or sampled RSS on CPU) and the memory left after freeing.
+"""
+import gc
+import os
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import torch
+
+from cpu_profile import apply_cpu_profile, inference_context
+from perf_utils import MemoryTracker, current_rss_mb, format_table, sync
+from quantize import cached_components, quantize_pipeline
+
+STAGE_COLUMNS = ["stage", "load_s", "run_s", "peak_mb", "after_free_mb"]
+TEXT_ENCODERS = ("text_encoder", "text_encoder_2")
+
+
+def _memory_now_mb(device: torch.device) -> Optional[float]:
+    if device.type == "cuda" and torch.cuda.is_available():
+        return torch.cuda.memory_allocated(device) / 2 ** 20
+    return current_rss_mb()
+
+
+def _free(device: torch.device):
+    gc.collect()
+    if device.type == "cuda" and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class _Stage:
+    """Context manager timing load/run of one stage under a MemoryTracker."""
+
+    def __init__(self, name: str, device: torch.device, rows: List[dict]):
+        self.name = name
+        self.device = device
+        self.rows = rows
+        self._tracker = MemoryTracker(device)
+
+    def __enter__(self):
+        self._tracker.__enter__()
+        self._start = time.perf_counter()
+        self._loaded = None
+        return self
+
+    def loaded(self):
+        sync(self.device)
+        self._loaded = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        sync(self.device)
+        end = time.perf_counter()
+        self._tracker.__exit__(exc_type, exc, tb)
+        loaded = self._loaded or self._start
+        self.rows.append({"stage": self.name, "load_s": loaded - self._start, "run_s": end - loaded,
+                          "peak_mb": self._tracker.peak_mb})
+        return False
+
+
+def _load_kwargs(model_id: str, device: torch.device, trust_remote_code: bool) -> dict:
+    return {
+        "dtype": torch.float16 if device.type == "cuda" else torch.float32,
+        "local_files_only": os.path.isdir(model_id),
+        "trust_remote_code": trust_remote_code,
+    }
+
+
+def _load_stage(model_id: str, device: torch.device, load_kwargs: dict, components, **skip):
+    """Load one stage's pipeline with quantized-cache reuse, quantization and the CPU profile applied."""
+    from diffusers import DiffusionPipeline  # type: ignore[import]
+
+    cached = cached_components(model_id, device, load_kwargs["dtype"], components=components)
+    pipe = DiffusionPipeline.from_pretrained(model_id, **skip, **load_kwargs, **cached)
+    pipe._quantized_components = tuple(cached)
+    pipe = quantize_pipeline(pipe, model_id, device, components=components).to(device)
+    return apply_cpu_profile(pipe, device)
+
+
+def generate_staged(prompt: str, out_path: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], trust_remote_code: bool, max_sequence_length: int = 512):
+    """Run FLUX stage by stage and save the image. Returns (out_path, stage rows)."""
+    from diffusers import AutoencoderKL  # type: ignore[import]
+    from diffusers.image_processor import VaeImageProcessor  # type: ignore[import]
+
+    load_kwargs = _load_kwargs(model, device, trust_remote_code)
+    rows: List[dict] = []
+
+    with _Stage("text_encode", device, rows) as stage:
+        encoders = _load_stage(model, device, load_kwargs, TEXT_ENCODERS, transformer=None, vae=None)
+        stage.loaded()
+        with torch.no_grad(), inference_context(encoders):
+            prompt_embeds, pooled, _ = encoders.encode_prompt(prompt=prompt, prompt_2=None, device=device, num_images_per_prompt=1,
+                                                              max_sequence_length=max_sequence_length)
+        del encoders
+    _free(device)
+    rows[-1]["after_free_mb"] = _memory_now_mb(device)
+
+    with _Stage("denoise", device, rows) as stage:
+        pipe = _load_stage(model, device, load_kwargs, ("transformer",), text_encoder=None, text_encoder_2=None,
+                           tokenizer=None, tokenizer_2=None, vae=None)
+        stage.loaded()
+        generator = torch.Generator(device=device).manual_seed(seed) if seed is not None else None
+        with inference_context(pipe):
+            latents = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled, height=height, width=width,
+                           num_inference_steps=steps, guidance_scale=scale, generator=generator, output_type="latent",
+                           max_sequence_length=max_sequence_length).images
+        unpack = type(pipe)._unpack_latents
+        del pipe, prompt_embeds, pooled
+    _free(device)
+    rows[-1]["after_free_mb"] = _memory_now_mb(device)
+
+    with _Stage("vae_decode", device, rows) as stage:
+        vae = AutoencoderKL.from_pretrained(model, subfolder="vae", dtype=load_kwargs["dtype"],
+                                            local_files_only=load_kwargs["local_files_only"]).to(device)
+        # The VAE stays in float under --quantize; the CPU profile still applies (channels_last, bf16 autocast)
+        holder = apply_cpu_profile(SimpleNamespace(vae=vae), device)
+        stage.loaded()
+        vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+        with torch.no_grad(), inference_context(holder):
+            latents = unpack(latents, height, width, vae_scale_factor)
+            latents = latents / vae.config.scaling_factor + vae.config.shift_factor
+            decoded = vae.decode(latents.to(vae.dtype), return_dict=False)[0]
+        # FLUX packs 2x2 latent patches, so the processor works at twice the VAE factor
+        image = VaeImageProcessor(vae_scale_factor=vae_scale_factor * 2).postprocess(decoded, output_type="pil")[0]
+        del vae, holder, latents, decoded
+    _free(device)
+    rows[-1]["after_free_mb"] = _memory_now_mb(device)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)) or ".", exist_ok=True)
+    image.save(out_path)
+    print(format_table(rows, STAGE_COLUMNS))
+    return out_path, rows
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+image_writer.py
+
+Background image writer for the text2image scripts.
+
+Encoding (PNG compression in particular) and disk I/O run on a small worker pool fed
+by a bounded queue, so the next generation overlaps with saving the previous one.
+Supported outputs: PNG (configurable compress_level), WebP, JPEG, and optional raw
+uint8 array dumps (.npy) next to the encoded image. Files are written to a temporary
+name and renamed, so readers never see partial images. Pending writes are flushed
+on close() and at interpreter exit.
+
+workers=0 keeps the old behaviour: encode and save synchronously in the caller.
+"""
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+FORMATS = {
+    "png": (".png", "PNG"),
+    "webp": (".webp", "WEBP"),
+    "jpeg": (".jpg", "JPEG"),
+}
+EXTENSION_FORMATS = {".png": "png", ".webp": "webp", ".jpg": "jpeg", ".jpeg": "jpeg"}
+
+
+def resolve_format(path: str, fmt: Optional[str]):
+    """Return (output path, format name); fmt overrides the extension when given."""
+    root, ext = os.path.splitext(path)
+    if fmt is None:
+        return path, EXTENSION_FORMATS.get(ext.lower(), "png")
+    fmt = fmt.lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown image format '{fmt}', expected one of {list(FORMATS)}")
+    if EXTENSION_FORMATS.get(ext.lower()) != fmt:
+        path = root + FORMATS[fmt][0]
+    return path, fmt
+
+
+def save_image(img, path: str, fmt: Optional[str] = None, png_compress_level: int = 6, quality: int = 90, dump_raw: bool = False) -> str:
+    """Encode and write one PIL image atomically; returns the final path."""
+    path, fmt = resolve_format(path, fmt)
+    os.makedirs(os.path.dirname(os.path.abspath(path)) or ".", exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    pil_format = FORMATS[fmt][1]
+    try:
+        if pil_format == "PNG":
+            img.save(tmp_path, format="PNG", compress_level=png_compress_level)
+        elif pil_format == "WEBP":
+            img.save(tmp_path, format="WEBP", quality=quality, method=4)
+        else:
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(tmp_path, format="JPEG", quality=quality)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # A failed encode must not leave a stray .tmp next to the outputs
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if dump_raw:
+        import numpy as np
+        np.save(os.path.splitext(path)[0] + ".npy", np.asarray(img))
+    return path
+
+
+class ImageWriter:
+    def __init__(self, workers: int = 2, max_queue: int = 8, fmt: Optional[str] = None, png_compress_level: int = 6, quality: int = 90, dump_raw: bool = False):
+        self.workers = workers
+        self.fmt = fmt
+        self.png_compress_level = png_compress_level
+        self.quality = quality
+        self.dump_raw = dump_raw
+        self.images = 0
+        self.encode_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._slots = threading.BoundedSemaphore(max(1, max_queue))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="img-writer") if workers > 0 else None
+
+    def _write(self, img, path: str) -> str:
+        start = time.perf_counter()
+        try:
+            return save_image(img, path, self.fmt, self.png_compress_level, self.quality, self.dump_raw)
+        finally:
+            with self._lock:
+                self.images += 1
+                self.encode_seconds += time.perf_counter() - start
+
+    def submit(self, img, path: str) -> Future:
+        """Queue one image; blocks only when max_queue writes are already pending."""
+        if self._executor is None:
+            fut = Future()
+            try:
+                fut.set_result(self._write(img, path))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+
+        start = time.perf_counter()
+        self._slots.acquire()
+        with self._lock:
+            self.wait_seconds += time.perf_counter() - start
+        fut = self._executor.submit(self._write, img, path)
+        with self._lock:
+            self._pending.add(fut)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, fut: Future):
+        with self._lock:
+            self._pending.discard(fut)
+        self._slots.release()
+        if fut.exception() is not None:
+            print(f"Warning: image write failed: {fut.exception()}")
+
+    def output_path(self, path: str) -> str:
+        """Path an image submitted as `path` will have once written (extension follows fmt)."""
+        return resolve_format(path, self.fmt)[0]
+
+    def save(self, img, path: str) -> str:
+        """Queue (or write) one image and return the path it will have once written."""
+        self.submit(img, path)
+        return self.output_path(path)
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending)
+        for fut in pending:
+            try:
+                fut.result()
+            except Exception:
+                pass
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "images": self.images,
+            "encode_s": round(self.encode_seconds, 3),
+            "queue_wait_s": round(self.wait_seconds, 3),
+            "pending": len(self._pending),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+# Process-wide writer used by the scripts; synchronous until configure_writer() is called
+WRITER = ImageWriter(workers=0)
+
+
+def configure_writer(workers: int = 2, max_queue: int = 8, fmt: Optional[str] = None, png_compress_level: int = 6, quality: int = 90, dump_raw: bool = False) -> ImageWriter:
+    global WRITER
+    WRITER.close()
+    WRITER = ImageWriter(workers, max_queue, fmt, png_compress_level, quality, dump_raw)
+    return WRITER
+
+
+def get_writer() -> ImageWriter:
+    return WRITER
+
+
+@atexit.register
+def _flush_at_exit():
+    WRITER.close()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+latent_preview.py
+
+Cheap progressive previews for Stable Diffusion denoising.
+
+Instead of a VAE decode, the current latents are projected to RGB with a fixed
+4x3 linear map (fitted against VAE decodes of SD 1.x latents), giving a 1/8
+resolution preview at negligible cost next to a UNet step. PreviewCallback plugs
+into callback_on_step_end, emits previews every N steps and can abort a
+generation early by raising GenerationCancelled.
+"""
+from typing import Callable, List, Optional, Sequence
+
+import torch
+
+# Latent channel -> RGB contribution for SD 1.x / 2.x latents (scaled latent space)
+SD15_LATENT_RGB_FACTORS = (
+    (0.3512, 0.2297, 0.3227),
+    (0.3250, 0.4974, 0.2350),
+    (-0.2829, 0.1762, 0.2721),
+    (-0.2120, -0.2616, -0.7177),
+)
+
+
+class GenerationCancelled(Exception):
+    """Raised from the step callback to stop a generation that nobody wants any more."""
+
+
+@torch.no_grad()
+def latents_to_rgb(latents: torch.Tensor, factors: Sequence[Sequence[float]] = SD15_LATENT_RGB_FACTORS, max_size: int = 256):
+    """Project a (B, 4, h, w) latent batch to small PIL RGB images."""
+    from PIL import Image
+
+    weight = torch.tensor(factors, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), weight)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    images = []
+    for arr in rgb:
+        img = Image.fromarray(arr)
+        scale = max_size / max(img.size)
+        if scale > 1:
+            img = img.resize((round(img.width * scale), round(img.height * scale)), Image.BILINEAR)
+        images.append(img)
+    return images
+
+
+class PreviewCallback:
+    """callback_on_step_end hook producing previews for each item of a batch.
+
+    on_preview(index, step, total_steps, image) is called for item `index` every
+    `every[index]` steps (a single int applies to all items). cancelled(index) is
+    polled each step; when every item reports cancelled, the run is aborted.
+    """
+
+    def __init__(self, total_steps: int, every, on_preview: Callable, cancelled: Optional[Callable[[int], bool]] = None, max_size: int = 256):
+        self.total_steps = total_steps
+        self.every = every
+        self.on_preview = on_preview
+        self.cancelled = cancelled
+        self.max_size = max_size
+
+    def _every(self, index: int) -> int:
+        every = self.every[index] if isinstance(self.every, (list, tuple)) else self.every
+        return max(0, int(every or 0))
+
+    def __call__(self, pipe, step: int, timestep, callback_kwargs):
+        latents = callback_kwargs.get("latents")
+        if latents is None:
+            return callback_kwargs
+        batch = latents.shape[0]
+        if self.cancelled is not None and all(self.cancelled(i) for i in range(batch)):
+            raise GenerationCancelled(f"cancelled at step {step + 1}/{self.total_steps}")
+
+        due: List[int] = [i for i in range(batch)
+                          if self._every(i) and (step + 1) % self._every(i) == 0 and step + 1 < self.total_steps
+                          and not (self.cancelled is not None and self.cancelled(i))]
+        if due:
+            images = latents_to_rgb(latents[due], max_size=self.max_size)
+            for i, img in zip(due, images):
+                self.on_preview(i, step + 1, self.total_steps, img)
+        return callback_kwargs
+
@@ -10,6 +10,7 @@ supports --trust-remote-code (default True), device selection, and timestamped o
 Usage examples:
   python local_flux_text2img.py "A portrait of a woman" --model "G:/AIModels/.../FLUX___1-dev"
   python local_flux_text2img.py --trust-remote-code
+  python local_flux_text2img.py "A castle" --staged   # text encoders -> transformer -> VAE, one at a time
 
 Note: this model may require a development version of diffusers. If loading fails,
 the script will print guidance about installing diffusers from GitHub.
@@ -35,6 +36,12 @@ except (ImportError, ModuleNotFoundError) as e:
     )
     raise SystemExit(msg)
 
+from cpu_profile import SETTINGS as CPU_PROFILE, apply_cpu_profile, inference_context, parse_cores, set_cpu_profile
+from flux_staged import generate_staged
+from pipeline_registry import REGISTRY, estimate_load_bytes, make_key
+from pipeline_snapshot import is_snapshot, load_snapshot
+from quantize import MODES as QUANT_MODES, SETTINGS as QUANT, cached_components, quantize_pipeline, set_quantization
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Local Flux text-to-image loader")
@@ -42,7 +49,7 @@ def parse_args():
         "漂亮的女性肖像，清晰细腻的面部特征，温柔微笑，淡雅妆容，柔和光线，浅景深，4k 超高清，写实风格"
     ), type=str, help="Text prompt to generate image from (optional)")
     parser.add_argument("--model", type=str, default=r"G:/AIModels/modelscope_cache/models/black-forest-labs/FLUX___1-dev",
-                        help="Model id or path (local folder or HF repo id).")
+                        help="Model id or path (local folder, HF repo id, or a pipeline_snapshot.py .safetensors bundle).")
     parser.add_argument("--out", type=str, default="", help="Output image path (optional). If omitted a timestamped filename will be used.")
     parser.add_argument("--height", type=int, default=512, help="Image height")
     parser.add_argument("--width", type=int, default=512, help="Image width")
@@ -55,6 +62,17 @@ def parse_args():
     parser.add_argument("--no-trust-remote-code", dest="trust_remote_code", action="store_false",
                         help="Do not allow executing remote model code.")
     parser.set_defaults(trust_remote_code=True)
+    parser.add_argument("--cpu-profile", choices=["default", "fast"], default="default",
+                        help="CPU inference profile: 'fast' = bf16 autocast, channels_last, torch.compile, thread pinning")
+    parser.add_argument("--cpu-threads", type=int, default=None, help="Intra-op threads for --cpu-profile fast (default: all available cores)")
+    parser.add_argument("--cpu-interop-threads", type=int, default=None, help="Inter-op threads for --cpu-profile fast (default: 1)")
+    parser.add_argument("--cpu-cores", type=str, default="", help="Pin to these cores for --cpu-profile fast, e.g. '0-7'")
+    parser.add_argument("--ram-budget-gb", type=float, default=None, help="RAM budget for cached pipelines (LRU eviction), default $T2I_RAM_BUDGET_GB")
+    parser.add_argument("--vram-budget-gb", type=float, default=None, help="VRAM budget for cached pipelines (LRU eviction), default $T2I_VRAM_BUDGET_GB")
+    parser.add_argument("--quantize", choices=QUANT_MODES, default="none",
+                        help="Quantize transformer/text encoders: dynamic-int8 (CPU), int8-weight / int4-weight (torchao); cached on disk after the first load")
+    parser.add_argument("--staged", action="store_true",
+                        help="Load/run/free the text encoders, transformer and VAE one stage at a time and report peak memory per stage")
     return parser.parse_args()
 
 
@@ -67,6 +85,15 @@ def choose_device(requested: Optional[str]) -> torch.device:
 
 
 def load_flux_pipeline(model_id: str, device: torch.device, trust_remote_code: bool):
+    if is_snapshot(model_id):
+        # Pre-built snapshot bundle (see pipeline_snapshot.py): weights are memory-mapped
+        pipe = quantize_pipeline(load_snapshot(model_id, device), None, device)
+        try:
+            pipe.enable_attention_slicing()
+        except Exception:
+            pass
+        return pipe
+
     local_only = os.path.isdir(model_id)
     # prefer dtype kwarg
     dtype = torch.float16 if device.type == "cuda" else torch.float32
@@ -93,9 +120,11 @@ def load_flux_pipeline(model_id: str, device: torch.device, trust_remote_code: b
     except Exception:
         pass
 
+    # Quantized transformer / text encoders cached by an earlier --quantize run skip their float weights
+    cached = cached_components(model_id, device, dtype)
     try:
         print("Loading pipeline components...", flush=True)
-        pipe = DiffusionPipeline.from_pretrained(model_id, **load_kwargs)
+        pipe = DiffusionPipeline.from_pretrained(model_id, **load_kwargs, **cached)
     except Exception as e:
         # Provide actionable guidance
         msg = (
@@ -109,6 +138,9 @@ def load_flux_pipeline(model_id: str, device: torch.device, trust_remote_code: b
         )
         raise RuntimeError(msg)
 
+    pipe._quantized_components = tuple(cached)
+    pipe = quantize_pipeline(pipe, model_id, device)
+
     # Move to device
     pipe = pipe.to(device)
 
@@ -121,16 +153,26 @@ def load_flux_pipeline(model_id: str, device: torch.device, trust_remote_code: b
     return pipe
 
 
+def get_flux_pipeline(model_id: str, device: torch.device, trust_remote_code: bool):
+    """Return a shared pipeline from the process-wide registry, loading it on first use."""
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    key = make_key(model_id, dtype, device, pipeline="flux", trust_remote_code=trust_remote_code,
+                   cpu_profile=CPU_PROFILE.name if device.type == "cpu" else "default", quantize=QUANT.mode)
+    return REGISTRY.get(key, lambda: apply_cpu_profile(load_flux_pipeline(model_id, device, trust_remote_code), device),
+                        estimated_bytes=estimate_load_bytes(model_id, dtype), on_cuda=device.type == "cuda")
+
+
 def generate(prompt: str, out_path: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], trust_remote_code: bool):
-    pipe = load_flux_pipeline(model, device, trust_remote_code)
+    pipe = get_flux_pipeline(model, device, trust_remote_code)
 
     generator = None
     if seed is not None:
         generator = torch.Generator(device=device).manual_seed(seed)
 
     # Call pipeline
-    result = pipe(prompt=prompt, height=height, width=width, num_inference_steps=steps,
-                  guidance_scale=scale, generator=generator)
+    with inference_context(pipe):
+        result = pipe(prompt=prompt, height=height, width=width, num_inference_steps=steps,
+                      guidance_scale=scale, generator=generator)
 
     # save first image
     image = result.images[0]
@@ -141,6 +183,9 @@ def generate(prompt: str, out_path: str, model: str, height: int, width: int, st
 
 def main():
     args = parse_args()
+    REGISTRY.set_budget(args.ram_budget_gb, args.vram_budget_gb)
+    set_cpu_profile(args.cpu_profile, args.cpu_threads, args.cpu_interop_threads, parse_cores(args.cpu_cores))
+    set_quantization(args.quantize)
     device = choose_device(args.device)
     print(f"Using device: {device}")
 
@@ -150,18 +195,34 @@ def main():
     else:
         out_path = args.out
 
-    out = generate(
-        prompt=args.prompt,
-        out_path=out_path,
-        model=args.model,
-        height=args.height,
-        width=args.width,
-        steps=args.steps,
-        scale=args.scale,
-        device=device,
-        seed=args.seed,
-        trust_remote_code=args.trust_remote_code,
-    )
+    if args.staged and is_snapshot(args.model):
+        print("--staged needs a diffusers model folder; snapshot bundles are already memory-mapped, running normally.")
+    if args.staged and not is_snapshot(args.model):
+        out, _ = generate_staged(
+            prompt=args.prompt,
+            out_path=out_path,
+            model=args.model,
+            height=args.height,
+            width=args.width,
+            steps=args.steps,
+            scale=args.scale,
+            device=device,
+            seed=args.seed,
+            trust_remote_code=args.trust_remote_code,
+        )
+    else:
+        out = generate(
+            prompt=args.prompt,
+            out_path=out_path,
+            model=args.model,
+            height=args.height,
+            width=args.width,
+            steps=args.steps,
+            scale=args.scale,
+            device=device,
+            seed=args.seed,
+            trust_remote_code=args.trust_remote_code,
+        )
 
     print(f"Saved image to: {out}")
 
@@ -4,12 +4,21 @@ local_sd_v1_5_text2img.py
 
 Load and run a local Stable Diffusion v1.5 model saved in diffusers format.
 Supports low-vram helpers and timestamped output filenames.
+
+Batch mode: --prompts-file prompts.jsonl reads one JSON record per line, e.g.
+  {"prompt": "a castle at dawn", "seed": 1, "steps": 25, "scheduler": "euler", "out": "castle.png"}
+Missing fields fall back to the CLI values; records sharing size/steps/scale/scheduler
+are generated together in batches of --batch-size.
 """
 import argparse
+import contextlib
+import json
 import os
+import re
 import sys
+import time
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 import torch
 
@@ -19,6 +28,20 @@ except (ImportError, ModuleNotFoundError) as e:
     install_cmd = f"{sys.executable} -m pip install -r requirements.txt"
     raise SystemExit(f"Missing diffusers. Run: {install_cmd}\nOriginal error: {e}")
 
+from cfg_cutoff import SETTINGS as CFG_CUTOFF, make_cfg_cutoff, set_cfg_cutoff
+from cpu_profile import SETTINGS as CPU_PROFILE, apply_cpu_profile, inference_context, parse_cores, set_cpu_profile
+from deferred_safety import DeferredSafetyChecker, save_checked
+from embedding_cache import EMBED_CACHE
+from fast_cache import SETTINGS as FAST_CACHE, apply_fast_cache, set_fast_cache
+from image_writer import configure_writer, get_writer, resolve_format
+from memory_planner import PLANNER
+from pipeline_registry import REGISTRY, estimate_load_bytes, make_key
+from pipeline_snapshot import is_snapshot, load_snapshot, read_snapshot_metadata
+from quantize import MODES as QUANT_MODES, SETTINGS as QUANT, applied_mode, cached_components, quantize_pipeline, set_quantization
+from result_cache import RESULT_CACHE, model_identity, result_key
+from scheduler_compare import compare_schedulers, make_scheduler
+from token_merging import SETTINGS as TOME, apply_token_merging, set_token_merging
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Local Stable Diffusion v1.5 text2img")
@@ -27,20 +50,65 @@ def parse_args():
     ), type=str)
     parser.add_argument("--model", type=str, default=r"G:/AIModels/modelscope_cache/models/AI-ModelScope/stable-diffusion-v1-5",
     # parser.add_argument("--model", type=str, default=r"G:\AIModels\modelscope_cache\models\AI-ModelScope\stable-diffusion-v2-1",
-                        help="Local diffusers model directory")
+                        help="Local diffusers model directory (or a pipeline_snapshot.py .safetensors bundle)")
     parser.add_argument("--out", type=str, default="", help="Output image path")
+    parser.add_argument("--negative-prompt", type=str, default=None, help="Negative prompt (optional)")
     parser.add_argument("--height", type=int, default=512)
     parser.add_argument("--width", type=int, default=512)
     parser.add_argument("--steps", type=int, default=30)
     parser.add_argument("--scale", type=float, default=7.5)
     parser.add_argument("--device", type=str, default=None)
     parser.add_argument("--seed", type=int, default=None)
-    parser.add_argument("--lowvram", action="store_true", help="Enable low VRAM helpers (attention slicing, cpu offload if available)")
+    parser.add_argument("--lowvram", action="store_true", help="Force all low VRAM helpers (attention slicing, cpu offload if available) instead of the memory planner")
     parser.add_argument("--trust-remote-code", action="store_true", help="Allow executing custom pipeline code if present")
     parser.add_argument("--disable_safety", action="store_true", help="Disable NSFW safety checker")
     parser.add_argument("--interactive", action="store_true", help="Keep the model loaded and accept multiple prompts in a REPL loop")
     parser.add_argument("--dbg-info", action="store_true", help="Print debug information about the loaded pipeline and model directory")
     parser.add_argument("--compare-schedulers", action="store_true", help="Generate and save outputs using multiple schedulers for comparison")
+    parser.add_argument("--ram-budget-gb", type=float, default=None, help="RAM budget for cached pipelines (LRU eviction), default $T2I_RAM_BUDGET_GB")
+    parser.add_argument("--vram-budget-gb", type=float, default=None, help="VRAM budget for cached pipelines (LRU eviction), default $T2I_VRAM_BUDGET_GB")
+    parser.add_argument("--cpu-profile", choices=["default", "fast"], default="default",
+                        help="CPU inference profile: 'fast' = bf16 autocast, channels_last, torch.compile, thread pinning")
+    parser.add_argument("--cpu-threads", type=int, default=None, help="Intra-op threads for --cpu-profile fast (default: all available cores)")
+    parser.add_argument("--cpu-interop-threads", type=int, default=None, help="Inter-op threads for --cpu-profile fast (default: 1)")
+    parser.add_argument("--cpu-cores", type=str, default="", help="Pin to these cores for --cpu-profile fast, e.g. '0-7'")
+    parser.add_argument("--quantize", choices=QUANT_MODES, default="none",
+                        help="Quantize UNet/text encoder: dynamic-int8 (CPU), int8-weight / int4-weight (torchao); cached on disk after the first load")
+    parser.add_argument("--fast-cache", action="store_true",
+                        help="DeepCache-style UNet feature reuse: run the deep blocks only every --fast-cache-interval steps (faster, slightly different image)")
+    parser.add_argument("--fast-cache-interval", type=int, default=3, help="--fast-cache: full UNet pass every N steps, cached deep features in between")
+    parser.add_argument("--cfg-cutoff", type=float, default=None,
+                        help="Drop the unconditional (CFG) branch after this fraction of steps, e.g. 0.6; later steps run at half the UNet batch")
+    parser.add_argument("--cfg-cutoff-threshold", type=float, default=None,
+                        help="Also drop it once the relative guidance delta |cond - uncond| / |cond| falls below this value, e.g. 0.05")
+    parser.add_argument("--tome-ratio", type=float, default=0.0,
+                        help="Token merging: fraction (0-0.75) of high-resolution tokens merged before self-attention; speeds up large sizes, slightly changes the image")
+    parser.add_argument("--embed-cache-size", type=int, default=64, help="Max cached text-encoder embeddings (0 disables the cache)")
+    parser.add_argument("--compare-mode", choices=["auto", "batched", "sequential"], default="auto",
+                        help="--compare-schedulers: run all schedulers as one latent batch, one by one, or pick by free memory")
+    parser.add_argument("--prompts-file", type=str, default="", help="JSONL file of prompt records to generate in bucketed batches")
+    parser.add_argument("--batch-size", type=int, default=4, help="Max prompts (or sweep seeds) per pipeline call in --prompts-file / seed sweep mode")
+    parser.add_argument("--out-dir", type=str, default="", help="Output directory for --prompts-file mode (default: timestamped folder)")
+    parser.add_argument("--seeds", type=parse_seeds, default=[], help="Seed sweep: comma list / ranges, e.g. '1,2,3' or '100-115'; batched --batch-size seeds per pass, plus a contact sheet")
+    parser.add_argument("--num-variations", type=int, default=0, help="Seed sweep of N consecutive seeds starting at --seed (random base if unset)")
+    parser.add_argument("--memory-plan", choices=["auto", "off"], default="auto",
+                        help="auto: pick VAE slicing/tiling, attention slicing or CPU offload per call from free memory, resolution and batch size")
+    parser.add_argument("--memory-margin", type=float, default=0.85, help="Fraction of free memory the memory planner may plan to use")
+    parser.add_argument("--result-cache-gb", type=float, default=2.0, help="Size cap of the on-disk cache of seeded results (0 disables it)")
+    parser.add_argument("--result-cache-ttl-hours", type=float, default=0.0, help="Expire cached results after this many hours (0 = never)")
+    parser.add_argument("--result-cache-dir", type=str, default="", help="Result cache directory (default: ~/.cache/t2i_results)")
+    parser.add_argument("--writer-workers", type=int, default=2, help="Background image encoder threads (0 = save synchronously)")
+    parser.add_argument("--writer-queue", type=int, default=8, help="Max images waiting to be written before generation blocks")
+    parser.add_argument("--image-format", choices=["png", "webp", "jpeg"], default=None, help="Output format (default: from the output file extension)")
+    parser.add_argument("--png-compress", type=int, default=6, choices=range(10), metavar="0-9", help="PNG zlib compression level (lower is faster, larger files)")
+    parser.add_argument("--quality", type=int, default=90, help="WebP/JPEG quality")
+    parser.add_argument("--dump-raw", action="store_true", help="Also write the raw uint8 RGB array as .npy next to each image")
+    parser.add_argument("--deferred-safety", action="store_true",
+                        help="Run the safety checker in a background worker (batched); verdicts go to safety.jsonl and flagged images are quarantined")
+    parser.add_argument("--safety-batch", type=int, default=8, help="Max images per deferred safety-checker batch")
+    parser.add_argument("--safety-wait-ms", type=float, default=500, help="Max time the deferred checker waits to fill a batch")
+    parser.add_argument("--safety-device", type=str, default=None, help="Device for the deferred safety checker (default: same as the pipeline)")
+    parser.add_argument("--quarantine-dir", type=str, default="", help="Where flagged images are moved (default: quarantine/ next to the image)")
     return parser.parse_args()
 
 
@@ -80,20 +148,30 @@ def choose_device(requested: Optional[str]) -> torch.device:
 
 
 def load_pipeline(model_dir: str, device: torch.device, trust_remote_code: bool, lowvram: bool):
-    local_only = os.path.isdir(model_dir)
-    torch_dtype = torch.float16 if device.type == "cuda" else torch.float32
-
-    load_kwargs = {
-        "dtype": torch_dtype,
-        "local_files_only": local_only,
-    }
-    if trust_remote_code:
-        load_kwargs["trust_remote_code"] = True
-
-    pipe = StableDiffusionPipeline.from_pretrained(model_dir, **load_kwargs)
-    pipe = pipe.to(device)
+    if is_snapshot(model_dir):
+        # Pre-built snapshot bundle (see pipeline_snapshot.py): weights are memory-mapped
+        pipe = quantize_pipeline(load_snapshot(model_dir, device), None, device)
+    else:
+        local_only = os.path.isdir(model_dir)
+        torch_dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+        load_kwargs = {
+            "dtype": torch_dtype,
+            "local_files_only": local_only,
+        }
+        if trust_remote_code:
+            load_kwargs["trust_remote_code"] = True
+
+        # Quantized components cached by an earlier --quantize run replace their float weights
+        cached = cached_components(model_dir, device, torch_dtype)
+        pipe = StableDiffusionPipeline.from_pretrained(model_dir, **load_kwargs, **cached)
+        pipe._quantized_components = tuple(cached)
+        pipe = quantize_pipeline(pipe, model_dir, device)
+        pipe = pipe.to(device)
 
     if lowvram:
+        # Explicit --lowvram: every helper on, the memory planner leaves this pipeline alone
+        pipe._memory_plan_fixed = True
         try:
             pipe.enable_attention_slicing()
         except Exception:
@@ -106,45 +184,51 @@ def load_pipeline(model_dir: str, device: torch.device, trust_remote_code: bool,
     return pipe
 
 
-def generate(prompt: str, out_path: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], lowvram: bool, trust_remote_code: bool, disable_safety: bool = False, pipe=None):
-    # If a preloaded pipeline is provided, reuse it to avoid re-loading weights each call
-    if pipe is None:
-        pipe = load_pipeline(model, device, trust_remote_code, lowvram)
+def registry_key(model_dir: str, device: torch.device, trust_remote_code: bool, lowvram: bool) -> tuple:
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    return make_key(model_dir, dtype, device, pipeline="sd", lowvram=lowvram, trust_remote_code=trust_remote_code,
+                    cpu_profile=CPU_PROFILE.name if device.type == "cpu" else "default", quantize=QUANT.mode)
 
-    # Optionally disable safety checker (ONLY use if you trust the model and prompts)
-    if disable_safety:
+
+def get_pipeline(model_dir: str, device: torch.device, trust_remote_code: bool, lowvram: bool):
+    """Return a shared pipeline from the process-wide registry, loading it on first use."""
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    key = registry_key(model_dir, device, trust_remote_code, lowvram)
+    return REGISTRY.get(key, lambda: apply_cpu_profile(load_pipeline(model_dir, device, trust_remote_code, lowvram), device),
+                        estimated_bytes=estimate_load_bytes(model_dir, dtype), on_cuda=device.type == "cuda" and not lowvram)
+
+
+def tokenizer_max_length(tokenizer) -> int:
+    """Return the tokenizer's usable max length, clamping absurd reported values to 77."""
+    # Defensive: some tokenizers report an extremely large model_max_length
+    # which will cause tokenizer.pad() to try to extend lists by a huge amount
+    # and raise OverflowError. Detect absurd values and clamp to a sensible default.
+    reported_max = getattr(tokenizer, "model_max_length", None)
+    if reported_max is None:
+        max_len = 77
+    else:
         try:
-            def _dummy_safety(images, **kwargs):
-                return images, [False] * len(images)
-            pipe.safety_checker = _dummy_safety
-            print("Safety checker disabled (--disable_safety enabled).")
+            max_len = int(reported_max)
+        except Exception:
+            max_len = 77
+
+    # If tokenizer reports an absurdly large or non-positive max, clamp to 77 (CLIP default)
+    if max_len <= 0 or max_len > 4096:
+        print(f"Warning: tokenizer.model_max_length={reported_max} looks invalid; using 77 instead to avoid padding overflow.")
+        max_len = 77
+        try:
+            tokenizer.model_max_length = max_len
         except Exception:
             pass
+    return max_len
+
 
-    # Truncate the prompt if tokenizer reports it is longer than allowed
+def truncate_prompt(pipe, prompt: str) -> str:
+    """Truncate the prompt if the pipeline tokenizer reports it is longer than allowed."""
     try:
         tokenizer = getattr(pipe, "tokenizer", None)
         if tokenizer is not None:
-            # Defensive: some tokenizers report an extremely large model_max_length
-            # which will cause tokenizer.pad() to try to extend lists by a huge amount
-            # and raise OverflowError. Detect absurd values and clamp to a sensible default.
-            reported_max = getattr(tokenizer, "model_max_length", None)
-            if reported_max is None:
-                max_len = 77
-            else:
-                try:
-                    max_len = int(reported_max)
-                except Exception:
-                    max_len = 77
-
-            # If tokenizer reports an absurdly large or non-positive max, clamp to 77 (CLIP default)
-            if max_len <= 0 or max_len > 4096:
-                print(f"Warning: tokenizer.model_max_length={reported_max} looks invalid; using 77 instead to avoid padding overflow.")
-                max_len = 77
-                try:
-                    tokenizer.model_max_length = max_len
-                except Exception:
-                    pass
+            max_len = tokenizer_max_length(tokenizer)
 
             # encode using the tokenizer to get token length (no padding)
             encoded = tokenizer(prompt, add_special_tokens=True, return_tensors="pt")
@@ -157,91 +241,470 @@ def generate(prompt: str, out_path: str, model: str, height: int, width: int, st
     except Exception as e:
         # tokenization/truncation failed; continue with original prompt
         print(f"Warning: could not check/truncate prompt: {e}")
+    return prompt
 
-    gen = None
-    if seed is not None:
-        gen = torch.Generator(device=device).manual_seed(seed)
 
-    res = pipe(prompt=prompt, height=height, width=width, num_inference_steps=steps, guidance_scale=scale, generator=gen)
-    img = res.images[0]
-    os.makedirs(os.path.dirname(os.path.abspath(out_path)) or ".", exist_ok=True)
-    img.save(out_path)
-    return out_path
+def scheduler_name(pipe, model_dir: str) -> str:
+    """Class name of the scheduler the call will use.
 
+    Always the class that is (or will be) instantiated: the loaded pipeline's, else
+    the class recorded in a snapshot, else the one model_index.json tells
+    from_pretrained to build.
+    """
+    if pipe is not None:
+        return type(pipe.scheduler).__name__
+    try:
+        if is_snapshot(model_dir):
+            return read_snapshot_metadata(model_dir)["components"]["scheduler"]["class"]
+        with open(os.path.join(model_dir, "model_index.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["scheduler"][1]
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        pass
+    try:
+        with open(os.path.join(model_dir, "scheduler", "scheduler_config.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["_class_name"]
+    except (OSError, ValueError, KeyError):
+        return "default"
 
-def generate_with_schedulers(prompt: str, out_path_base: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], lowvram: bool, trust_remote_code: bool, disable_safety: bool = False, pipe=None):
-    """Generate images using multiple schedulers and save with suffixes for comparison."""
-    from diffusers import DPMSolverMultistepScheduler, EulerAncestralDiscreteScheduler
 
-    if pipe is None:
-        pipe = load_pipeline(model, device, trust_remote_code, lowvram)
+# Memory helpers that change output pixels (offload and batch-of-one VAE slicing do not)
+PIXEL_HELPERS = ("vae_tiling", "attention_slicing")
 
-    # Optionally disable safety checker
+
+def memory_plan_key(pipe, device: torch.device, height: int, width: int, scale: float, lowvram: bool, pending_bytes: int = 0) -> List[str]:
+    """Pixel-affecting memory helpers a single-image call will run with.
+
+    With pipe=None, pending_bytes are the weights still to be loaded; the planner then
+    sees the free memory the loaded pipeline will see.
+    """
+    if lowvram or (pipe is not None and getattr(pipe, "_memory_plan_fixed", False)):
+        helpers = ("attention_slicing",)
+    elif PLANNER.enabled:
+        helpers, _, _ = PLANNER.choose(pipe, device, height, width, 1, scale > 1.0, pending_bytes)
+    else:
+        helpers = ()
+    return [h for h in PIXEL_HELPERS if h in helpers]
+
+
+def generation_key(prompt: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: int, disable_safety: bool, pipe=None, negative_prompt: Optional[str] = None, memory_plan: Optional[List[str]] = None) -> str:
+    """Content address of a seeded generation (see result_cache.py).
+
+    memory_plan defaults to the plan the memory planner would pick right now; pass
+    the helpers a finished call actually used when storing its result.
+    """
+    writer = get_writer()
+    if memory_plan is None:
+        memory_plan = memory_plan_key(pipe, device, height, width, scale, lowvram=False)
+    return result_key(
+        model=model_identity(model), scheduler=scheduler_name(pipe, model), prompt=prompt, negative_prompt=negative_prompt,
+        height=height, width=width, steps=steps, scale=scale, seed=seed, device=device.type,
+        dtype="float16" if device.type == "cuda" else "float32",
+        cpu_profile=CPU_PROFILE.name if device.type == "cpu" else "default", quantize=applied_mode(pipe), safety=not disable_safety,
+        fast_cache=FAST_CACHE.interval, tome_ratio=TOME.ratio, cfg_cutoff=[CFG_CUTOFF.fraction, CFG_CUTOFF.threshold],
+        memory_plan=memory_plan, encoding=[writer.fmt, writer.png_compress_level, writer.quality],
+    )
+
+
+def configure_safety(pipe, disable_safety: bool):
+    """Switch the inline safety checker off for this call, or back on after an earlier call disabled it."""
+    # Optionally disable safety checker (ONLY use if you trust the model and prompts)
     if disable_safety:
         try:
             def _dummy_safety(images, **kwargs):
                 return images, [False] * len(images)
+            if getattr(pipe, "_original_safety_checker", None) is None:
+                pipe._original_safety_checker = pipe.safety_checker
             pipe.safety_checker = _dummy_safety
+            print("Safety checker disabled (--disable_safety enabled).")
         except Exception:
             pass
+    elif getattr(pipe, "_original_safety_checker", None) is not None and getattr(pipe, "_deferred_safety", None) is None:
+        # Registry pipelines are shared between calls, so undo an earlier --disable_safety
+        pipe.safety_checker = pipe._original_safety_checker
+
+
+def generate(prompt: str, out_path: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], lowvram: bool, trust_remote_code: bool, disable_safety: bool = False, pipe=None, negative_prompt: Optional[str] = None):
+    # Seeded runs are deterministic: serve repeats from the result cache before loading anything
+    cached = seed is not None and RESULT_CACHE.enabled
+    if cached:
+        # Plan like the loaded pipeline will: the registry's resident copy if there is one, else with
+        # its weights taken off the free memory, so the lookup and the stored key pick the same plan
+        planned = pipe if pipe is not None else REGISTRY.peek(registry_key(model, device, trust_remote_code, lowvram))
+        pending = 0 if planned is not None else estimate_load_bytes(model, torch.float16 if device.type == "cuda" else torch.float32)
+        cache_key = generation_key(prompt, model, height, width, steps, scale, device, seed, disable_safety, planned, negative_prompt,
+                                   memory_plan_key(planned, device, height, width, scale, lowvram, pending))
+        hit = RESULT_CACHE.fetch(cache_key, get_writer().output_path(out_path))
+        if hit is not None:
+            print(f"Result cache hit ({cache_key[:12]})")
+            return hit
 
-    # Keep the original scheduler config
-    base_config = pipe.scheduler.config
+    # If a preloaded pipeline is provided, reuse it to avoid re-loading weights each call
+    if pipe is None:
+        pipe = get_pipeline(model, device, trust_remote_code, lowvram)
+
+    configure_safety(pipe, disable_safety)
+
+    img = generate_images(pipe, [prompt], height, width, steps, scale, device, seeds=[seed], negative_prompt=negative_prompt)[0]
+    # Encoding/disk I/O runs on the writer pool (synchronous unless --writer-workers > 0)
+    store = None
+    if cached:
+        # Store only under the plan this call really ran with, so pixels of one plan are never served for another
+        used = getattr(pipe, "_memory_helpers", ("attention_slicing",) if getattr(pipe, "_memory_plan_fixed", False) else ())
+        cache_key = generation_key(prompt, model, height, width, steps, scale, device, seed, disable_safety, pipe, negative_prompt,
+                                   [h for h in PIXEL_HELPERS if h in used])
+        meta = {"prompt": prompt, "seed": seed, "height": height, "width": width, "steps": steps, "scale": scale, "model": model}
+        store = lambda path: RESULT_CACHE.put(cache_key, path, meta)
+    return save_checked(pipe, img, out_path, on_written=store)
+
+
+def make_generators(device: torch.device, seeds: List[Optional[int]]):
+    """Build one torch.Generator per batch item, or None when no item asks for a seed."""
+    if all(seed is None for seed in seeds):
+        return None
+    gens = []
+    for seed in seeds:
+        gen = torch.Generator(device=device)
+        if seed is None:
+            gen.seed()
+        else:
+            gen.manual_seed(seed)
+        gens.append(gen)
+    return gens
+
+
+def embedding_model_key(pipe, device: torch.device) -> str:
+    """Embeddings are only interchangeable for the same weights, device, dtype and quantization."""
+    name = getattr(pipe, "name_or_path", None)
+    model = model_identity(name) if name else f"{type(pipe).__name__}@{id(pipe):x}"
+    text_encoder = getattr(pipe, "text_encoder", None)
+    dtype = getattr(text_encoder, "dtype", None)
+    return f"{model}|{device.type}|{dtype}|{applied_mode(pipe)}"
+
+
+def encode_prompts(pipe, prompts: List[str], negative_prompt: Optional[str], scale: float, device: torch.device):
+    """Return (prompt_embeds, negative_prompt_embeds) for a batch, going through EMBED_CACHE.
+
+    Prompts are truncated only on a cache miss, so repeated prompts skip both the
+    tokenizer and the CLIP text encoder. Duplicates within the batch (e.g. a seed
+    sweep) are looked up once.
+    """
+    do_cfg = scale > 1.0
+    max_len = tokenizer_max_length(pipe.tokenizer)
+    encoded = {}
+    for prompt in dict.fromkeys(prompts):
+        encoded[prompt] = EMBED_CACHE.get_or_encode(
+            pipe, embedding_model_key(pipe, device), prompt, negative_prompt, max_len, device, do_cfg,
+            prepare=lambda text: truncate_prompt(pipe, text),
+        )
+    pos = [encoded[prompt][0] for prompt in prompts]
+    neg = [encoded[prompt][1] for prompt in prompts]
+    prompt_embeds = torch.cat(pos, dim=0)
+    negative_embeds = torch.cat(neg, dim=0) if do_cfg else None
+    return prompt_embeds, negative_embeds
+
+
+def generate_images(pipe, prompts: List[str], height: int, width: int, steps: int, scale: float, device: torch.device, seeds: Optional[List[Optional[int]]] = None, negative_prompt: Optional[str] = None, **pipe_kwargs):
+    """Run a single batched pipeline call for a list of prompts.
+
+    All prompts share height/width/steps/scale; each item gets its own generator so
+    seeded items reproduce the same image they would get from a batch of one.
+    """
+    if seeds is None:
+        seeds = [None] * len(prompts)
+    gen = make_generators(device, seeds)
+    if gen is not None and len(gen) == 1:
+        gen = gen[0]
+
+    apply_fast_cache(pipe)
+    apply_token_merging(pipe)
+    plan_ctx = contextlib.nullcontext()
+    if PLANNER.enabled and not getattr(pipe, "_memory_plan_fixed", False):
+        PLANNER.plan(pipe, device, height, width, len(prompts), scale > 1.0)
+        plan_ctx = PLANNER.track(pipe, device)
+
+    cutoff = make_cfg_cutoff(pipe, steps, scale, pipe_kwargs)
+    try:
+        if EMBED_CACHE.enabled and getattr(pipe, "tokenizer", None) is not None:
+            try:
+                prompt_embeds, negative_embeds = encode_prompts(pipe, prompts, negative_prompt, scale, device)
+            except Exception as e:
+                print(f"Warning: embedding cache unavailable, falling back to prompt strings: {e}")
+            else:
+                with plan_ctx, inference_context(pipe):
+                    res = pipe(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds, height=height, width=width,
+                               num_inference_steps=steps, guidance_scale=scale, generator=gen, **pipe_kwargs)
+                return res.images
+
+        prompts = [truncate_prompt(pipe, p) for p in prompts]
+        negative = [negative_prompt] * len(prompts) if negative_prompt else None
+        with plan_ctx, inference_context(pipe):
+            res = pipe(prompt=prompts, negative_prompt=negative, height=height, width=width, num_inference_steps=steps,
+                       guidance_scale=scale, generator=gen, **pipe_kwargs)
+        return res.images
+    finally:
+        if cutoff is not None:
+            cutoff.close()
+            print(cutoff.report(len(prompts)))
+
+
+def generate_with_schedulers(prompt: str, out_path_base: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], lowvram: bool, trust_remote_code: bool, disable_safety: bool = False, pipe=None, negative_prompt: Optional[str] = None, compare_mode: str = "auto"):
+    """Generate images using multiple schedulers and save with suffixes for comparison.
+
+    The prompt is encoded once and every scheduler starts from the same initial latents;
+    compare_mode picks batched (one latent batch for all schedulers), sequential or auto.
+    A wall time / steps-per-second / peak memory table is printed.
+    """
+    if pipe is None:
+        pipe = get_pipeline(model, device, trust_remote_code, lowvram)
 
-    outputs = []
+    configure_safety(pipe, disable_safety)
 
-    # DPMSolver
-    try:
-        pipe.scheduler = DPMSolverMultistepScheduler.from_config(base_config)
-        out_path = f"{out_path_base}_dpmsolver.png"
-        outputs.append(generate(prompt, out_path, model, height, width, steps, scale, device, seed, lowvram, trust_remote_code, disable_safety, pipe=pipe))
-    except Exception as e:
-        print("DPMSolver generation failed:", e)
+    prompt_embeds, negative_embeds = encode_prompts(pipe, [prompt], negative_prompt, scale, device)
+    with inference_context(pipe):
+        outputs, _ = compare_schedulers(pipe, prompt_embeds, negative_embeds, out_path_base, height, width, steps, scale,
+                                        device, seed, mode=compare_mode)
+    return outputs
 
-    # Euler Ancestral
-    try:
-        pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(base_config)
-        out_path = f"{out_path_base}_euler.png"
-        outputs.append(generate(prompt, out_path, model, height, width, steps, scale, device, seed, lowvram, trust_remote_code, disable_safety, pipe=pipe))
-    except Exception as e:
-        print("Euler generation failed:", e)
 
-    # DDIM (original)
-    try:
-        from diffusers import DDIMScheduler
-        pipe.scheduler = DDIMScheduler.from_config(base_config)
-        out_path = f"{out_path_base}_ddim.png"
-        outputs.append(generate(prompt, out_path, model, height, width, steps, scale, device, seed, lowvram, trust_remote_code, disable_safety, pipe=pipe))
-    except Exception as e:
-        print("DDIM generation failed:", e)
+SEED_RANGE = re.compile(r"^(-?\d+)-(-?\d+)$")
+
 
+def parse_seeds(spec: str) -> List[int]:
+    """Parse a seed list like '1,2,3', '100-115' or '-5--1' (ranges inclusive); argparse type for --seeds."""
+    seeds = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = SEED_RANGE.match(part)
+        try:
+            if match:
+                lo, hi = int(match.group(1)), int(match.group(2))
+                if lo > hi:
+                    raise argparse.ArgumentTypeError(f"reversed seed range '{part}' (use {hi}-{lo})")
+                seeds.extend(range(lo, hi + 1))
+            else:
+                seeds.append(int(part))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid seed '{part}', expected an integer or a range like 100-115")
+    if not seeds:
+        raise argparse.ArgumentTypeError(f"no seeds in '{spec}'")
+    return seeds
+
+
+def sweep_seeds(seeds: List[int], num_variations: int, base_seed: Optional[int]) -> List[int]:
+    """Seeds for a sweep: the explicit --seeds list, else N consecutive seeds from --seed (or a random base)."""
+    if seeds:
+        return list(seeds)
+    if num_variations > 0:
+        if base_seed is None:
+            base_seed = int(torch.randint(0, 2 ** 31 - 1 - num_variations, (1,)).item())
+        return list(range(base_seed, base_seed + num_variations))
+    return []
+
+
+def make_contact_sheet(images, labels: List[str], columns: Optional[int] = None, thumb: int = 256):
+    """Tile images (scaled to thumb px on the long side) into a labelled grid."""
+    from PIL import Image, ImageDraw
+
+    columns = columns or max(1, int(len(images) ** 0.5 + 0.999))
+    rows = (len(images) + columns - 1) // columns
+    scale = thumb / max(images[0].size)
+    tw, th = max(1, round(images[0].width * scale)), max(1, round(images[0].height * scale))
+    label_h = 16
+    sheet = Image.new("RGB", (columns * tw, rows * (th + label_h)), "white")
+    draw = ImageDraw.Draw(sheet)
+    for i, (img, label) in enumerate(zip(images, labels)):
+        x, y = (i % columns) * tw, (i // columns) * (th + label_h)
+        sheet.paste(img.convert("RGB").resize((tw, th)), (x, y))
+        draw.text((x + 4, y + th + 2), label, fill="black")
+    return sheet
+
+
+def generate_seed_sweep(prompt: str, seeds: List[int], out_path_base: str, pipe, height: int, width: int, steps: int, scale: float, device: torch.device, negative_prompt: Optional[str] = None, batch_size: int = 8):
+    """Generate one image per seed with batched pipeline calls and write a contact sheet.
+
+    The prompt is encoded once and every chunk of batch_size seeds is one latent batch
+    with a generator per seed, so each image matches a single seeded run.
+    Returns the list of written paths, contact sheet last.
+    """
+    outputs, images = [], []
+    batch_size = max(1, batch_size)
+    start = time.perf_counter()
+    for i in range(0, len(seeds), batch_size):
+        chunk = seeds[i:i + batch_size]
+        batch = generate_images(pipe, [prompt] * len(chunk), height, width, steps, scale, device, seeds=chunk, negative_prompt=negative_prompt)
+        for seed, img in zip(chunk, batch):
+            outputs.append(save_checked(pipe, img, f"{out_path_base}_seed{seed}.png"))
+            images.append(img)
+        print(f"Generated {len(images)}/{len(seeds)} variations")
+    elapsed = time.perf_counter() - start
+    print(f"Seed sweep: {len(images)} images in {elapsed:.1f}s ({len(images) / elapsed:.3f} images/s, batch size {batch_size})")
+    if images:
+        sheet = make_contact_sheet(images, [f"seed {seed}" for seed in seeds])
+        outputs.append(save_checked(pipe, sheet, f"{out_path_base}_sheet.png"))
     return outputs
 
 
+def load_prompt_records(path: str, defaults: dict) -> List[dict]:
+    """Read a JSONL prompts file; missing fields fall back to the CLI defaults.
+
+    Records with a non-numeric or non-positive size/steps/scale/seed are skipped with a
+    message instead of aborting the whole job.
+    """
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_no}: invalid JSON ({e})")
+                continue
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict) or not item.get("prompt"):
+                print(f"Skipping line {line_no}: no prompt")
+                continue
+            rec = dict(defaults)
+            rec.update(item)
+            try:
+                for field, cast in (("height", int), ("width", int), ("steps", int), ("scale", float)):
+                    rec[field] = cast(rec[field])
+                if rec["height"] <= 0 or rec["width"] <= 0 or rec["steps"] <= 0:
+                    raise ValueError("height, width and steps must be positive")
+                if rec.get("seed") is not None:
+                    rec["seed"] = int(rec["seed"])
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Skipping line {line_no}: invalid record ({type(e).__name__}: {e})")
+                continue
+            rec["index"] = len(records)
+            records.append(rec)
+    return records
+
+
+def generate_from_prompts_file(prompts_file: str, out_dir: str, pipe, device: torch.device, defaults: dict, batch_size: int = 4, negative_prompt: Optional[str] = None):
+    """Generate every record of a JSONL prompts file with bucketed, batched pipeline calls.
+
+    Records are grouped by (height, width, steps, scale, scheduler) so each group can be
+    sent through the pipeline as list-of-prompts batches. Images are written as soon as
+    their batch finishes and outputs that already exist are skipped, so an interrupted
+    job can simply be restarted. A results.jsonl manifest is appended in out_dir.
+    """
+    records = load_prompt_records(prompts_file, defaults)
+    os.makedirs(out_dir, exist_ok=True)
+    writer = get_writer()
+    for rec in records:
+        if not rec.get("out"):
+            rec["out"] = os.path.join(out_dir, f"{rec['index']:05d}.png")
+        elif not os.path.isabs(rec["out"]):
+            # Relative names in the prompts file live under out_dir, not the current directory
+            rec["out"] = os.path.join(out_dir, rec["out"])
+        # Resolve the extension up front so existing outputs are found with --image-format
+        rec["out"] = resolve_format(rec["out"], writer.fmt)[0]
+
+    groups = {}
+    for rec in records:
+        key = (rec["height"], rec["width"], rec["steps"], rec["scale"], str(rec.get("scheduler") or "default"))
+        groups.setdefault(key, []).append(rec)
+    print(f"Loaded {len(records)} prompts in {len(groups)} bucket(s) from {prompts_file}")
+
+    original_scheduler = pipe.scheduler
+    base_config = original_scheduler.config
+    manifest_path = os.path.join(out_dir, "results.jsonl")
+    written = []
+    try:
+        for (height, width, steps, scale, scheduler), group in groups.items():
+            todo = [rec for rec in group if not os.path.exists(rec["out"])]
+            if len(todo) < len(group):
+                print(f"Skipping {len(group) - len(todo)} existing output(s) in bucket {height}x{width}/{steps}/{scale}/{scheduler}")
+            if not todo:
+                continue
+            pipe.scheduler = original_scheduler if scheduler == "default" else make_scheduler(scheduler, base_config)
+            for i in range(0, len(todo), max(1, batch_size)):
+                batch = todo[i:i + max(1, batch_size)]
+                prompts = [rec["prompt"] for rec in batch]
+                seeds = [rec.get("seed") for rec in batch]
+                try:
+                    images = generate_images(pipe, prompts, height, width, steps, scale, device, seeds=seeds, negative_prompt=negative_prompt)
+                except Exception as e:
+                    print(f"Batch of {len(batch)} failed ({height}x{width}/{steps}/{scale}/{scheduler}): {e}")
+                    continue
+                with open(manifest_path, "a", encoding="utf-8") as manifest:
+                    for rec, img in zip(batch, images):
+                        # Queued on the writer pool, so the next batch starts while this one is encoded
+                        save_checked(pipe, img, rec["out"])
+                        written.append(rec["out"])
+                        manifest.write(json.dumps({k: rec.get(k) for k in ("index", "prompt", "seed", "height", "width", "steps", "scale", "scheduler", "out")}, ensure_ascii=False) + "\n")
+                print(f"Saved {len(written)}/{len(records)} images (last: {batch[-1]['out']})")
+    finally:
+        pipe.scheduler = original_scheduler
+        writer.flush()
+    return written
+
+
 def main():
     args = parse_args()
+    EMBED_CACHE.resize(args.embed_cache_size)
+    REGISTRY.set_budget(args.ram_budget_gb, args.vram_budget_gb)
+    set_cpu_profile(args.cpu_profile, args.cpu_threads, args.cpu_interop_threads, parse_cores(args.cpu_cores))
+    set_quantization(args.quantize)
+    set_fast_cache(args.fast_cache_interval if args.fast_cache else 1)
+    set_token_merging(args.tome_ratio)
+    set_cfg_cutoff(args.cfg_cutoff, args.cfg_cutoff_threshold)
+    PLANNER.configure(args.memory_plan, args.memory_margin)
+    RESULT_CACHE.configure(args.result_cache_dir or None, args.result_cache_gb, args.result_cache_ttl_hours)
+    configure_writer(args.writer_workers, args.writer_queue, args.image_format, args.png_compress, args.quality, args.dump_raw)
     device = choose_device(args.device)
     print(f"Using device: {device}")
 
+    deferred_safety = None
+    if args.deferred_safety and not args.disable_safety:
+        # The registry hands generate() the same pipeline, so attaching once covers every mode
+        deferred_safety = DeferredSafetyChecker.attach(
+            get_pipeline(args.model, device, args.trust_remote_code, args.lowvram),
+            device=torch.device(args.safety_device) if args.safety_device else None,
+            batch_size=args.safety_batch,
+            max_wait_s=args.safety_wait_ms / 1000.0,
+            quarantine_dir=args.quarantine_dir or None,
+        )
+
     if not args.out:
         timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M")
         out_path = f"sdv1_5_{timestamp}.png"
     else:
         out_path = args.out
+    sweep = sweep_seeds(args.seeds, args.num_variations, args.seed)
+    if sweep:
+        print(f"Seed sweep over {len(sweep)} seeds: {sweep}")
     print("============args.interactive:", args.interactive)
-    if args.interactive:
+    if args.prompts_file:
+        pipe = get_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
+        if args.dbg_info:
+            print_pipeline_debug_info(pipe, args.model)
+        configure_safety(pipe, args.disable_safety)
+        out_dir = args.out_dir or f"sdv1_5_batch_{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        defaults = {
+            "height": args.height,
+            "width": args.width,
+            "steps": args.steps,
+            "scale": args.scale,
+            "seed": args.seed,
+            "scheduler": "default",
+        }
+        outs = generate_from_prompts_file(args.prompts_file, out_dir, pipe, device, defaults, batch_size=args.batch_size,
+                                          negative_prompt=args.negative_prompt)
+        print(f"Saved {len(outs)} images to: {out_dir}")
+        print("Embedding cache:", EMBED_CACHE.stats())
+        print("Pipeline registry:", REGISTRY.stats())
+    elif args.interactive:
         # Load pipeline once and reuse
-        pipe = load_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
+        pipe = get_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
         if args.dbg_info:
             print_pipeline_debug_info(pipe, args.model)
-        if args.disable_safety:
-            try:
-                def _dummy_safety(images, **kwargs):
-                    return images, [False] * len(images)
-                pipe.safety_checker = _dummy_safety
-                print("Safety checker disabled (--disable_safety enabled).")
-            except Exception:
-                pass
+        configure_safety(pipe, args.disable_safety)
 
         print("Entering interactive prompt mode. Type 'exit' or 'quit' to stop.")
         count = 0
@@ -261,7 +724,12 @@ def main():
             timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
             out_file = args.out or f"sdv1_5_{timestamp}_{count}.png"
             try:
-                if args.compare_schedulers:
+                if sweep:
+                    outs = generate_seed_sweep(user_prompt, sweep, os.path.splitext(out_file)[0], pipe, args.height, args.width,
+                                               args.steps, args.scale, device, negative_prompt=args.negative_prompt,
+                                               batch_size=args.batch_size)
+                    print("Saved images:", outs)
+                elif args.compare_schedulers:
                     outs = generate_with_schedulers(
                         prompt=user_prompt,
                         out_path_base=os.path.splitext(out_file)[0],
@@ -275,7 +743,9 @@ def main():
                         lowvram=args.lowvram,
                         trust_remote_code=args.trust_remote_code,
                         disable_safety=args.disable_safety,
+                        negative_prompt=args.negative_prompt,
                         pipe=pipe,
+                        compare_mode=args.compare_mode,
                     )
                     print("Saved images:", outs)
                 else:
@@ -292,6 +762,7 @@ def main():
                         lowvram=args.lowvram,
                         trust_remote_code=args.trust_remote_code,
                         disable_safety=args.disable_safety,
+                        negative_prompt=args.negative_prompt,
                         pipe=pipe,
                     )
                     print(f"Saved image to: {out}")
@@ -300,13 +771,22 @@ def main():
                 print("Generation failed:")
                 traceback.print_exc()
             count += 1
+        print("Embedding cache:", EMBED_CACHE.stats())
+        print("Pipeline registry:", REGISTRY.stats())
     else:
         # Non-interactive: optionally load pipeline and print debug info before a single run
         if args.dbg_info:
-            pipe = load_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
+            pipe = get_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
             print_pipeline_debug_info(pipe, args.model)
 
-        if args.compare_schedulers:
+        if sweep:
+            pipe = get_pipeline(args.model, device, args.trust_remote_code, args.lowvram)
+            configure_safety(pipe, args.disable_safety)
+            outs = generate_seed_sweep(args.prompt, sweep, os.path.splitext(out_path)[0], pipe, args.height, args.width,
+                                       args.steps, args.scale, device, negative_prompt=args.negative_prompt,
+                                       batch_size=args.batch_size)
+            print("Saved images:", outs)
+        elif args.compare_schedulers:
             base = os.path.splitext(out_path)[0]
             outs = generate_with_schedulers(
                 prompt=args.prompt,
@@ -321,6 +801,8 @@ def main():
                 lowvram=args.lowvram,
                 trust_remote_code=args.trust_remote_code,
                 disable_safety=args.disable_safety,
+                negative_prompt=args.negative_prompt,
+                compare_mode=args.compare_mode,
             )
             print("Saved images:", outs)
         else:
@@ -337,10 +819,22 @@ def main():
                 lowvram=args.lowvram,
                 trust_remote_code=args.trust_remote_code,
                 disable_safety=args.disable_safety,
+                negative_prompt=args.negative_prompt,
             )
 
             print(f"Saved image to: {out}")
 
+    # Wait for queued encodes before reporting; atexit would flush them too, but later
+    writer = get_writer()
+    writer.close()
+    print("Image writer:", writer.stats())
+    if deferred_safety is not None:
+        deferred_safety.close()
+        print("Deferred safety:", deferred_safety.stats())
+    if RESULT_CACHE.enabled:
+        print("Result cache:", RESULT_CACHE.stats())
+        print("Result cache (all runs):", RESULT_CACHE.save_stats())
+
 
 if __name__ == "__main__":
     main()
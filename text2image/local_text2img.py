@@ -31,6 +31,11 @@ except (ImportError, ModuleNotFoundError) as e:
     )
     raise SystemExit(msg)
 
+from cpu_profile import SETTINGS as CPU_PROFILE, apply_cpu_profile, inference_context, parse_cores, set_cpu_profile
+from pipeline_registry import REGISTRY, estimate_load_bytes, make_key
+from quantize import MODES as QUANT_MODES, SETTINGS as QUANT, cached_components, quantize_pipeline, set_quantization
+from token_merging import apply_token_merging, set_token_merging
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Local text-to-image using diffusers")
@@ -48,6 +53,17 @@ def parse_args():
     parser.add_argument("--seed", type=int, default=None, help="Random seed (optional)")
     parser.add_argument("--trust-remote-code", action="store_true",
                         help="Allow execution of model repository code (useful for custom pipelines).")
+    parser.add_argument("--cpu-profile", choices=["default", "fast"], default="default",
+                        help="CPU inference profile: 'fast' = bf16 autocast, channels_last, torch.compile, thread pinning")
+    parser.add_argument("--cpu-threads", type=int, default=None, help="Intra-op threads for --cpu-profile fast (default: all available cores)")
+    parser.add_argument("--cpu-interop-threads", type=int, default=None, help="Inter-op threads for --cpu-profile fast (default: 1)")
+    parser.add_argument("--cpu-cores", type=str, default="", help="Pin to these cores for --cpu-profile fast, e.g. '0-7'")
+    parser.add_argument("--quantize", choices=QUANT_MODES, default="none",
+                        help="Quantize UNet/text encoder: dynamic-int8 (CPU), int8-weight / int4-weight (torchao); cached on disk after the first load")
+    parser.add_argument("--tome-ratio", type=float, default=0.0,
+                        help="Token merging: fraction (0-0.75) of high-resolution tokens merged before self-attention (UNet pipelines only)")
+    parser.add_argument("--ram-budget-gb", type=float, default=None, help="RAM budget for cached pipelines (LRU eviction), default $T2I_RAM_BUDGET_GB")
+    parser.add_argument("--vram-budget-gb", type=float, default=None, help="VRAM budget for cached pipelines (LRU eviction), default $T2I_VRAM_BUDGET_GB")
     return parser.parse_args()
 
 
@@ -102,8 +118,9 @@ def load_pipeline(model_id: str, device: torch.device, trust_remote_code: bool =
             pass
 
     # Try to load a StableDiffusionPipeline; many local models use this.
+    cached = cached_components(model_id, device, torch_dtype)
     try:
-        pipe = StableDiffusionPipeline.from_pretrained(model_id, **load_kwargs)
+        pipe = StableDiffusionPipeline.from_pretrained(model_id, **load_kwargs, **cached)
     except Exception as e:
         # Provide a helpful message for common cases (checkpoint vs diffusers format)
         msg = (
@@ -116,13 +133,24 @@ def load_pipeline(model_id: str, device: torch.device, trust_remote_code: bool =
         raise RuntimeError(msg)
 
     # Move to device
+    pipe._quantized_components = tuple(cached)
+    pipe = quantize_pipeline(pipe, model_id, device)
     pipe = pipe.to(device)
 
     return pipe
 
 
+def get_pipeline(model_id: str, device: torch.device, trust_remote_code: bool = False):
+    """Return a shared pipeline from the process-wide registry, loading it on first use."""
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    key = make_key(model_id, dtype, device, pipeline="sd", trust_remote_code=trust_remote_code,
+                   cpu_profile=CPU_PROFILE.name if device.type == "cpu" else "default", quantize=QUANT.mode)
+    return REGISTRY.get(key, lambda: apply_cpu_profile(load_pipeline(model_id, device, trust_remote_code=trust_remote_code), device),
+                        estimated_bytes=estimate_load_bytes(model_id, dtype), on_cuda=device.type == "cuda")
+
+
 def generate(prompt: str, out_path: str, model: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], trust_remote_code: bool = False):
-    pipe = load_pipeline(model, device, trust_remote_code=trust_remote_code)
+    pipe = apply_token_merging(get_pipeline(model, device, trust_remote_code=trust_remote_code))
 
     # set seed
     generator = None
@@ -130,8 +158,9 @@ def generate(prompt: str, out_path: str, model: str, height: int, width: int, st
         generator = torch.Generator(device=device).manual_seed(seed)
 
     # The pipeline may accept height/width (most pipelines do)
-    result = pipe(prompt=prompt, height=height, width=width, num_inference_steps=steps,
-                  guidance_scale=scale, generator=generator)
+    with inference_context(pipe):
+        result = pipe(prompt=prompt, height=height, width=width, num_inference_steps=steps,
+                      guidance_scale=scale, generator=generator)
 
     image = result.images[0]
     # Ensure output dir exists
@@ -143,6 +172,10 @@ def generate(prompt: str, out_path: str, model: str, height: int, width: int, st
 
 def main():
     args = parse_args()
+    REGISTRY.set_budget(args.ram_budget_gb, args.vram_budget_gb)
+    set_cpu_profile(args.cpu_profile, args.cpu_threads, args.cpu_interop_threads, parse_cores(args.cpu_cores))
+    set_quantization(args.quantize)
+    set_token_merging(args.tome_ratio)
     device = choose_device(args.device)
     print(f"Using device: {device}")
 
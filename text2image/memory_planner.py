@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+memory_planner.py
+
+Automatic memory planning for Stable Diffusion pipelines.
+
+Before each pipeline call the planner estimates the activation memory of the
+request (resolution, batch size, CFG) and compares it with the memory actually free
+on the device (torch.cuda.mem_get_info, or available RAM on CPU). It then picks the
+cheapest set of memory helpers that fits, in order of slowdown:
+
+  vae_slicing        decode the batch one image at a time       (~free)
+  vae_tiling         tiled VAE encode/decode                    (small cost, fixes >=1024px decode)
+  attention_slicing  UNet attention in slices                   (moderate)
+  model_offload      whole-model CPU offload (CUDA only)        (model transfers per call)
+  sequential_offload layer-by-layer CPU offload (CUDA only)     (slow, last resort)
+
+With SDPA (torch >= 2) attention slicing saves nothing: SlicedAttnProcessor materializes
+each head's score matrix, which the fused kernel never does, so the estimate gives
+slicing no advantage and the planner moves on to offload instead.
+
+The chosen plan and the estimated vs observed peak are logged for every call.
+Estimates are deliberately coarse (per-512x512 constants measured on SD 1.5 fp16);
+the safety margin absorbs the error.
+"""
+from typing import Dict, List, Optional
+
+import torch
+
+from perf_utils import MemoryTracker, current_rss_mb
+
+MB = 2 ** 20
+
+# Candidate plans, cheapest first; the planner picks the first one whose estimate fits
+PLANS = (
+    (),
+    ("vae_slicing",),
+    ("vae_slicing", "vae_tiling"),
+    ("vae_slicing", "vae_tiling", "attention_slicing"),
+    ("vae_slicing", "vae_tiling", "attention_slicing", "model_offload"),
+    ("vae_slicing", "vae_tiling", "attention_slicing", "sequential_offload"),
+)
+
+
+def free_memory_bytes(device: torch.device) -> Optional[int]:
+    """Free memory on the device (CUDA free + reclaimable cache, or available RAM)."""
+    if device.type == "cuda" and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info(device)
+        # Blocks cached by the allocator are reusable by this process
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        import psutil  # type: ignore[import]
+        return psutil.virtual_memory().available
+    except (ImportError, ModuleNotFoundError):
+        pass
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _module_bytes(module) -> int:
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+def estimate_peak(pipe, height: int, width: int, batch: int, do_cfg: bool, helpers, default_dtype: torch.dtype = torch.float16) -> Dict[str, float]:
+    """Estimated extra bytes (beyond weights already resident) for one call under a plan.
+
+    pipe may be None (no weights loaded yet); default_dtype then stands in for the UNet's.
+    """
+    dtype = getattr(getattr(pipe, "unet", None), "dtype", default_dtype)
+    elem = torch.finfo(dtype).bits // 8 if dtype.is_floating_point else 2
+    pixels = height * width
+    branches = batch * (2 if do_cfg else 1)
+    tokens = (height // 8) * (width // 8)
+
+    # UNet convolution/feed-forward activations: ~0.5 GB fp16 per 512x512 sample per branch
+    unet = 0.5 * 2 ** 30 * branches * pixels / (512 * 512) * elem / 2
+    # Self-attention scores at the highest UNet resolution (8 heads); slicing keeps one head
+    heads = 1 if "attention_slicing" in helpers else 8
+    attn = branches * heads * tokens * tokens * elem
+    if "attention_slicing" not in helpers and hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        # Memory-efficient SDPA kernels do not materialize the full score matrix; slicing
+        # swaps in SlicedAttnProcessor, which does (baddbmm), so it gets no discount
+        attn /= 8
+
+    # VAE decoder: ~6 live 128-channel buffers at full resolution plus mid-block attention
+    vae_images = 1 if "vae_slicing" in helpers else batch
+    vae_pixels = min(pixels, 512 * 512) if "vae_tiling" in helpers else pixels
+    vae_tokens = vae_pixels // 64
+    vae = vae_images * (6 * 128 * vae_pixels * elem + vae_tokens * vae_tokens * elem)
+
+    weights_freed = 0
+    modules = [getattr(pipe, name, None) for name in ("unet", "vae", "text_encoder")]
+    sizes = [_module_bytes(m) for m in modules]
+    if "sequential_offload" in helpers:
+        weights_freed = sum(sizes)
+    elif "model_offload" in helpers:
+        # Only the largest active model stays on the device
+        weights_freed = sum(sizes) - max(sizes or [0])
+
+    peak = max(unet + attn, vae) - weights_freed
+    return {"unet_mb": unet / MB, "attn_mb": attn / MB, "vae_mb": vae / MB, "freed_mb": weights_freed / MB,
+            "peak_mb": max(peak, 0) / MB}
+
+
+class MemoryPlanner:
+    def __init__(self, mode: str = "off", margin: float = 0.85):
+        self.mode = mode
+        self.margin = margin
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == "auto"
+
+    def configure(self, mode: str = "auto", margin: Optional[float] = None):
+        if mode not in ("auto", "off"):
+            raise ValueError(f"Unknown memory plan mode '{mode}', expected 'auto' or 'off'")
+        self.mode = mode
+        if margin is not None:
+            self.margin = margin
+
+    def choose(self, pipe, device: torch.device, height: int, width: int, batch: int, do_cfg: bool, pending_bytes: int = 0):
+        """Return (helpers, estimate, free_bytes) for the cheapest plan that fits.
+
+        pending_bytes: weights that are not resident yet but will be by the time the call runs
+        (planning for a pipeline before loading it), taken off the free memory.
+        """
+        free = free_memory_bytes(device)
+        if free is not None and pending_bytes:
+            free = max(0, free - pending_bytes)
+        dtype = torch.float16 if device.type == "cuda" else torch.float32
+        candidates = [p for p in PLANS if device.type == "cuda" or not any(h.endswith("offload") for h in p)]
+        estimates = [estimate_peak(pipe, height, width, batch, do_cfg, plan, dtype) for plan in candidates]
+        if free is not None:
+            for plan, est in zip(candidates, estimates):
+                if est["peak_mb"] * MB <= free * self.margin:
+                    return plan, est, free
+        # Nothing fits (or free memory is unknown): the cheapest plan with the lowest estimate
+        best = min(range(len(candidates)), key=lambda i: estimates[i]["peak_mb"])
+        return candidates[best], estimates[best], free
+
+    def plan(self, pipe, device: torch.device, height: int, width: int, batch: int, do_cfg: bool) -> List[str]:
+        helpers, estimate, free = self.choose(pipe, device, height, width, batch, do_cfg)
+        apply_helpers(pipe, helpers)
+        free_txt = f"{free / MB:.0f} MB" if free is not None else "unknown"
+        print(f"Memory plan {height}x{width} x{batch}: [{', '.join(helpers) or 'none'}] "
+              f"(estimated peak {estimate['peak_mb']:.0f} MB, free {free_txt})")
+        pipe._memory_plan_estimate_mb = estimate["peak_mb"]
+        return list(helpers)
+
+    def track(self, pipe, device: torch.device):
+        """MemoryTracker for the pipeline call that logs the observed peak on exit."""
+        return _PlanTracker(pipe, device)
+
+
+class _PlanTracker(MemoryTracker):
+    def __init__(self, pipe, device: torch.device):
+        super().__init__(device)
+        self.pipe = pipe
+        self.baseline_mb = None
+
+    def __enter__(self):
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            self.baseline_mb = torch.cuda.memory_allocated(self.device) / MB
+        else:
+            self.baseline_mb = current_rss_mb()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if self.peak_mb is not None and self.baseline_mb is not None:
+            estimate = getattr(self.pipe, "_memory_plan_estimate_mb", 0)
+            print(f"Memory plan observed peak: {self.peak_mb:.0f} MB "
+                  f"(+{self.peak_mb - self.baseline_mb:.0f} MB over resident weights, estimated +{estimate:.0f} MB)")
+        return False
+
+
+def _call(target, name: str):
+    fn = getattr(target, name, None)
+    if fn is None:
+        return False
+    try:
+        fn()
+        return True
+    except Exception as e:
+        print(f"Warning: {name}() failed: {e}")
+        return False
+
+
+def apply_helpers(pipe, helpers):
+    """Switch pipe's memory helpers to exactly `helpers` (CPU offload cannot be undone)."""
+    active = set(getattr(pipe, "_memory_helpers", ()))
+    wanted = set(helpers)
+    if active == wanted:
+        return
+    vae = getattr(pipe, "vae", None)
+    for name, target, enable, disable in (
+        # Call the VAE directly; the pipeline-level enable_vae_* wrappers are deprecated
+        ("vae_slicing", vae, "enable_slicing", "disable_slicing"),
+        ("vae_tiling", vae, "enable_tiling", "disable_tiling"),
+        ("attention_slicing", pipe, "enable_attention_slicing", "disable_attention_slicing"),
+    ):
+        if name in wanted and name not in active:
+            _call(target, enable)
+        elif name not in wanted and name in active:
+            _call(target, disable)
+    # Offload hooks stay installed once added; later plans keep them
+    if "sequential_offload" in wanted and "sequential_offload" not in active:
+        _call(pipe, "enable_sequential_cpu_offload")
+    elif "model_offload" in wanted and not active & {"model_offload", "sequential_offload"}:
+        _call(pipe, "enable_model_cpu_offload")
+    pipe._memory_helpers = tuple(sorted(wanted | (active & {"model_offload", "sequential_offload"})))
+
+
+# Process-wide planner; scripts enable it from main() with PLANNER.configure("auto")
+PLANNER = MemoryPlanner()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+mock_dashscope.py
+
+Local stand-in for the DashScope async image- and video-synthesis REST APIs, for
+offline tests of dashscope_batch.py and text2video/scripts/video_task_tracker.py.
+
+  POST /api/v1/services/aigc/text2image/image-synthesis     (X-DashScope-Async: enable)
+  POST /api/v1/services/aigc/video-generation/video-synthesis
+  GET  /api/v1/tasks/<task_id>
+  GET  /files/<name>.png | .mp4                             (Range requests supported)
+
+Image tasks go PENDING -> RUNNING -> SUCCEEDED after --task-seconds and return n
+result URLs served by this server. Video tasks queue for one of --video-slots
+workers (PENDING), then run for --video-seconds +-50% (RUNNING) and return a
+video_url; task output carries submit_time / scheduled_time / end_time like the real
+service. Throttling is simulated: HTTP 429 with code Throttling.RateQuota when
+submits exceed --rps, or when more than --max-running image tasks are unfinished.
+
+  python mock_dashscope.py --port 8765 --rps 2 --max-running 4 --task-seconds 1.5
+  python dashscope_batch.py --prompts-file prompts.txt --base-url http://127.0.0.1:8765/api/v1
+
+Like the real service, image k of a seeded n-image task is generated with seed + k.
+--check runs dashscope_batch.py's packing against the mock: a seeded n=3 request
+split into n=1 calls, and an n=4 request whose images 0 and 2 are already cached,
+must both end up with image k made from seed + k (on disk and in the remote cache).
+
+  python mock_dashscope.py --check
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+
+def tiny_png(seed: int, size: int = 64) -> bytes:
+    """A small solid-colour PNG (no PIL needed), coloured by seed so results differ."""
+    rgb = bytes(((seed * 67) % 256, (seed * 131) % 256, (seed * 29) % 256))
+    raw = b"".join(b"\x00" + rgb * size for _ in range(size))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def _timestamp(t: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) + f".{int(t * 1000) % 1000:03d}"
+
+
+class MockState:
+    def __init__(self, rps: float = 0.0, max_running: int = 0, task_seconds: float = 1.0, max_n: int = 4,
+                 video_slots: int = 2, video_seconds: float = 3.0, video_bytes: int = 2 << 20):
+        self.rps = rps
+        self.max_running = max_running
+        self.task_seconds = task_seconds
+        self.max_n = max_n
+        self.video_seconds = video_seconds
+        self.video_bytes = video_bytes
+        self.slots = [0.0] * max(1, video_slots)  # time each video worker becomes free
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.submits = []
+        self.stats = {"submits": 0, "throttled": 0, "polls": 0, "downloads": 0}
+
+    def _running(self, now: float) -> int:
+        return sum(1 for t in self.tasks.values() if t["kind"] == "image" and now < t["done_at"])
+
+    def _admit(self, now: float, kind: str) -> Optional[Tuple[int, dict]]:
+        self.submits = [t for t in self.submits if now - t < 1.0]
+        if (self.rps and len(self.submits) >= self.rps) or (kind == "image" and self.max_running and self._running(now) >= self.max_running):
+            self.stats["throttled"] += 1
+            return 429, {"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded, please try again later."}
+        return None
+
+    def _created(self, task_id: str) -> Tuple[int, dict]:
+        return 200, {"output": {"task_id": task_id, "task_status": "PENDING"}, "request_id": uuid.uuid4().hex}
+
+    def submit(self, body: dict) -> Tuple[int, dict]:
+        now = time.time()
+        with self.lock:
+            rejected = self._admit(now, "image")
+            if rejected:
+                return rejected
+            n = int(body.get("parameters", {}).get("n", 1))
+            if not 1 <= n <= self.max_n:
+                return 400, {"code": "InvalidParameter", "message": f"n must be between 1 and {self.max_n}"}
+            if not body.get("input", {}).get("prompt"):
+                return 400, {"code": "InvalidParameter", "message": "input.prompt is required"}
+            self.submits.append(now)
+            self.stats["submits"] += 1
+            task_id = uuid.uuid4().hex
+            self.tasks[task_id] = {"kind": "image", "n": n, "submitted": now, "scheduled_at": now + 0.2 * self.task_seconds,
+                                   "done_at": now + self.task_seconds,
+                                   "seed": int(body.get("parameters", {}).get("seed", len(self.tasks)))}
+        return self._created(task_id)
+
+    def submit_video(self, body: dict) -> Tuple[int, dict]:
+        now = time.time()
+        with self.lock:
+            rejected = self._admit(now, "video")
+            if rejected:
+                return rejected
+            if not body.get("input", {}).get("prompt"):
+                return 400, {"code": "InvalidParameter", "message": "input.prompt is required"}
+            self.submits.append(now)
+            self.stats["submits"] += 1
+            # FIFO onto the earliest free worker; the wait shows up as PENDING (queue) time
+            slot = min(range(len(self.slots)), key=self.slots.__getitem__)
+            scheduled = max(now, self.slots[slot])
+            done = scheduled + self.video_seconds * random.uniform(0.5, 1.5)
+            self.slots[slot] = done
+            task_id = uuid.uuid4().hex
+            self.tasks[task_id] = {"kind": "video", "n": 1, "submitted": now, "scheduled_at": scheduled, "done_at": done,
+                                   "seed": int(body.get("parameters", {}).get("seed", len(self.tasks)))}
+        return self._created(task_id)
+
+    def task(self, task_id: str, base: str) -> Tuple[int, dict]:
+        now = time.time()
+        with self.lock:
+            self.stats["polls"] += 1
+            task = self.tasks.get(task_id)
+        if task is None:
+            return 404, {"code": "InvalidParameter", "message": f"task {task_id} not found"}
+        output = {"task_id": task_id, "submit_time": _timestamp(task["submitted"])}
+        if now < task["scheduled_at"]:
+            output["task_status"] = "PENDING"
+        elif now < task["done_at"]:
+            output["task_status"] = "RUNNING"
+            output["scheduled_time"] = _timestamp(task["scheduled_at"])
+        else:
+            output["task_status"] = "SUCCEEDED"
+            output["scheduled_time"] = _timestamp(task["scheduled_at"])
+            output["end_time"] = _timestamp(task["done_at"])
+            if task["kind"] == "video":
+                output["video_url"] = f"{base}/files/{task_id}_0.mp4"
+                return 200, {"output": output, "usage": {"video_count": 1}, "request_id": uuid.uuid4().hex}
+            output["results"] = [{"url": f"{base}/files/{task_id}_{i}.png"} for i in range(task["n"])]
+            output["task_metrics"] = {"TOTAL": task["n"], "SUCCEEDED": task["n"], "FAILED": 0}
+        return 200, {"output": output, "usage": {"image_count": task["n"]}, "request_id": uuid.uuid4().hex}
+
+    def file(self, name: str) -> Optional[bytes]:
+        stem, _, ext = name.rpartition(".")
+        task_id, _, index = stem.rpartition("_")
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            self.stats["downloads"] += 1
+        if ext == "mp4":
+            # Deterministic filler of the configured size (not a playable video)
+            block = (task_id.encode() * 64)[:4096]
+            return (block * (self.video_bytes // len(block) + 1))[:self.video_bytes]
+        return tiny_png(task["seed"] + int(index or 0))
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, so clients can pool connections
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send(self, status: int, body: bytes, content_type: str = "application/json", headers: Optional[dict] = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, status: int, payload: dict):
+            self._send(status, json.dumps(payload).encode("utf-8"))
+
+        def _authorized(self) -> bool:
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                self._json(401, {"code": "InvalidApiKey", "message": "Invalid API-key provided."})
+                return False
+            return True
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            if self.path.endswith("/image-synthesis"):
+                submit = state.submit
+            elif self.path.endswith("/video-synthesis"):
+                submit = state.submit_video
+            else:
+                return self._json(404, {"code": "NotFound", "message": self.path})
+            if not self._authorized():
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except json.JSONDecodeError:
+                return self._json(400, {"code": "InvalidParameter", "message": "body is not JSON"})
+            self._json(*submit(payload))
+
+        def do_GET(self):
+            if self.path.startswith("/files/"):
+                name = self.path[len("/files/"):]
+                data = state.file(name)
+                if data is None:
+                    return self._json(404, {"code": "NotFound", "message": self.path})
+                content_type = "video/mp4" if name.endswith(".mp4") else "image/png"
+                spec = self.headers.get("Range", "")
+                if spec.startswith("bytes="):
+                    first, _, last = spec[len("bytes="):].partition("-")
+                    start, end = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+                    return self._send(206, data[start:end + 1], content_type,
+                                      {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+                return self._send(200, data, content_type)
+            if "/tasks/" in self.path:
+                if not self._authorized():
+                    return
+                host = self.headers.get("Host") or f"127.0.0.1:{self.server.server_address[1]}"
+                return self._json(*state.task(self.path.rsplit("/", 1)[-1], f"http://{host}"))
+            self._json(404, {"code": "NotFound", "message": self.path})
+
+    return Handler
+
+
+def serve(port: int = 0, state: Optional[MockState] = None):
+    """Start the mock in a daemon thread; returns (server, base_url). port=0 picks a free port."""
+    state = state or MockState()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+def check_seeded_batches():
+    """Seeded requests split over several calls (or partly cached) must get seed + index per image."""
+    from dashscope_batch import BatchStats, DashScopeClient, pack_calls, run_batch
+    from remote_cache import REMOTE_CACHE, fingerprint, result_key
+
+    server, base_url = serve(state=MockState(task_seconds=0.2))
+    client = DashScopeClient("sk-mock", base_url, pool_size=8)
+    errors = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            REMOTE_CACHE.configure(os.path.join(tmp, "cache"), max_gb=1.0)
+            cases = [("tree", 3, 5, 1, ()), ("house", 4, 10, 4, (0, 2))]
+            for prompt, n, seed, max_n, cached in cases:
+                out_dir = os.path.join(tmp, prompt)
+                records = [{"index": 0, "prompt": prompt, "n": n, "seed": seed, "size": "64*64"}]
+                fps = [fingerprint("image", "qwen-image", prompt, size="64*64", seed=seed, index=k, endpoint=base_url) for k in range(n)]
+                for k in cached:
+                    src = os.path.join(tmp, f"{prompt}-cached-{k}.png")
+                    with open(src, "wb") as f:
+                        f.write(tiny_png(seed + k))
+                    REMOTE_CACHE.store(fps[k], src)
+                stats = BatchStats()
+                calls = pack_calls(records, out_dir, max_n, stats, "qwen-image", endpoint=base_url)
+                sent = sorted(c["seed"] for c in calls)
+                # Every missing image here is its own call: max_n=1, or cut off by a cached neighbour
+                expected = [seed + k for k in range(n) if k not in cached]
+                if sent != expected:
+                    errors.append(f"{prompt}: calls sent seeds {sent}, expected {expected}")
+                asyncio.run(run_batch(client, calls, "qwen-image", 4, stats, poll_interval=0.1, timeout=30, max_n=max_n))
+                for k in range(n):
+                    path = os.path.join(out_dir, f"00000_{k}.png")
+                    data = open(path, "rb").read() if os.path.isfile(path) else None
+                    if data != tiny_png(seed + k):
+                        errors.append(f"{prompt}: image {k} on disk was not made with seed {seed + k}")
+                    entry, _ = REMOTE_CACHE._entry(result_key(**fps[k]))
+                    if entry is None or open(entry, "rb").read() != tiny_png(seed + k):
+                        errors.append(f"{prompt}: cache entry for index {k} does not hold the seed {seed + k} image")
+    finally:
+        client.close()
+        server.shutdown()
+    for error in errors:
+        print("FAIL:", error)
+    if errors:
+        raise SystemExit(1)
+    print("OK: seeded batches get seed + index per image, on disk and in the cache")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the DashScope async image-synthesis API")
+    parser.add_argument("--check", action="store_true", help="Run the seeded-batch packing check against an in-process mock and exit")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rps", type=float, default=2.0, help="Max submits per second before 429 (0 = unlimited)")
+    parser.add_argument("--max-running", type=int, default=4, help="Max unfinished tasks before 429 (0 = unlimited)")
+    parser.add_argument("--task-seconds", type=float, default=1.5, help="Time a task takes to succeed")
+    parser.add_argument("--max-n", type=int, default=4, help="Largest accepted n per call")
+    parser.add_argument("--video-slots", type=int, default=2, help="Video tasks run concurrently; the rest wait as PENDING")
+    parser.add_argument("--video-seconds", type=float, default=3.0, help="Mean video task run time (+-50%%)")
+    parser.add_argument("--video-mb", type=float, default=2.0, help="Size of each served video file")
+    args = parser.parse_args()
+    if args.check:
+        check_seeded_batches()
+        return
+    server, base_url = serve(args.port, MockState(args.rps, args.max_running, args.task_seconds, args.max_n, args.video_slots,
+                                                  args.video_seconds, int(args.video_mb * 2 ** 20)))
+    print(f"Mock DashScope listening on {base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+perf_utils.py
+
+Small timing/memory helpers shared by the text2image scripts and benchmarks.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+try:
+    import psutil  # type: ignore[import]
+except (ImportError, ModuleNotFoundError):
+    psutil = None
+
+
+def sync(device: torch.device):
+    """Wait for queued CUDA work so wall-clock timings are honest."""
+    if device.type == "cuda" and torch.cuda.is_available():
+        torch.cuda.synchronize(device)
+
+
+def current_rss_mb() -> Optional[float]:
+    """Resident set size of this process in MB, or None if it cannot be read."""
+    if psutil is not None:
+        try:
+            return psutil.Process().memory_info().rss / 2 ** 20
+        except Exception:
+            pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except Exception:
+        return None
+
+
+class MemoryTracker:
+    """Context manager measuring peak memory of the enclosed block.
+
+    On CUDA this is torch's peak allocated memory; on CPU the process RSS is sampled
+    in a background thread (every interval seconds) and the maximum is kept.
+    """
+
+    def __init__(self, device: torch.device, interval: float = 0.01):
+        self.device = device
+        self.interval = interval
+        self.peak_mb: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak_mb = current_rss_mb()
+            if self.peak_mb is not None:
+                self._thread = threading.Thread(target=self._sample, daemon=True)
+                self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss_mb()
+            if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+                self.peak_mb = rss
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            sync(self.device)
+            self.peak_mb = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            rss = current_rss_mb()
+            if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+                self.peak_mb = rss
+        return False
+
+
+class Timer:
+    """Context manager recording elapsed wall time (CUDA-synchronized) in .seconds."""
+
+    def __init__(self, device: Optional[torch.device] = None):
+        self.device = device
+        self.seconds = 0.0
+
+    def __enter__(self):
+        if self.device is not None:
+            sync(self.device)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.device is not None:
+            sync(self.device)
+        self.seconds = time.perf_counter() - self._start
+        return False
+
+
+class StepTimer:
+    """callback_on_step_end hook recording the wall time of every denoising step.
+
+    Pass as callback_on_step_end=timer; the first step is measured from start().
+    """
+
+    def __init__(self, device: Optional[torch.device] = None):
+        self.device = device
+        self.step_seconds: List[float] = []
+        self._last = None
+
+    def start(self):
+        self.step_seconds = []
+        if self.device is not None:
+            sync(self.device)
+        self._last = time.perf_counter()
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        if self.device is not None:
+            sync(self.device)
+        now = time.perf_counter()
+        if self._last is not None:
+            self.step_seconds.append(now - self._last)
+        self._last = now
+        return callback_kwargs
+
+    @property
+    def mean_step_s(self) -> Optional[float]:
+        if not self.step_seconds:
+            return None
+        return sum(self.step_seconds) / len(self.step_seconds)
+
+
+def format_table(rows: List[Dict], columns: List[str]) -> str:
+    """Render rows (dicts) as a fixed-width text table with the given columns."""
+    def fmt(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.3f}"
+        return str(value)
+
+    cells = [[fmt(row.get(col)) for col in columns] for row in rows]
+    widths = [max([len(col)] + [len(r[i]) for r in cells]) for i, col in enumerate(columns)]
+    lines = ["  ".join(col.ljust(w) for col, w in zip(columns, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for r in cells:
+        lines.append("  ".join(c.ljust(w) for c, w in zip(r, widths)))
+    return "\n".join(lines)
+
+
+def image_similarity(a, b) -> dict:
+    """PSNR (dB) and cosine similarity of two images' pixels (PIL images or file paths)."""
+    import numpy as np
+    from PIL import Image
+
+    def pixels(img, size=None):
+        img = Image.open(img) if isinstance(img, str) else img
+        img = img.convert("RGB")
+        return np.asarray(img.resize(size) if size and img.size != size else img, dtype=np.float64)
+
+    x = pixels(a)
+    y = pixels(b, (x.shape[1], x.shape[0]))
+    mse = float(np.mean((x - y) ** 2))
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+    cos = float(np.dot(x.ravel(), y.ravel()) / (np.linalg.norm(x) * np.linalg.norm(y) + 1e-12))
+    return {"psnr_db": psnr, "cosine": cos}
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+pipeline_registry.py
+
+Process-wide registry of loaded diffusers pipelines shared by the local text2image
+scripts (local_sd_v1_5_text2img.py, local_text2img.py, local_flux_text2img.py).
+
+Pipelines are keyed by (model dir, dtype, device, loader options) so repeated
+generate() calls reuse the loaded weights. An optional RAM / VRAM budget is enforced
+with LRU eviction. Budgets default to $T2I_RAM_BUDGET_GB / $T2I_VRAM_BUDGET_GB.
+"""
+import gc
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import torch
+
+WEIGHT_PATTERNS = ("*.safetensors", "*.bin", "*.ckpt", "*.pt")
+
+
+def _env_budget(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        print(f"Warning: ignoring invalid {name}={value!r}")
+        return None
+
+
+def make_key(model_dir: str, dtype: torch.dtype, device: torch.device, **options) -> tuple:
+    model = os.path.abspath(model_dir) if os.path.isdir(model_dir) else model_dir
+    return (model, str(dtype), str(device), tuple(sorted(options.items())))
+
+
+def pipeline_nbytes(pipe) -> Tuple[int, int]:
+    """Return (cpu_bytes, cuda_bytes) held by the parameters and buffers of a pipeline."""
+    cpu_bytes = cuda_bytes = 0
+    components = getattr(pipe, "components", None) or {}
+    for module in components.values():
+        if not isinstance(module, torch.nn.Module):
+            continue
+        for t in list(module.parameters()) + list(module.buffers()):
+            n = t.numel() * t.element_size()
+            if t.device.type == "cuda":
+                cuda_bytes += n
+            elif t.device.type != "meta":
+                cpu_bytes += n
+    return cpu_bytes, cuda_bytes
+
+
+def estimate_load_bytes(model_dir: str, dtype: torch.dtype) -> int:
+    """Rough size of a model directory's weights once loaded with dtype (0 if unknown)."""
+    if not os.path.isdir(model_dir):
+        return 0
+    total = 0
+    for pattern in WEIGHT_PATTERNS:
+        for path in glob.glob(os.path.join(model_dir, "**", pattern), recursive=True):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+    # Checkpoints are commonly stored in fp32; half precision loads take about half
+    if dtype in (torch.float16, torch.bfloat16):
+        total //= 2
+    return total
+
+
+class PipelineRegistry:
+    def __init__(self, ram_budget_gb: Optional[float] = None, vram_budget_gb: Optional[float] = None):
+        self.ram_budget_gb = ram_budget_gb
+        self.vram_budget_gb = vram_budget_gb
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def set_budget(self, ram_budget_gb: Optional[float] = None, vram_budget_gb: Optional[float] = None):
+        with self._lock:
+            if ram_budget_gb is not None:
+                self.ram_budget_gb = ram_budget_gb
+            if vram_budget_gb is not None:
+                self.vram_budget_gb = vram_budget_gb
+            self._evict_to_budget(0, 0)
+
+    def get(self, key: tuple, loader: Callable[[], object], estimated_bytes: int = 0, on_cuda: bool = False):
+        """Return the pipeline for key, calling loader() (and evicting LRU entries) on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry["hits"] += 1
+                self.hits += 1
+                return entry["pipe"]
+            self.misses += 1
+
+            # Make room before loading so the new weights do not push us over budget
+            self._evict_to_budget(0 if on_cuda else estimated_bytes, estimated_bytes if on_cuda else 0)
+            start = time.perf_counter()
+            pipe = loader()
+            load_s = time.perf_counter() - start
+            self.load_seconds += load_s
+            cpu_bytes, cuda_bytes = pipeline_nbytes(pipe)
+            self._entries[key] = {"pipe": pipe, "load_s": load_s, "hits": 0, "cpu_bytes": cpu_bytes, "cuda_bytes": cuda_bytes}
+            print(f"Loaded pipeline in {load_s:.1f}s (RAM {cpu_bytes / 2 ** 30:.2f} GB, VRAM {cuda_bytes / 2 ** 30:.2f} GB): {key[0]}")
+            self._evict_to_budget(0, 0, keep=key)
+            return pipe
+
+    def peek(self, key: tuple):
+        """The already loaded pipeline for key, or None; never loads and does not count as a hit."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry["pipe"] if entry is not None else None
+
+    def _totals(self) -> Tuple[int, int]:
+        cpu = sum(e["cpu_bytes"] for e in self._entries.values())
+        cuda = sum(e["cuda_bytes"] for e in self._entries.values())
+        return cpu, cuda
+
+    def _over_budget(self, extra_cpu: int, extra_cuda: int) -> bool:
+        cpu, cuda = self._totals()
+        if self.ram_budget_gb is not None and cpu + extra_cpu > self.ram_budget_gb * 2 ** 30:
+            return True
+        if self.vram_budget_gb is not None and cuda + extra_cuda > self.vram_budget_gb * 2 ** 30:
+            return True
+        return False
+
+    def _evict_to_budget(self, extra_cpu: int, extra_cuda: int, keep: Optional[tuple] = None):
+        while self._over_budget(extra_cpu, extra_cuda):
+            victim = next((k for k in self._entries if k != keep), None)
+            if victim is None:
+                break
+            self.evict(victim)
+
+    def evict(self, key: tuple):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            self.evictions += 1
+            print(f"Evicting pipeline (LRU): {key[0]} [{key[1]}, {key[2]}]")
+            del entry
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self.evict(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            cpu, cuda = self._totals()
+            total = self.hits + self.misses
+            return {
+                "pipelines": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "load_seconds": round(self.load_seconds, 2),
+                "ram_gb": round(cpu / 2 ** 30, 2),
+                "vram_gb": round(cuda / 2 ** 30, 2),
+                "ram_budget_gb": self.ram_budget_gb,
+                "vram_budget_gb": self.vram_budget_gb,
+                "entries": [
+                    {"model": k[0], "dtype": k[1], "device": k[2], "options": dict(k[3]),
+                     "load_s": round(e["load_s"], 2), "hits": e["hits"]}
+                    for k, e in self._entries.items()
+                ],
+            }
+
+
+# Shared by every script imported into the same process
+REGISTRY = PipelineRegistry(_env_budget("T2I_RAM_BUDGET_GB"), _env_budget("T2I_VRAM_BUDGET_GB"))
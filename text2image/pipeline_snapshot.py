@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+pipeline_snapshot.py
+
+Write a fully resolved diffusers pipeline (component configs, tokenizer/scheduler
+files and dtype-converted weights) into one safetensors bundle, and rebuild the
+pipeline from it with every weight tensor backed by a memory mapping of the file.
+
+Usage examples:
+  python pipeline_snapshot.py snapshot G:/AIModels/.../stable-diffusion-v1-5 sd15.snapshot.safetensors --dtype fp16
+  python pipeline_snapshot.py snapshot G:/AIModels/.../FLUX___1-dev flux.snapshot.safetensors --pipeline flux --dtype bf16
+  python pipeline_snapshot.py bench G:/AIModels/.../stable-diffusion-v1-5 sd15.snapshot.safetensors --repeats 3
+
+bench prints each side's dtype and weight size next to its timings. from_pretrained
+loads fp32 on CPU, so compare against a --dtype fp32 snapshot there; an fp16 snapshot
+reads half the bytes and its speedup is not like for like.
+
+Loading is cheap because the modules are built on the meta device and then assigned
+tensors that point straight into the mapped file; pages are read lazily by the OS and
+shared between processes that map the same snapshot.
+"""
+import argparse
+import base64
+import importlib
+import inspect
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+
+import torch
+
+from perf_utils import format_table
+from pipeline_registry import pipeline_nbytes
+
+SNAPSHOT_FORMAT = "t2i-snapshot-v1"
+SNAPSHOT_SUFFIX = ".snapshot.safetensors"
+METADATA_KEY = "t2i_snapshot"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+CLI_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def is_snapshot(path: str) -> bool:
+    """True for bundles written by write_snapshot(); plain single-file checkpoints lack the metadata key."""
+    if not (os.path.isfile(path) and path.endswith(".safetensors")):
+        return False
+    try:
+        header, _ = read_header(path)
+    except (OSError, ValueError, struct.error):
+        return False
+    return isinstance(header, dict) and METADATA_KEY in (header.get("__metadata__") or {})
+
+
+def _module_config(module) -> dict:
+    config = getattr(module, "config", None)
+    if config is None:
+        raise ValueError(f"{type(module).__name__} has no config; cannot snapshot it")
+    if hasattr(config, "to_dict"):
+        return config.to_dict()
+    return dict(config)
+
+
+def _saved_files(component) -> Dict[str, str]:
+    """save_pretrained() a non-module component and return its files base64-encoded."""
+    files = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        component.save_pretrained(tmp)
+        for root, _, names in os.walk(tmp):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, tmp).replace(os.sep, "/")] = base64.b64encode(f.read()).decode("ascii")
+    return files
+
+
+def write_snapshot(pipe, out_path: str, dtype: Optional[torch.dtype] = None, source: str = "") -> str:
+    """Serialize pipe into a single safetensors file; floating weights are converted to dtype."""
+    from safetensors.torch import save_file
+
+    tensors = {}
+    seen_ptrs = set()
+    components = {}
+    for name, comp in pipe.components.items():
+        if comp is None:
+            components[name] = None
+            continue
+        entry = {"class": type(comp).__name__, "module": type(comp).__module__}
+        if isinstance(comp, torch.nn.Module):
+            entry["kind"] = "module"
+            entry["config"] = _module_config(comp)
+            for key, t in comp.state_dict().items():
+                t = t.detach().to("cpu")
+                if dtype is not None and t.is_floating_point():
+                    t = t.to(dtype)
+                # safetensors refuses aliased storage (tied weights), so copy repeats
+                if t.data_ptr() in seen_ptrs:
+                    t = t.clone()
+                seen_ptrs.add(t.data_ptr())
+                tensors[f"{name}/{key}"] = t.contiguous()
+        else:
+            entry["kind"] = "files"
+            entry["files"] = _saved_files(comp)
+        components[name] = entry
+
+    extra_config = {
+        k: v for k, v in dict(pipe.config).items()
+        if not k.startswith("_") and k not in pipe.components
+    }
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "pipeline_class": type(pipe).__name__,
+        "pipeline_config": extra_config,
+        "components": components,
+        "dtype": str(dtype) if dtype is not None else None,
+        "source": source,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)) or ".", exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    save_file(tensors, tmp_path, metadata={METADATA_KEY: json.dumps(meta, ensure_ascii=False)})
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def read_header(path: str):
+    """Return (header dict, byte offset of the tensor data) of a safetensors file."""
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    return header, 8 + header_len
+
+
+def read_snapshot_metadata(path: str) -> dict:
+    header, _ = read_header(path)
+    raw = (header.get("__metadata__") or {}).get(METADATA_KEY)
+    if raw is None:
+        raise ValueError(f"{path} is a safetensors file but not a pipeline snapshot")
+    meta = json.loads(raw)
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format: {meta.get('format')}")
+    return meta
+
+
+def mmap_tensors(path: str) -> Dict[str, torch.Tensor]:
+    """Map the whole file once (private, copy-on-write) and view every tensor into it."""
+    header, data_start = read_header(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    tensors = {}
+    fallback = []
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, _ = info["data_offsets"]
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        offset = data_start + begin
+        if offset % itemsize:
+            fallback.append(name)
+            continue
+        t = torch.empty(0, dtype=dtype)
+        t.set_(storage, offset // itemsize, tuple(info["shape"]))
+        tensors[name] = t
+    if fallback:
+        # Misaligned entries (should not happen for files written here) are read normally
+        from safetensors import safe_open
+        with safe_open(path, framework="pt") as f:
+            for name in fallback:
+                tensors[name] = f.get_tensor(name)
+    return tensors
+
+
+def _build_module(entry: dict, state: Dict[str, torch.Tensor]):
+    from accelerate import init_empty_weights
+    from diffusers import ModelMixin
+
+    cls = getattr(importlib.import_module(entry["module"]), entry["class"])
+    with init_empty_weights():
+        if issubclass(cls, ModelMixin):
+            model = cls.from_config(entry["config"])
+        else:
+            # transformers models (text encoders, safety checker)
+            model = cls(cls.config_class.from_dict(entry["config"]))
+    model.load_state_dict(state, strict=False, assign=True)
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    still_meta = [n for n, p in model.named_parameters() if p.device.type == "meta"]
+    if still_meta:
+        raise ValueError(f"{entry['class']}: snapshot is missing weights for {still_meta[:5]}")
+    return model.eval()
+
+
+def _build_from_files(entry: dict, tmp_root: str, name: str):
+    cls = getattr(importlib.import_module(entry["module"]), entry["class"])
+    comp_dir = os.path.join(tmp_root, name)
+    for rel, data in entry["files"].items():
+        path = os.path.join(comp_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(data))
+    return cls.from_pretrained(comp_dir)
+
+
+def load_snapshot(path: str, device: Optional[torch.device] = None):
+    """Rebuild a pipeline from a snapshot file; CPU weights stay backed by the mapping."""
+    import diffusers
+
+    meta = read_snapshot_metadata(path)
+    if (device is None or device.type == "cpu") and meta.get("dtype") == str(torch.float16):
+        print("Warning: fp16 snapshot loaded on CPU; write the snapshot with --dtype fp32 or bf16 for CPU workers.")
+    tensors = mmap_tensors(path)
+    by_component: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, t in tensors.items():
+        comp, _, param = key.partition("/")
+        by_component.setdefault(comp, {})[param] = t
+
+    components = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, entry in meta["components"].items():
+            if entry is None:
+                components[name] = None
+            elif entry["kind"] == "module":
+                components[name] = _build_module(entry, by_component.get(name, {}))
+            else:
+                components[name] = _build_from_files(entry, tmp, name)
+
+    pipeline_cls = getattr(diffusers, meta["pipeline_class"])
+    accepted = inspect.signature(pipeline_cls.__init__).parameters
+    kwargs = {k: v for k, v in meta.get("pipeline_config", {}).items() if k in accepted}
+    kwargs.update(components)
+    pipe = pipeline_cls(**kwargs)
+    # Like from_pretrained: name_or_path identifies the weights (embedding cache, result keys)
+    pipe.register_to_config(_name_or_path=os.path.abspath(path))
+    if device is not None and device.type != "cpu":
+        pipe = pipe.to(device)
+    return pipe
+
+
+def snapshot_model(model_dir: str, out_path: str, pipeline: str, dtype: Optional[torch.dtype], trust_remote_code: bool) -> str:
+    """Load model_dir with the matching script loader on CPU and write its snapshot."""
+    cpu = torch.device("cpu")
+    if pipeline == "flux":
+        import local_flux_text2img as flux
+        pipe = flux.load_flux_pipeline(model_dir, cpu, trust_remote_code)
+    else:
+        import local_sd_v1_5_text2img as sd
+        pipe = sd.load_pipeline(model_dir, cpu, trust_remote_code, lowvram=False)
+    return write_snapshot(pipe, out_path, dtype=dtype, source=os.path.abspath(model_dir))
+
+
+def _timed_load(loader: str, path: str, pipeline: str, device: torch.device) -> dict:
+    """Run one load in this (fresh) process and return timings; used by the benchmark."""
+    start = time.perf_counter()
+    if loader == "snapshot":
+        pipe = load_snapshot(path, device)
+    elif pipeline == "flux":
+        import local_flux_text2img as flux
+        pipe = flux.load_flux_pipeline(path, device, trust_remote_code=True)
+    else:
+        import local_sd_v1_5_text2img as sd
+        pipe = sd.load_pipeline(path, device, trust_remote_code=False, lowvram=False)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    load_s = time.perf_counter() - start
+    cpu_bytes, cuda_bytes = pipeline_nbytes(pipe)
+    main_module = getattr(pipe, "unet", None) or getattr(pipe, "transformer", None)
+    return {"loader": loader, "load_s": load_s, "pipeline_class": type(pipe).__name__,
+            "weights_mb": (cpu_bytes + cuda_bytes) / 2 ** 20, "dtype": str(getattr(main_module, "dtype", "?")).replace("torch.", "")}
+
+
+def bench_cold_start(model_dir: str, snapshot_path: str, pipeline: str, device: str, repeats: int) -> list:
+    """Time each loader in a fresh interpreter per run so nothing is warm in-process."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for loader, path in (("from_pretrained", model_dir), ("snapshot", snapshot_path)):
+        times = []
+        for _ in range(repeats):
+            cmd = [sys.executable, os.path.abspath(__file__), "_load", loader, path, "--pipeline", pipeline, "--device", device]
+            wall_start = time.perf_counter()
+            out = subprocess.run(cmd, cwd=here, capture_output=True, text=True)
+            wall = time.perf_counter() - wall_start
+            if out.returncode != 0:
+                print(out.stdout, out.stderr)
+                raise RuntimeError(f"{loader} load failed")
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            times.append((result["load_s"], wall))
+        runs.append({
+            "loader": loader,
+            "dtype": result["dtype"],
+            "weights_mb": result["weights_mb"],
+            "load_s_min": min(t[0] for t in times),
+            "load_s_mean": sum(t[0] for t in times) / len(times),
+            "process_s_mean": sum(t[1] for t in times) / len(times),
+        })
+    base = runs[0]["load_s_mean"]
+    for row in runs:
+        row["speedup"] = base / row["load_s_mean"] if row["load_s_mean"] else None
+    if runs[0]["dtype"] != runs[1]["dtype"]:
+        # e.g. an fp16 snapshot vs the fp32 CPU from_pretrained load: part of the speedup is just fewer bytes
+        print(f"Warning: from_pretrained loaded {runs[0]['dtype']} ({runs[0]['weights_mb']:.0f} MB) but the snapshot is "
+              f"{runs[1]['dtype']} ({runs[1]['weights_mb']:.0f} MB); the speedup is not like for like. "
+              f"Write the snapshot with --dtype matching the loader for a fair comparison.")
+    return runs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pipeline snapshots for fast cold start")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("snapshot", help="Write a snapshot bundle from a diffusers model directory")
+    p.add_argument("model", type=str)
+    p.add_argument("out", type=str, nargs="?", default="", help=f"Output file (default: <model>{SNAPSHOT_SUFFIX})")
+    p.add_argument("--pipeline", choices=["sd", "flux"], default="sd")
+    p.add_argument("--dtype", choices=list(CLI_DTYPES), default="fp16")
+    p.add_argument("--trust-remote-code", action="store_true")
+
+    b = sub.add_parser("bench", help="Compare cold-start time of from_pretrained vs snapshot loading")
+    b.add_argument("model", type=str)
+    b.add_argument("snapshot", type=str)
+    b.add_argument("--pipeline", choices=["sd", "flux"], default="sd")
+    b.add_argument("--device", type=str, default="cpu")
+    b.add_argument("--repeats", type=int, default=3)
+
+    l = sub.add_parser("_load", help=argparse.SUPPRESS)
+    l.add_argument("loader", choices=["from_pretrained", "snapshot"])
+    l.add_argument("path", type=str)
+    l.add_argument("--pipeline", choices=["sd", "flux"], default="sd")
+    l.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "snapshot":
+        out = args.out or os.path.abspath(args.model).rstrip("/\\") + SNAPSHOT_SUFFIX
+        start = time.perf_counter()
+        snapshot_model(args.model, out, args.pipeline, CLI_DTYPES[args.dtype], args.trust_remote_code)
+        print(f"Wrote snapshot {out} ({os.path.getsize(out) / 2 ** 30:.2f} GB) in {time.perf_counter() - start:.1f}s")
+    elif args.command == "bench":
+        rows = bench_cold_start(args.model, args.snapshot, args.pipeline, args.device, args.repeats)
+        print(format_table(rows, ["loader", "dtype", "weights_mb", "load_s_min", "load_s_mean", "process_s_mean", "speedup"]))
+    else:
+        print(json.dumps(_timed_load(args.loader, args.path, args.pipeline, torch.device(args.device))))
+
+
+if __name__ == "__main__":
+    main()
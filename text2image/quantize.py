@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+quantize.py
+
+Opt-in quantized loading for the local diffusion scripts (UNet / transformer and
+text encoders; the VAE stays in float since it is small and quality-sensitive).
+
+Modes:
+  none          float weights (fp16 on CUDA, fp32 on CPU)
+  dynamic-int8  torch.ao dynamic quantization of nn.Linear (int8 weights, activations
+                quantized per call); CPU only
+  int8-weight   torchao weight-only int8 (needs torchao)
+  int4-weight   torchao weight-only int4 (needs torchao; in practice CUDA + bf16 only)
+
+Quantized components are pickled to the cache directory
+(~/.cache/t2i_quantized/<model identity>/<device>-<dtype>-torch<ver>-torchao<ver>/
+<component>-<mode>.pt). Later loads pass them to from_pretrained so the float weights
+of those components are never read; a different device, dtype or library version
+never picks up another build's modules. A component that fails to quantize (int4
+outside CUDA + bf16, typically) stays in float and the load carries on; pipe._quantized
+is only set when at least one component was quantized (see applied_mode()).
+
+Like cpu_profile.py the mode is process-wide: scripts call set_quantization() from
+main(), loaders call cached_components() / quantize_pipeline().
+
+Benchmark (latency, peak RSS and similarity to the float output, one process per mode):
+  python quantize.py bench --model G:/AIModels/.../stable-diffusion-v1-5 --steps 20
+  python quantize.py bench --pipeline flux --model .../FLUX___1-dev --modes none,dynamic-int8,int8-weight
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from importlib import metadata
+from typing import Dict, Iterable, Optional
+
+import torch
+
+from perf_utils import MemoryTracker, StepTimer, format_table, image_similarity
+from result_cache import model_identity
+
+MODES = ("none", "dynamic-int8", "int8-weight", "int4-weight")
+COMPONENTS = ("unet", "transformer", "text_encoder", "text_encoder_2")
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "t2i_quantized")
+
+
+class QuantSettings:
+    def __init__(self):
+        self.mode = "none"
+        self.cache_dir = DEFAULT_CACHE_DIR
+
+
+SETTINGS = QuantSettings()
+
+
+def set_quantization(mode: str = "none", cache_dir: Optional[str] = None):
+    if mode not in MODES:
+        raise ValueError(f"Unknown quantization mode '{mode}', expected one of {MODES}")
+    SETTINGS.mode = mode
+    if cache_dir:
+        SETTINGS.cache_dir = cache_dir
+
+
+def _torchao():
+    try:
+        import torchao.quantization as tq  # type: ignore[import]
+        return tq
+    except (ImportError, ModuleNotFoundError):
+        return None
+
+
+def mode_supported(mode: str, device: torch.device) -> Optional[str]:
+    """None if mode can run on device, else the reason it cannot."""
+    if mode == "dynamic-int8" and device.type != "cpu":
+        return "dynamic int8 quantized kernels are CPU only"
+    if mode in ("int8-weight", "int4-weight") and _torchao() is None:
+        return "torchao is not installed (pip install torchao)"
+    return None
+
+
+def quantize_module(module: torch.nn.Module, mode: str) -> torch.nn.Module:
+    """Quantize one component in place (returned for convenience)."""
+    if mode == "dynamic-int8":
+        return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    tq = _torchao()
+    if mode == "int8-weight":
+        config = tq.Int8WeightOnlyConfig() if hasattr(tq, "Int8WeightOnlyConfig") else tq.int8_weight_only()
+    else:
+        config = tq.Int4WeightOnlyConfig() if hasattr(tq, "Int4WeightOnlyConfig") else tq.int4_weight_only()
+    tq.quantize_(module, config)
+    return module
+
+
+def default_dtype(device: torch.device) -> torch.dtype:
+    """The loaders' float dtype: fp16 on CUDA, fp32 on CPU."""
+    return torch.float16 if device.type == "cuda" else torch.float32
+
+
+def _module_dtype(module: torch.nn.Module, device: torch.device) -> torch.dtype:
+    for param in module.parameters():
+        if param.is_floating_point():
+            return param.dtype
+    return default_dtype(device)
+
+
+def _build_tag(device: torch.device, dtype: torch.dtype) -> str:
+    try:
+        torchao_version = metadata.version("torchao")
+    except metadata.PackageNotFoundError:
+        torchao_version = "none"
+    return f"{device.type}-{str(dtype).replace('torch.', '')}-torch{torch.__version__}-torchao{torchao_version}"
+
+
+def cache_path(model_id: str, component: str, mode: str, device: torch.device, dtype: Optional[torch.dtype] = None) -> str:
+    return os.path.join(SETTINGS.cache_dir, model_identity(model_id)[:16], _build_tag(device, dtype or default_dtype(device)),
+                        f"{component}-{mode}.pt")
+
+
+def cached_components(model_id: str, device: torch.device, dtype: Optional[torch.dtype] = None,
+                      components: Iterable[str] = COMPONENTS) -> Dict[str, torch.nn.Module]:
+    """Quantized components already on disk for the active mode, device and dtype, as from_pretrained kwargs."""
+    mode = SETTINGS.mode
+    if mode == "none" or mode_supported(mode, device) is not None:
+        return {}
+    found = {}
+    for name in components:
+        path = cache_path(model_id, name, mode, device, dtype)
+        if os.path.isfile(path):
+            try:
+                found[name] = torch.load(path, map_location=device, weights_only=False)
+            except Exception as e:
+                print(f"Warning: ignoring unreadable quantized cache {path}: {e}")
+    if found:
+        print(f"Loaded quantized ({mode}) components from cache: {', '.join(found)}")
+    return found
+
+
+def quantize_pipeline(pipe, model_id: Optional[str], device: torch.device, components: Iterable[str] = COMPONENTS):
+    """Quantize the pipeline's components for the active mode, caching new results on disk.
+
+    Components listed in pipe._quantized_components (set by loaders for the ones that
+    came from cached_components()) are left alone. model_id=None skips the disk cache
+    (e.g. snapshot bundles).
+    """
+    mode = SETTINGS.mode
+    if mode == "none":
+        return pipe
+    reason = mode_supported(mode, device)
+    if reason is not None:
+        print(f"Quantization '{mode}' skipped: {reason}.")
+        return pipe
+    done = set(getattr(pipe, "_quantized_components", ()))
+    for name in components:
+        module = getattr(pipe, name, None)
+        if not isinstance(module, torch.nn.Module) or name in done:
+            continue
+        path = cache_path(model_id, name, mode, device, _module_dtype(module, device)) if model_id else None
+        start = time.perf_counter()
+        try:
+            quantize_module(module, mode)
+        except Exception as e:
+            print(f"Warning: could not quantize {name} ({mode}), keeping float weights: {e}")
+            continue
+        print(f"Quantized {name} ({mode}) in {time.perf_counter() - start:.1f}s")
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            torch.save(module, tmp_path)
+            os.replace(tmp_path, path)
+        done.add(name)
+    if not done:
+        print(f"WARNING: --quantize {mode} requested but no component could be quantized; running with float weights.")
+        return pipe
+    pipe._quantized = mode
+    pipe._quantized_components = tuple(sorted(done))
+    return pipe
+
+
+def applied_mode(pipe=None) -> str:
+    """Quantization a loaded pipeline really runs with; the requested mode when nothing is loaded yet."""
+    if pipe is None:
+        return SETTINGS.mode
+    return getattr(pipe, "_quantized", "none")
+
+
+def _load(pipeline: str, model: str, device: torch.device):
+    if pipeline == "flux":
+        import local_flux_text2img as script
+        return script.load_flux_pipeline(model, device, trust_remote_code=True)
+    if pipeline == "text2img":
+        import local_text2img as script
+        return script.load_pipeline(model, device)
+    import local_sd_v1_5_text2img as script
+    return script.load_pipeline(model, device, trust_remote_code=False, lowvram=False)
+
+
+def _bench_once(pipeline: str, model: str, mode: str, steps: int, size: int, seed: int, out_path: str) -> dict:
+    """Load with the given mode, time one generation and save its image (runs in a fresh process)."""
+    set_quantization(mode)
+    device = torch.device("cpu")
+    with MemoryTracker(device) as mem:
+        start = time.perf_counter()
+        pipe = _load(pipeline, model, device)
+        load_s = time.perf_counter() - start
+        if hasattr(pipe, "set_progress_bar_config"):
+            pipe.set_progress_bar_config(disable=True)
+        prompt = "a lighthouse on a cliff at sunset, detailed"
+        timer = StepTimer()
+        start = time.perf_counter()
+        timer.start()
+        image = pipe(prompt=prompt, height=size, width=size, num_inference_steps=steps,
+                     generator=torch.Generator().manual_seed(seed), callback_on_step_end=timer).images[0]
+        latency_s = time.perf_counter() - start
+    image.save(out_path)
+    return {"mode": mode, "load_s": load_s, "latency_s": latency_s, "s_per_step": timer.mean_step_s,
+            "peak_rss_mb": mem.peak_mb, "out": out_path}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quantized loading: prebuild cache / benchmark against float")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("bench", "_run", "build"):
+        help_text = {"bench": "Compare modes (latency, RSS, similarity to float)", "build": "Quantize and cache components once"}
+        p = sub.add_parser(name, help=help_text.get(name, argparse.SUPPRESS))
+        p.add_argument("--model", type=str, required=True)
+        p.add_argument("--pipeline", choices=["sd", "text2img", "flux"], default="sd")
+        p.add_argument("--cache-dir", type=str, default="")
+        if name == "bench":
+            p.add_argument("--modes", type=str, default="none,dynamic-int8,int8-weight")
+        else:
+            p.add_argument("--mode", choices=MODES, default="dynamic-int8")
+        if name != "build":
+            p.add_argument("--steps", type=int, default=20)
+            p.add_argument("--size", type=int, default=512)
+            p.add_argument("--seed", type=int, default=0)
+            p.add_argument("--out-dir", type=str, default="quant_bench")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.cache_dir:
+        SETTINGS.cache_dir = args.cache_dir
+    if args.command == "build":
+        set_quantization(args.mode, args.cache_dir or None)
+        _load(args.pipeline, args.model, torch.device("cpu"))
+        print(f"Quantized components cached under {os.path.dirname(cache_path(args.model, 'unet', args.mode, torch.device('cpu')))}")
+        return
+    if args.command == "_run":
+        out_path = os.path.join(args.out_dir, f"{args.mode}.png")
+        print(json.dumps(_bench_once(args.pipeline, args.model, args.mode, args.steps, args.size, args.seed, out_path)))
+        return
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    if "none" not in modes:
+        modes.insert(0, "none")
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for mode in modes:
+        reason = mode_supported(mode, torch.device("cpu"))
+        if reason is not None:
+            print(f"Skipping {mode}: {reason}")
+            continue
+        # Quantized kernels, thread pools and RSS are process-wide, so each mode gets its own process;
+        # the first run of a mode also builds its cache, so run the bench twice for warm-cache load times
+        cmd = [sys.executable, os.path.abspath(__file__), "_run", "--model", args.model, "--pipeline", args.pipeline,
+               "--mode", mode, "--steps", str(args.steps), "--size", str(args.size), "--seed", str(args.seed),
+               "--out-dir", os.path.abspath(args.out_dir)]
+        if args.cache_dir:
+            cmd += ["--cache-dir", args.cache_dir]
+        out = subprocess.run(cmd, cwd=here, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(out.stdout, out.stderr)
+            print(f"Benchmark run for mode '{mode}' failed")
+            continue
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    base = next((r for r in rows if r["mode"] == "none"), None)
+    for row in rows:
+        if base is not None:
+            row.update(image_similarity(base["out"], row["out"]))
+            row["speedup"] = base["latency_s"] / row["latency_s"] if row["latency_s"] else None
+    print(format_table(rows, ["mode", "load_s", "latency_s", "s_per_step", "speedup", "peak_rss_mb", "psnr_db", "cosine"]))
+    with open(os.path.join(args.out_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
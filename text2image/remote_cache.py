@@ -0,0 +1,118 @@
+"""
+remote_cache.py
+
+Persistent cache of paid remote (DashScope) generations, shared by the image and
+video scripts.
+
+Entries are keyed on a normalized request fingerprint: API endpoint, kind (image /
+video), model, prompt with whitespace collapsed, size written as W*H, seed, negative
+prompt and any other output-affecting parameters, plus the index of the result within
+a request (so asking for 3 images of one prompt caches 3 distinct entries). Storage, LRU size cap
+and TTL come from result_cache.ResultCache; each entry's metadata also keeps the
+fingerprint, task id and source URL.
+
+Only requests with an explicit seed are cached by default: without one, asking again
+means asking for a new random sample. Set DASHSCOPE_CACHE_UNSEEDED=1 to cache unseeded
+requests as well. Pass the scripts' bypass flag (--no-cache, or use_cache=False) to
+force a fresh generation; its result replaces the cached one.
+
+Only results of the public endpoint are cached: scripts call use_endpoint(base_url,
+mock), which turns REMOTE_CACHE off for --mock runs and any other --base-url, so
+stand-in outputs never end up under real fingerprints.
+
+Environment: DASHSCOPE_CACHE_DIR, DASHSCOPE_CACHE_GB (default 5, 0 disables),
+DASHSCOPE_CACHE_TTL_HOURS (default 720), DASHSCOPE_CACHE_UNSEEDED (default 0).
+"""
+import os
+from typing import Optional
+
+from result_cache import ResultCache, result_key
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dashscope_results")
+DEFAULT_ENDPOINT = "https://dashscope.aliyuncs.com/api/v1"
+
+
+def normalize_size(size: Optional[str]) -> Optional[str]:
+    if not size:
+        return None
+    for sep in ("x", "X", "×", ","):
+        size = size.replace(sep, "*")
+    return "*".join(part.strip() for part in size.split("*"))
+
+
+def normalize_endpoint(url: Optional[str]) -> str:
+    return (url or DEFAULT_ENDPOINT).strip().rstrip("/").lower()
+
+
+def fingerprint(kind: str, model: str, prompt: str, size: Optional[str] = None, seed: Optional[int] = None,
+                negative_prompt: Optional[str] = None, index: int = 0, endpoint: Optional[str] = None, **params) -> dict:
+    """Canonical request description; equal fingerprints mean interchangeable results."""
+    negative_prompt = " ".join((negative_prompt or "").split()) or None
+    fp = {
+        "endpoint": normalize_endpoint(endpoint),
+        "kind": kind,
+        "model": model.strip().lower(),
+        "prompt": " ".join(prompt.split()),
+        "negative_prompt": negative_prompt,
+        "size": normalize_size(size),
+        "seed": int(seed) if seed is not None else None,
+        "index": index,
+    }
+    fp.update({k: v for k, v in params.items() if v is not None})
+    return fp
+
+
+class RemoteCache(ResultCache):
+    COUNTERS = ResultCache.COUNTERS + ("calls_avoided",)
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 0, ttl_s: float = 0.0, cache_unseeded: bool = False):
+        super().__init__(cache_dir, max_bytes, ttl_s)
+        self.cache_unseeded = cache_unseeded
+        self.calls_avoided = 0
+
+    def cacheable(self, fp: dict) -> bool:
+        return self.enabled and (fp.get("seed") is not None or self.cache_unseeded)
+
+    def lookup(self, fp: dict, out_path: str) -> Optional[str]:
+        """Copy a cached result to out_path (returns it) or None on a miss / when not cacheable."""
+        if not self.cacheable(fp):
+            return None
+        return self.fetch(result_key(**fp), out_path)
+
+    def contains(self, fp: dict) -> bool:
+        return self.cacheable(fp) and self._entry(result_key(**fp))[0] is not None
+
+    def store(self, fp: dict, path: str, **meta):
+        if self.cacheable(fp):
+            self.put(result_key(**fp), path, dict(meta, fingerprint=fp))
+
+    def avoided(self, calls: int = 1):
+        with self._lock:
+            self.calls_avoided += calls
+
+    def stats(self) -> dict:
+        return dict(super().stats(), calls_avoided=self.calls_avoided)
+
+    def save_stats(self) -> dict:
+        # A disabled cache (mock / custom endpoint run) leaves the persistent stats alone
+        return super().save_stats() if self.enabled else {}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+# Process-wide cache, enabled by default (set DASHSCOPE_CACHE_GB=0 to turn it off)
+REMOTE_CACHE = RemoteCache(cache_unseeded=os.getenv("DASHSCOPE_CACHE_UNSEEDED", "0") == "1")
+REMOTE_CACHE.configure(os.getenv("DASHSCOPE_CACHE_DIR") or None, _env_float("DASHSCOPE_CACHE_GB", 5.0),
+                       _env_float("DASHSCOPE_CACHE_TTL_HOURS", 720.0))
+
+
+def use_endpoint(base_url: Optional[str], mock: bool = False) -> bool:
+    """Disable REMOTE_CACHE unless requests go to the public endpoint; returns whether it is on."""
+    if mock or normalize_endpoint(base_url) != normalize_endpoint(DEFAULT_ENDPOINT):
+        REMOTE_CACHE.configure(max_gb=0)
+    return REMOTE_CACHE.enabled
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+result_cache.py
+
+Content-addressed on-disk cache of generated images.
+
+A seeded generation is fully determined by its inputs, so generate() looks up a
+SHA-256 of (model identity, scheduler, prompt, negative prompt, size, steps, scale,
+seed, dtype/device, output encoding, ...) before loading or running any model.
+A hit copies the stored file to the requested output path. Misses are added once
+the image has been written.
+
+Layout: <cache_dir>/<key[:2]>/<key>.<ext> plus <key>.json metadata. Recency is
+the file mtime (refreshed on every hit), which drives LRU eviction under the size
+cap. Entries older than the TTL are dropped on lookup. Hit/miss counters are kept
+for this process and accumulated in <cache_dir>/stats.json.
+
+Check that a seeded rerun in a new process is served from the cache (runs the SD
+script twice, each in its own process, with the given arguments):
+  python result_cache.py check --seed 7 --height 1024 --width 1024 --model G:/AIModels/.../stable-diffusion-v1-5
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "t2i_results")
+IDENTITY_FILES = ("model_index.json", "scheduler/scheduler_config.json", "unet/config.json")
+WEIGHT_EXTS = (".safetensors", ".bin", ".ckpt", ".pt")
+
+_identity_cache: Dict[str, str] = {}
+
+
+def model_identity(model: str) -> str:
+    """Stable identity of a model dir / snapshot file: configs plus weight sizes and mtimes.
+
+    Re-saving or replacing weights changes the identity, so stale results are never served.
+    Hub ids that are not local paths are used as-is.
+    """
+    path = os.path.abspath(model)
+    if path in _identity_cache:
+        return _identity_cache[path]
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        st = os.stat(path)
+        h.update(f"{path}|{st.st_size}|{int(st.st_mtime)}".encode())
+    elif os.path.isdir(path):
+        for rel in IDENTITY_FILES:
+            cfg = os.path.join(path, rel)
+            if os.path.isfile(cfg):
+                with open(cfg, "rb") as f:
+                    h.update(rel.encode() + f.read())
+        for root, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                if name.endswith(WEIGHT_EXTS):
+                    st = os.stat(os.path.join(root, name))
+                    h.update(f"{os.path.relpath(os.path.join(root, name), path)}|{st.st_size}|{int(st.st_mtime)}".encode())
+    else:
+        h.update(model.encode())
+    _identity_cache[path] = h.hexdigest()
+    return _identity_cache[path]
+
+
+def result_key(**params) -> str:
+    """SHA-256 over the canonical JSON of the generation parameters."""
+    blob = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    COUNTERS = ("hits", "misses", "evictions")
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 0, ttl_s: float = 0.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def configure(self, cache_dir: Optional[str] = None, max_gb: float = 2.0, ttl_hours: float = 0.0):
+        if cache_dir:
+            self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 2 ** 30)
+        self.ttl_s = ttl_hours * 3600.0
+
+    def _entry(self, key: str):
+        folder = os.path.join(self.cache_dir, key[:2])
+        meta_path = os.path.join(folder, f"{key}.json")
+        if not os.path.isfile(meta_path):
+            return None, None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        data_path = os.path.join(folder, key + meta.get("ext", ".png"))
+        if not os.path.isfile(data_path):
+            return None, None
+        return data_path, meta_path
+
+    def fetch(self, key: str, out_path: str) -> Optional[str]:
+        """Copy the cached result for key to out_path; returns out_path on a hit, else None."""
+        data_path, meta_path = self._entry(key)
+        if data_path is not None and self.ttl_s and time.time() - os.path.getmtime(meta_path) > self.ttl_s:
+            self._remove(data_path, meta_path)
+            data_path = None
+        if data_path is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)) or ".", exist_ok=True)
+        tmp_path = f"{out_path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(data_path, tmp_path)
+        os.replace(tmp_path, out_path)
+        # data mtime tracks recency for LRU; meta mtime tracks age for TTL
+        os.utime(data_path, None)
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += os.path.getsize(out_path)
+        return out_path
+
+    def put(self, key: str, src_path: str, meta: Optional[dict] = None):
+        """Store a written output under key, then evict down to the size cap."""
+        if not self.enabled or not os.path.isfile(src_path):
+            return
+        folder = os.path.join(self.cache_dir, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        ext = os.path.splitext(src_path)[1] or ".png"
+        data_path = os.path.join(folder, key + ext)
+        tmp_path = f"{data_path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, data_path)
+        record = dict(meta or {}, ext=ext, created=time.time(), bytes=os.path.getsize(data_path))
+        with open(os.path.join(folder, f"{key}.json"), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        self.evict()
+
+    def invalidate(self, key: str):
+        data_path, meta_path = self._entry(key)
+        if data_path is not None:
+            self._remove(data_path, meta_path)
+
+    def _remove(self, data_path: str, meta_path: str):
+        for path in (data_path, meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _scan(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for sub in os.listdir(self.cache_dir):
+            folder = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith(".json") or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(folder, name)
+                st = os.stat(path)
+                meta_path = os.path.join(folder, os.path.splitext(name)[0] + ".json")
+                entries.append((st.st_mtime, st.st_size, path, meta_path))
+        return entries
+
+    def evict(self):
+        """Remove expired entries, then least recently used ones until under max_bytes."""
+        entries = sorted(self._scan())
+        now = time.time()
+        total = sum(e[1] for e in entries)
+        for mtime, size, path, meta_path in entries:
+            expired = self.ttl_s and os.path.exists(meta_path) and now - os.path.getmtime(meta_path) > self.ttl_s
+            if not expired and total <= self.max_bytes:
+                continue
+            self._remove(path, meta_path)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        entries = self._scan()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size_mb": round(sum(e[1] for e in entries) / 2 ** 20, 1),
+        }
+
+    def save_stats(self) -> dict:
+        """Add this process's counters to <cache_dir>/stats.json and return the totals."""
+        path = os.path.join(self.cache_dir, "stats.json")
+        totals = {name: 0 for name in self.COUNTERS}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                totals.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        for name in self.COUNTERS:
+            totals[name] = totals.get(name, 0) + getattr(self, name)
+        lookups = totals["hits"] + totals["misses"]
+        totals["hit_rate"] = round(totals["hits"] / lookups, 3) if lookups else None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(totals, f)
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        return totals
+
+
+# Process-wide cache; disabled until a script calls RESULT_CACHE.configure()
+RESULT_CACHE = ResultCache()
+
+
+def check_cross_process_hit(script_args: List[str], script: str = "local_sd_v1_5_text2img.py") -> bool:
+    """Run a seeded generation twice in fresh processes; True if the second one is a cache hit."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = []
+        for run in range(2):
+            cmd = [sys.executable, os.path.join(here, script), *script_args, "--out", os.path.join(tmp, f"run{run}.png")]
+            out = subprocess.run(cmd, cwd=here, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(out.stdout, out.stderr)
+                raise RuntimeError(f"Generation run {run + 1} failed")
+            outputs.append(out.stdout)
+    if "Result cache hit" in outputs[0]:
+        print("Note: the first run was already served from the cache (entry left by an earlier run).")
+    return "Result cache hit" in outputs[1]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Result cache checks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    check = sub.add_parser("check", help="Verify a seeded rerun in a new process hits the cache; other arguments go to the SD script")
+    check.add_argument("--script", type=str, default="local_sd_v1_5_text2img.py")
+    return parser.parse_known_args()
+
+
+def main():
+    args, script_args = parse_args()
+    if "--seed" not in script_args:
+        raise SystemExit("check needs --seed: only seeded generations are cached")
+    if check_cross_process_hit(script_args, args.script):
+        print("OK: the second process was served from the result cache.")
+    else:
+        raise SystemExit("FAIL: the second process missed the result cache.")
+
+
+if __name__ == "__main__":
+    main()
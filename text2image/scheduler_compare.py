@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+scheduler_compare.py
+
+Shared-work scheduler comparison for Stable Diffusion pipelines.
+
+The prompt is encoded once and every scheduler starts from the same initial
+latents. In "batched" mode all schedulers are denoised together as one latent
+batch: each step runs a single UNet call with per-sample timesteps and then lets
+every scheduler step its own slice. "sequential" mode runs one pipeline call per
+scheduler but still reuses the embeddings and the initial noise.
+"""
+import inspect
+from typing import List, Optional, Sequence
+
+import torch
+
+from deferred_safety import save_checked
+from perf_utils import MemoryTracker, Timer, format_table
+
+SCHEDULER_CLASSES = {
+    "dpmsolver": "DPMSolverMultistepScheduler",
+    "euler": "EulerAncestralDiscreteScheduler",
+    "ddim": "DDIMScheduler",
+}
+
+REPORT_COLUMNS = ["scheduler", "mode", "wall_s", "steps_per_s", "peak_mem_mb", "out"]
+
+
+def make_scheduler(name: str, base_config):
+    """Build a scheduler by short name (dpmsolver/euler/ddim) from the pipeline's scheduler config."""
+    import diffusers
+
+    cls_name = SCHEDULER_CLASSES.get(name.lower())
+    if cls_name is None:
+        raise ValueError(f"Unknown scheduler '{name}', expected one of: default, {', '.join(SCHEDULER_CLASSES)}")
+    return getattr(diffusers, cls_name).from_config(base_config)
+
+
+def initial_latents(pipe, height: int, width: int, seed: Optional[int], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Sample one unscaled initial latent (schedulers apply init_noise_sigma themselves)."""
+    vae_scale = getattr(pipe, "vae_scale_factor", 8)
+    shape = (1, pipe.unet.config.in_channels, height // vae_scale, width // vae_scale)
+    gen = torch.Generator(device=device)
+    if seed is None:
+        gen.seed()
+    else:
+        gen.manual_seed(seed)
+    return torch.randn(shape, generator=gen, device=device, dtype=dtype)
+
+
+def batched_fits(device: torch.device, n_schedulers: int, height: int, width: int, do_cfg: bool) -> bool:
+    """Rough check that one latent batch of all schedulers fits in free device memory."""
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return True
+    try:
+        free, _ = torch.cuda.mem_get_info(device)
+    except Exception:
+        return False
+    # ~0.6 GB of fp16 UNet activations per 512x512 sample per CFG branch, plus VAE decode headroom
+    need_gb = 0.6 * n_schedulers * (2 if do_cfg else 1) * (height * width) / (512 * 512) + 0.5
+    return free / 2 ** 30 > need_gb
+
+
+def _step_kwargs(scheduler, generator) -> dict:
+    if "generator" in inspect.signature(scheduler.step).parameters:
+        return {"generator": generator}
+    return {}
+
+
+def _make_generator(device: torch.device, seed: Optional[int]):
+    gen = torch.Generator(device=device)
+    if seed is None:
+        gen.seed()
+    else:
+        gen.manual_seed(seed)
+    return gen
+
+
+@torch.no_grad()
+def _decode(pipe, latents: torch.Tensor, device: torch.device, dtype: torch.dtype):
+    image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    has_nsfw = None
+    if getattr(pipe, "safety_checker", None) is not None and hasattr(pipe, "run_safety_checker"):
+        image, has_nsfw = pipe.run_safety_checker(image, device, dtype)
+    do_denormalize = [True] * image.shape[0] if has_nsfw is None else [not x for x in has_nsfw]
+    return pipe.image_processor.postprocess(image, output_type="pil", do_denormalize=do_denormalize)
+
+
+@torch.no_grad()
+def run_batched(pipe, names: Sequence[str], prompt_embeds, negative_embeds, latents, steps: int, scale: float, device: torch.device, seed: Optional[int]):
+    """Denoise all schedulers as one latent batch. Returns (images, wall_seconds, peak_mb)."""
+    base_config = pipe.scheduler.config
+    schedulers = [make_scheduler(n, base_config) for n in names]
+    for sched in schedulers:
+        sched.set_timesteps(steps, device=device)
+    if len({len(s.timesteps) for s in schedulers}) != 1:
+        raise ValueError("schedulers produced different numbers of timesteps")
+
+    do_cfg = negative_embeds is not None
+    n = len(schedulers)
+    text = torch.cat([negative_embeds] * n + [prompt_embeds] * n) if do_cfg else torch.cat([prompt_embeds] * n)
+    lats = [latents.clone() * s.init_noise_sigma for s in schedulers]
+    gens = [_make_generator(device, seed) for _ in schedulers]
+
+    with MemoryTracker(device) as mem, Timer(device) as timer:
+        for i in range(len(schedulers[0].timesteps)):
+            ts = [s.timesteps[i] for s in schedulers]
+            model_in = torch.cat([s.scale_model_input(l, t) for s, l, t in zip(schedulers, lats, ts)])
+            t_batch = torch.stack([torch.as_tensor(t, device=device) for t in ts])
+            if do_cfg:
+                model_in = torch.cat([model_in, model_in])
+                t_batch = torch.cat([t_batch, t_batch])
+            noise = pipe.unet(model_in, t_batch, encoder_hidden_states=text, return_dict=False)[0]
+            if do_cfg:
+                uncond, cond = noise.chunk(2)
+                noise = uncond + scale * (cond - uncond)
+            lats = [
+                s.step(noise[j:j + 1], ts[j], lats[j], **_step_kwargs(s, gens[j]), return_dict=False)[0]
+                for j, s in enumerate(schedulers)
+            ]
+        images = _decode(pipe, torch.cat(lats), device, prompt_embeds.dtype)
+    return images, timer.seconds, mem.peak_mb
+
+
+@torch.no_grad()
+def run_sequential(pipe, name: str, prompt_embeds, negative_embeds, latents, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int]):
+    """One pipeline call with a given scheduler. Returns (image, wall_seconds, peak_mb)."""
+    original = pipe.scheduler
+    pipe.scheduler = make_scheduler(name, original.config)
+    try:
+        with MemoryTracker(device) as mem, Timer(device) as timer:
+            res = pipe(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds, latents=latents.clone(),
+                       height=height, width=width, num_inference_steps=steps, guidance_scale=scale,
+                       generator=_make_generator(device, seed))
+    finally:
+        pipe.scheduler = original
+    return res.images[0], timer.seconds, mem.peak_mb
+
+
+def compare_schedulers(pipe, prompt_embeds, negative_embeds, out_path_base: str, height: int, width: int, steps: int, scale: float, device: torch.device, seed: Optional[int], names: Sequence[str] = ("dpmsolver", "euler", "ddim"), mode: str = "auto"):
+    """Run every scheduler from identical embeddings/latents, save images and print a timing table.
+
+    mode is "sequential", "batched" or "auto" (batched when it is expected to fit in memory,
+    falling back to sequential on OOM or mismatched timestep counts).
+    Returns (output paths, report rows).
+    """
+    latents = initial_latents(pipe, height, width, seed, device, prompt_embeds.dtype)
+    rows: List[dict] = []
+    outputs: List[str] = []
+
+    if mode == "auto":
+        mode = "batched" if batched_fits(device, len(names), height, width, negative_embeds is not None) else "sequential"
+    if mode == "batched":
+        try:
+            images, wall, peak = run_batched(pipe, names, prompt_embeds, negative_embeds, latents, steps, scale, device, seed)
+        except (RuntimeError, ValueError) as e:
+            print(f"Batched scheduler comparison failed ({e}); falling back to sequential runs.")
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            mode = "sequential"
+        else:
+            for name, img in zip(names, images):
+                out_path = save_checked(pipe, img, f"{out_path_base}_{name}.png")
+                outputs.append(out_path)
+                # UNet passes are shared, so every scheduler reports the batch wall time
+                rows.append({"scheduler": name, "mode": f"batched x{len(names)}", "wall_s": wall,
+                             "steps_per_s": steps / wall if wall else None, "peak_mem_mb": peak, "out": out_path})
+
+    if mode == "sequential":
+        for name in names:
+            try:
+                img, wall, peak = run_sequential(pipe, name, prompt_embeds, negative_embeds, latents, height, width, steps, scale, device, seed)
+            except Exception as e:
+                print(f"{name} generation failed:", e)
+                continue
+            out_path = save_checked(pipe, img, f"{out_path_base}_{name}.png")
+            outputs.append(out_path)
+            rows.append({"scheduler": name, "mode": "sequential", "wall_s": wall,
+                         "steps_per_s": steps / wall if wall else None, "peak_mem_mb": peak, "out": out_path})
+
+    print(format_table(rows, REPORT_COLUMNS))
+    return outputs, rows
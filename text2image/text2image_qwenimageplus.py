@@ -1,15 +1,37 @@
 import dashscope
 from dashscope import ImageSynthesis
-import requests
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, filedialog
+from tkinter import scrolledtext, messagebox, filedialog, ttk
 
-def generate_with_qwen_imageplus(prompt, save_path="qwen_image.png", api_key = None):
+from downloader import download
+from remote_cache import REMOTE_CACHE, fingerprint, use_endpoint
+
+# 只缓存公共 API 的结果（自定义 DASHSCOPE_HTTP_BASE_URL 时关闭缓存）
+use_endpoint(dashscope.base_http_api_url)
+
+def generate_with_qwen_imageplus(prompt, save_path="qwen_image.png", api_key = None, cancel_event=None, poll_interval=1.0, use_cache=True, seed=None):
     """
     use qwen image_plus to generate image
+
+    With a seed, results are kept in the shared remote cache (remote_cache.py): an identical
+    request is copied from disk without calling the API. use_cache=False forces a new
+    generation. Without a seed every call is a new random sample.
+
+    With cancel_event (threading.Event) the task is submitted asynchronously and polled,
+    so setting the event cancels it (returns False) instead of waiting for the result.
     """
+    model, size = "qwen-image", "1328*1328"
+    fp = fingerprint("image", model, prompt, size=size, seed=seed, endpoint=dashscope.base_http_api_url)
+    if use_cache and REMOTE_CACHE.lookup(fp, save_path):
+        REMOTE_CACHE.avoided()
+        print(f"image saved:path ={save_path} (缓存命中，未调用api)")
+        return True
+
     # set api key
     if api_key:
         dashscope.api_key = api_key
@@ -20,24 +42,45 @@ def generate_with_qwen_imageplus(prompt, save_path="qwen_image.png", api_key = N
         raise ValueError("please provide dashscope api key.")
 
     try:
-        # 调用api
-        response = ImageSynthesis.call(
+        call_kwargs = dict(
             # 测试发现 模型的名称可以到阿里百炼模型服务中查看；
             # qwen-image-plus 比ImageSynthesis.Models.wanx_v1好多了
             # qwen-image-plus（image2025-10-13-13-39.png）和qwen-image（image2025-10-13-13-41.png）效果差不多
             # model="qwen-image-plus",
-            model="qwen-image",
+            model=model,
             #ImageSynthesis.Models.wanx_v1,
             prompt=prompt,
             n=1,
-            size="1328*1328"
+            size=size,
+            api_key=dashscope.api_key,
         )
+        if seed is not None:
+            call_kwargs["seed"] = seed
+        if cancel_event is None:
+            # 调用api
+            response = ImageSynthesis.call(**call_kwargs)
+        else:
+            # 异步提交后轮询，期间可随时取消
+            task = ImageSynthesis.async_call(**call_kwargs)
+            if task.status_code != 200:
+                print(f"{task} 提交失败.")
+                return False
+            while True:
+                if cancel_event.wait(poll_interval):
+                    try:
+                        ImageSynthesis.cancel(task, api_key=dashscope.api_key)
+                    except Exception:
+                        pass  # 已开始运行的任务无法取消，结果直接丢弃
+                    return False
+                response = ImageSynthesis.fetch(task, api_key=dashscope.api_key)
+                if response.status_code != 200 or response.output.task_status in ("SUCCEEDED", "FAILED", "CANCELED", "UNKNOWN"):
+                    break
         if response.status_code == 200 and response.output.results:     
             image_url = response.output.results[0].url
-            image_response = requests.get(image_url)
-            with open(save_path, "wb") as f:
-                f.write(image_response.content)
-            print(f"image saved:path ={save_path}")
+            # 流式写入临时文件后原子重命名，中断可续传
+            result = download(image_url, save_path)
+            print(f"image saved:path ={save_path} ({result})")
+            REMOTE_CACHE.store(fp, save_path, url=image_url, task_id=getattr(response.output, "task_id", None))
             return True
         else:
             print(f"{response} 生成失败或无结果.")
@@ -47,14 +90,98 @@ def generate_with_qwen_imageplus(prompt, save_path="qwen_image.png", api_key = N
         return False
 
 
+MAX_CONCURRENT_JOBS = int(os.getenv("QWEN_GUI_JOBS", "3"))
+THUMBNAIL_SIZE = 160
+STATUS_LABELS = {"queued": "排队中", "running": "生成中", "cancelling": "取消中", "done": "完成", "failed": "失败", "cancelled": "已取消"}
+
+
+class GenerationJob:
+    """One queued generation; status is written only by the worker thread, the Tk loop just reads it.
+
+    The Tk side cancels by setting cancel_event; "cancelling" is derived from it in display_status.
+    """
+
+    def __init__(self, job_id, prompt, save_path, use_cache=True, seed=None):
+        self.id = job_id
+        self.prompt = prompt
+        self.save_path = save_path
+        self.use_cache = use_cache
+        self.seed = seed
+        self.status = "queued"
+        self.error = None
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.thumbnail = None  # PIL thumbnail made in the worker; PhotoImage is created lazily on the Tk thread
+        self.photo = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def display_status(self):
+        if self.status in ("queued", "running") and self.cancel_event.is_set():
+            # A job cancelled before a worker picked it up never runs, so nothing else will update it
+            return "cancelled" if self.future is not None and self.future.cancelled() else "cancelling"
+        return self.status
+
+    def run(self, api_key):
+        if self.cancel_event.is_set():
+            self.status = "cancelled"
+            return
+        self.status, self.started = "running", time.monotonic()
+        try:
+            ok = generate_with_qwen_imageplus(self.prompt, self.save_path, api_key, cancel_event=self.cancel_event,
+                                             use_cache=self.use_cache, seed=self.seed)
+            # A result that finished downloading before the cancel landed is still a result
+            if ok:
+                self.thumbnail = load_thumbnail(self.save_path)
+                self.status = "done"
+            elif self.cancel_event.is_set():
+                self.status = "cancelled"
+            else:
+                self.status, self.error = "failed", "生成失败或无结果，详见控制台输出"
+        except Exception as e:
+            self.status, self.error = "failed", str(e)
+        finally:
+            self.finished = time.monotonic()
+
+
+def load_thumbnail(path, size=THUMBNAIL_SIZE):
+    """Decode and shrink the saved image off the Tk thread (None without Pillow)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(path) as img:
+            img.thumbnail((size, size))
+            return img.copy()
+    except OSError:
+        return None
+
+
 class ImageGeneratorGUI:
-    def __init__(self, root):
+    def __init__(self, root, max_jobs=MAX_CONCURRENT_JOBS):
         self.root = root
         self.root.title("Qwen Image Generator")
-        self.root.geometry("600x600")
-        
+        self.root.geometry("760x860")
+
+        # 后台线程池执行生成任务，界面线程只负责排队和刷新状态
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="qwen-job")
+        self.jobs = {}
+        self.job_counter = 0
+
         # Create UI elements
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.refresh_jobs()
         
     def create_widgets(self):
         # API Key frame
@@ -76,7 +203,7 @@ class ImageGeneratorGUI:
         prompt_label.pack(pady=(10, 5))
         
         # Prompt text area
-        self.prompt_text = scrolledtext.ScrolledText(self.root, width=70, height=15, wrap=tk.WORD)
+        self.prompt_text = scrolledtext.ScrolledText(self.root, width=80, height=8, wrap=tk.WORD)
         self.prompt_text.pack(pady=5)
         
         # Default prompt
@@ -91,18 +218,55 @@ class ImageGeneratorGUI:
         
         tk.Label(filename_frame, text="保存文件名:").pack(side=tk.LEFT)
         self.filename_entry = tk.Entry(filename_frame, width=30)
-        self.filename_entry.insert(0, "image" + datetime.now().strftime("%Y-%m-%d-%H-%M") + ".png")
+        self.filename_entry.insert(0, self.default_filename())
         self.filename_entry.pack(side=tk.LEFT, padx=(5, 0))
         
         # Browse button
         browse_button = tk.Button(filename_frame, text="浏览...", command=self.browse_file)
         browse_button.pack(side=tk.LEFT, padx=(5, 0))
         
+        # 填写种子时相同请求直接使用本地缓存；留空则每次都是新的随机结果
+        seed_frame = tk.Frame(self.root)
+        seed_frame.pack()
+        tk.Label(seed_frame, text="种子（留空为随机）:").pack(side=tk.LEFT)
+        self.seed_entry = tk.Entry(seed_frame, width=12)
+        self.seed_entry.pack(side=tk.LEFT, padx=(5, 10))
+        # 勾选后忽略本地缓存，强制重新调用api生成
+        self.bypass_cache = tk.BooleanVar(value=False)
+        tk.Checkbutton(seed_frame, text="忽略缓存，强制重新生成", variable=self.bypass_cache).pack(side=tk.LEFT)
+
         # Generate button
-        generate_button = tk.Button(self.root, text="生成图像", command=self.generate_image, 
+        generate_button = tk.Button(self.root, text=f"加入队列（最多同时 {self.max_jobs} 个）", command=self.generate_image,
                                   bg="#4CAF50", fg="white", font=("Arial", 12, "bold"),
                                   padx=20, pady=10)
-        generate_button.pack(pady=20)
+        generate_button.pack(pady=10)
+
+        # Job list
+        jobs_frame = tk.Frame(self.root)
+        jobs_frame.pack(fill=tk.BOTH, expand=True, padx=20)
+        columns = ("status", "elapsed", "file", "prompt")
+        self.job_list = ttk.Treeview(jobs_frame, columns=columns, show="headings", height=8, selectmode="browse")
+        for col, title, width in zip(columns, ("状态", "耗时", "文件", "提示词"), (70, 60, 200, 360)):
+            self.job_list.heading(col, text=title)
+            self.job_list.column(col, width=width, anchor=tk.W, stretch=col == "prompt")
+        scrollbar = tk.Scrollbar(jobs_frame, orient=tk.VERTICAL, command=self.job_list.yview)
+        self.job_list.configure(yscrollcommand=scrollbar.set)
+        self.job_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.job_list.bind("<<TreeviewSelect>>", lambda event: self.show_preview())
+
+        buttons_frame = tk.Frame(self.root)
+        buttons_frame.pack(pady=5)
+        tk.Button(buttons_frame, text="取消所选", command=self.cancel_selected).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons_frame, text="清除已结束", command=self.clear_finished).pack(side=tk.LEFT, padx=5)
+
+        # Preview of the selected job
+        self.preview_label = tk.Label(self.root, text="选中已完成的任务以预览", compound=tk.CENTER)
+        self.preview_label.pack(pady=(5, 10))
+
+    @staticmethod
+    def default_filename():
+        return "image" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".png"
         
     def browse_file(self):
         filename = filedialog.asksaveasfilename(defaultextension=".png",
@@ -128,21 +292,87 @@ class ImageGeneratorGUI:
         if not save_path:
             messagebox.showerror("错误", "请输入保存文件名!")
             return
-            
-        # Show generating message
-        self.root.config(cursor="wait")
-        self.root.update()
-        
-        try:
-            success = generate_with_qwen_imageplus(prompt, save_path, api_key)
-            if success:
-                messagebox.showinfo("成功", f"图像已生成并保存至: {save_path}")
+
+        seed_text = self.seed_entry.get().strip()
+        if seed_text and not seed_text.isdigit():
+            messagebox.showerror("错误", "种子必须是非负整数!")
+            return
+        seed = int(seed_text) if seed_text else None
+
+        # 同名文件已存在或已在队列中时自动加序号，避免并发任务互相覆盖
+        taken = {job.save_path for job in self.jobs.values()}
+        root_name, ext = os.path.splitext(save_path)
+        suffix = 1
+        while save_path in taken or os.path.exists(save_path):
+            save_path = f"{root_name}_{suffix}{ext or '.png'}"
+            suffix += 1
+
+        self.job_counter += 1
+        job = GenerationJob(self.job_counter, prompt, save_path, use_cache=not self.bypass_cache.get(), seed=seed)
+        self.jobs[job.id] = job
+        job.future = self.executor.submit(job.run, api_key)
+        self.job_list.insert("", tk.END, iid=str(job.id), values=self.row_values(job))
+
+        self.filename_entry.delete(0, tk.END)
+        self.filename_entry.insert(0, self.default_filename())
+
+    @staticmethod
+    def row_values(job):
+        status = STATUS_LABELS[job.display_status] + (f": {job.error}" if job.error else "")
+        return (status, f"{job.elapsed:.0f}s", os.path.basename(job.save_path), job.prompt.replace("\n", " ")[:80])
+
+    def refresh_jobs(self):
+        # Tk 只能在主线程更新，定时读取后台任务状态
+        for job in self.jobs.values():
+            iid = str(job.id)
+            if self.job_list.exists(iid):
+                self.job_list.item(iid, values=self.row_values(job))
+        self.root.after(500, self.refresh_jobs)
+
+    def selected_job(self):
+        selection = self.job_list.selection()
+        return self.jobs.get(int(selection[0])) if selection else None
+
+    def cancel_selected(self):
+        job = self.selected_job()
+        if job is None or job.display_status not in ("queued", "running"):
+            return
+        job.cancel_event.set()
+        job.future.cancel()
+
+    def clear_finished(self):
+        for job_id, job in list(self.jobs.items()):
+            if job.display_status in ("done", "failed", "cancelled"):
+                self.job_list.delete(str(job_id))
+                del self.jobs[job_id]
+        self.show_preview()
+
+    def show_preview(self):
+        job = self.selected_job()
+        if job is None or job.status != "done":
+            self.preview_label.config(image="", text="选中已完成的任务以预览")
+            return
+        if job.photo is None:
+            if job.thumbnail is not None:
+                from PIL import ImageTk
+                job.photo = ImageTk.PhotoImage(job.thumbnail)
             else:
-                messagebox.showerror("失败", "图像生成失败，请检查控制台输出获取更多信息。")
-        except Exception as e:
-            messagebox.showerror("错误", f"发生异常: {str(e)}")
-        finally:
-            self.root.config(cursor="")
+                # 没有 Pillow 时用 Tk 自带的 PNG 解码，按比例缩小
+                try:
+                    photo = tk.PhotoImage(file=job.save_path)
+                    factor = max(1, -(-max(photo.width(), photo.height()) // THUMBNAIL_SIZE))
+                    job.photo = photo.subsample(factor)
+                except tk.TclError:
+                    self.preview_label.config(image="", text="无法预览")
+                    return
+        self.preview_label.config(image=job.photo, text="")
+
+    def on_close(self):
+        for job in self.jobs.values():
+            job.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        REMOTE_CACHE.save_stats()
+        self.root.destroy()
             
 
 def main():
@@ -158,6 +388,8 @@ def main():
         身着野兽皮，皮毛依稀可见，手持战斧，斧刃在晨光下反射出高光 立于浑浊的水中正缓慢前进 胸部丰满 肌肉线条明显，水面及与膝盖
         背景是高大的杉木，黑绿色的藤蔓缠绕着树干 远处薄雾朦胧 隐约看到几只饿狼 4k 超高清"""
         generate_with_qwen_imageplus(prompt, "image" + datetime.now().strftime("%Y-%m-%d-%H-%M") + ".png")
+        print(f"remote cache: {REMOTE_CACHE.stats()}")
+        REMOTE_CACHE.save_stats()
 
 
 if __name__ == "__main__":
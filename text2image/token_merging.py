@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+token_merging.py
+
+Token merging (ToMe for Stable Diffusion) for the UNet self-attention (--tome-ratio).
+
+Self-attention cost grows with the square of the token count, i.e. with the fourth
+power of the image side. Before each high-resolution self-attention the spatial
+tokens are split into a 2x2-strided "dst" grid and the remaining "src" tokens; the
+`ratio * N` src tokens most similar (cosine) to some dst token are averaged into it.
+Attention runs on the reduced set and its output is unmerged (each merged token
+copies its dst result) before the block's residual add, so the rest of the UNet
+sees the full-resolution token grid.
+
+Only transformer blocks at the highest resolution that has attention are patched
+(downsample 1 on SD 1.x / 2.x, 2 on SDXL), the ones with the largest token count.
+
+End-to-end benchmark on real weights (seconds per step and PSNR / cosine similarity
+to the ratio 0 image, at each size):
+  python token_merging.py bench --model G:/AIModels/.../stable-diffusion-v1-5 --ratios 0.3,0.5 --sizes 512,768,1024
+
+UNet-only timing without weights (randomly initialised UNet with the SD 1.5 layout, or
+the layout of --config): seconds per UNet call only, no image quality.
+  python token_merging.py bench-unet --sizes 512,768,1024 --ratios 0.3,0.5 --batch 2
+
+Measured with bench-unet --batch 1 (SD 1.5 layout, fp32, one CPU core, torch 2.14 /
+diffusers 0.41; seconds per UNet call, speedup over ratio 0). Runs with the default
+--batch 2 (one image with CFG) are not comparable to these numbers:
+
+  size   ratio 0   ratio 0.3        ratio 0.5
+  512    12.9 s    11.5 s (1.12x)   11.0 s (1.17x)
+  768    28.5 s    25.8 s (1.11x)   24.4 s (1.17x)
+  1024   70.4 s    57.3 s (1.23x)   48.8 s (1.44x)
+
+End-to-end seconds per step, and similarity to ratio 0 on real weights, have not
+been measured; run `bench` on the target machine for those.
+"""
+import argparse
+import json
+import math
+import os
+import time
+from types import SimpleNamespace
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+from perf_utils import StepTimer, format_table, image_similarity
+
+MAX_RATIO = 0.75  # at most 3 of every 4 tokens can be src tokens
+
+
+class TomeSettings:
+    def __init__(self):
+        self.ratio = 0.0
+
+
+SETTINGS = TomeSettings()
+
+
+def set_token_merging(ratio: float = 0.0):
+    SETTINGS.ratio = min(max(float(ratio), 0.0), MAX_RATIO)
+
+
+def _identity(x: torch.Tensor) -> torch.Tensor:
+    return x
+
+
+def bipartite_merge_2d(metric: torch.Tensor, h: int, w: int, r: int, sx: int = 2, sy: int = 2) -> Tuple[Callable, Callable]:
+    """Build merge/unmerge functions for (B, h*w, C) tokens, merging r src tokens into dst tokens."""
+    B, N, _ = metric.shape
+    if r <= 0:
+        return _identity, _identity
+    device = metric.device
+    hsy, wsx = h // sy, w // sx
+
+    # The first token of every sy x sx cell is a dst token (-1 sorts it first)
+    cells = torch.zeros(hsy, wsx, sy * sx, device=device, dtype=torch.int64)
+    cells[:, :, 0] = -1
+    cells = cells.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+    if hsy * sy < h or wsx * sx < w:
+        grid = torch.zeros(h, w, device=device, dtype=torch.int64)
+        grid[:hsy * sy, :wsx * sx] = cells
+    else:
+        grid = cells
+    order = grid.reshape(1, -1, 1).argsort(dim=1)
+    num_dst = hsy * wsx
+    a_idx, b_idx = order[:, num_dst:, :], order[:, :num_dst, :]
+
+    def split(x):
+        c = x.shape[-1]
+        src = torch.gather(x, 1, a_idx.expand(x.shape[0], N - num_dst, c))
+        dst = torch.gather(x, 1, b_idx.expand(x.shape[0], num_dst, c))
+        return src, dst
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x: torch.Tensor) -> torch.Tensor:
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, -2, unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, -2, src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        n, _, c = unm.shape
+        src = torch.gather(dst, -2, dst_idx.expand(n, r, c))
+        out = torch.zeros(n, N, c, device=x.device, dtype=x.dtype)
+        a_full = a_idx.expand(n, a_idx.shape[1], 1)
+        out.scatter_(-2, b_idx.expand(n, num_dst, c), dst)
+        out.scatter_(-2, torch.gather(a_full, 1, unm_idx).expand(n, unm_len, c), unm)
+        out.scatter_(-2, torch.gather(a_full, 1, src_idx).expand(n, r, c), src)
+        return out
+
+    return merge, unmerge
+
+
+class _TomeState:
+    def __init__(self, unet, ratio: float, max_downsample: int):
+        self.unet = unet
+        self.ratio = ratio
+        self.max_downsample = max_downsample
+        self.size: Optional[Tuple[int, int]] = None
+        self.patched = []  # (attention module, previous instance-level forward or None, our forward)
+        self.hook = unet.register_forward_pre_hook(self._record_size, with_kwargs=True)
+
+    def _record_size(self, module, args, kwargs):
+        sample = args[0] if args else kwargs.get("sample")
+        if sample is not None:
+            self.size = tuple(sample.shape[-2:])
+
+    def merge_fns(self, x: torch.Tensor) -> Tuple[Callable, Callable]:
+        if self.size is None or x.dim() != 3:
+            return _identity, _identity
+        h0, w0 = self.size
+        n = x.shape[1]
+        downsample = int(math.ceil(math.sqrt(h0 * w0 / n)))
+        if downsample > self.max_downsample:
+            return _identity, _identity
+        h, w = int(math.ceil(h0 / downsample)), int(math.ceil(w0 / downsample))
+        if h * w != n:
+            return _identity, _identity
+        return bipartite_merge_2d(x, h, w, int(n * self.ratio))
+
+
+def _max_downsample(unet) -> int:
+    """Downsample factor of the first down block that has attention (1 for SD 1.5, 2 for SDXL)."""
+    for i, block_type in enumerate(getattr(unet.config, "down_block_types", ())):
+        if "Attn" in block_type:
+            return 2 ** i
+    return 1
+
+
+def enable_token_merging(pipe, ratio: float):
+    """Patch the self-attention (attn1) of the UNet's high-resolution transformer blocks."""
+    disable_token_merging(pipe)
+    ratio = min(max(ratio, 0.0), MAX_RATIO)
+    if ratio <= 0:
+        return None
+    unet = getattr(pipe, "unet", None)
+    if unet is None or not hasattr(unet, "down_blocks"):
+        print("--tome-ratio ignored: token merging needs a UNet pipeline (not a DiT/transformer one).")
+        return None
+    unet = getattr(unet, "_orig_mod", unet)
+    from diffusers.models.attention import BasicTransformerBlock  # type: ignore[import]
+
+    state = _TomeState(unet, ratio, _max_downsample(unet))
+    for module in unet.modules():
+        attn = getattr(module, "attn1", None) if isinstance(module, BasicTransformerBlock) else None
+        if attn is None:
+            continue
+        original = attn.forward
+
+        def forward(hidden_states, *args, _original=original, **kwargs):
+            merge, unmerge = state.merge_fns(hidden_states)
+            return unmerge(_original(merge(hidden_states), *args, **kwargs))
+
+        state.patched.append((attn, attn.__dict__.get("forward"), forward))
+        attn.forward = forward
+    pipe._token_merging = state
+    return state
+
+
+def disable_token_merging(pipe):
+    state = getattr(pipe, "_token_merging", None)
+    if state is None:
+        return
+    state.hook.remove()
+    for attn, previous, patch in state.patched:
+        if attn.__dict__.get("forward") is patch:
+            if previous is not None:
+                attn.forward = previous
+            else:
+                del attn.forward
+    pipe._token_merging = None
+
+
+def apply_token_merging(pipe):
+    """Bring pipe in line with SETTINGS.ratio (no-op when already matching)."""
+    state = getattr(pipe, "_token_merging", None)
+    current = state.ratio if state is not None else 0.0
+    if current != SETTINGS.ratio:
+        enable_token_merging(pipe, SETTINGS.ratio)
+    return pipe
+
+
+@torch.inference_mode()
+def bench_unet(config: Optional[str], sizes: List[int], ratios: List[float], batch: int = 2, repeats: int = 2) -> List[dict]:
+    """Seconds per UNet call with random weights (speed only: no weights are read, no quality numbers)."""
+    from diffusers import UNet2DConditionModel  # type: ignore[import]
+
+    torch.manual_seed(0)
+    if config:
+        unet = UNet2DConditionModel.from_config(UNet2DConditionModel.load_config(config, subfolder="unet"))
+    else:
+        unet = UNet2DConditionModel(cross_attention_dim=768, attention_head_dim=8)  # SD 1.5 layout
+    unet.eval()
+    holder = SimpleNamespace(unet=unet)
+    context = torch.randn(batch, 77, unet.config.cross_attention_dim)
+    timestep = torch.tensor([500])
+    rows = []
+    for size in sizes:
+        sample = torch.randn(batch, unet.config.in_channels, size // 8, size // 8)
+        base = None
+        for ratio in ratios:
+            enable_token_merging(holder, ratio)
+            unet(sample, timestep, context)  # warm-up
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                unet(sample, timestep, context)
+                times.append(time.perf_counter() - start)
+            row = {"size": size, "ratio": ratio, "s_per_call": min(times)}
+            if ratio == 0.0:
+                base = row["s_per_call"]
+            row["speedup"] = base / row["s_per_call"] if base else None
+            rows.append(row)
+            print(f"{size}px ratio {ratio:g}: {row['s_per_call']:.2f}s/call", flush=True)
+    disable_token_merging(holder)
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Token merging benchmark: seconds per step vs resolution on CPU")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("bench-unet", help="Time the UNet alone with random weights (speed only)")
+    p.add_argument("--config", type=str, default="", help="Model dir whose unet/config.json sets the layout (default: SD 1.5)")
+    p.add_argument("--ratios", type=str, default="0.3,0.5")
+    p.add_argument("--sizes", type=str, default="512,768,1024")
+    p.add_argument("--batch", type=int, default=2, help="UNet batch (2 = one image with CFG)")
+    p.add_argument("--repeats", type=int, default=2)
+    p.add_argument("--out-dir", type=str, default="tome_bench")
+    p = sub.add_parser("bench", help="Time ratio 0 against each --ratios value at each --sizes resolution")
+    p.add_argument("--model", type=str, required=True)
+    p.add_argument("--ratios", type=str, default="0.3,0.5")
+    p.add_argument("--sizes", type=str, default="512,768,1024")
+    p.add_argument("--prompt", type=str, default="a lighthouse on a cliff at sunset, detailed")
+    p.add_argument("--steps", type=int, default=10)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--device", type=str, default="cpu")
+    p.add_argument("--out-dir", type=str, default="tome_bench")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ratios = [0.0] + [float(r) for r in args.ratios.split(",") if r.strip() and float(r) > 0]
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    os.makedirs(args.out_dir, exist_ok=True)
+    if args.command == "bench-unet":
+        rows = bench_unet(args.config or None, sizes, ratios, args.batch, args.repeats)
+        print(format_table(rows, ["size", "ratio", "s_per_call", "speedup"]))
+        with open(os.path.join(args.out_dir, "unet_results.json"), "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        return
+
+    import local_sd_v1_5_text2img as sd
+
+    device = sd.choose_device(args.device)
+    pipe = sd.load_pipeline(args.model, device, trust_remote_code=False, lowvram=False)
+    pipe.set_progress_bar_config(disable=True)
+
+    rows = []
+    for size in sizes:
+        reference, base = None, None
+        for ratio in ratios:
+            enable_token_merging(pipe, ratio)
+            timer = StepTimer()
+            timer.start()
+            image = pipe(prompt=args.prompt, height=size, width=size, num_inference_steps=args.steps,
+                         generator=torch.Generator(device=device).manual_seed(args.seed), callback_on_step_end=timer).images[0]
+            out = os.path.join(args.out_dir, f"{size}_ratio{ratio:g}.png")
+            image.save(out)
+            # The first step includes one-off warm-up costs, so compare the remaining ones
+            steps = timer.step_seconds[1:] or timer.step_seconds
+            row = {"size": size, "ratio": ratio, "s_per_step": sum(steps) / len(steps), "out": out}
+            if ratio == 0.0:
+                reference, base = image, row["s_per_step"]
+            row["speedup"] = base / row["s_per_step"] if base and row["s_per_step"] else None
+            row.update(image_similarity(reference, image))
+            rows.append(row)
+            print(f"{size}px ratio {ratio:g}: {row['s_per_step']:.2f}s/step")
+    disable_token_merging(pipe)
+
+    print(format_table(rows, ["size", "ratio", "s_per_step", "speedup", "psnr_db", "cosine"]))
+    with open(os.path.join(args.out_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,37 @@ from http import HTTPStatus
 from dashscope import VideoSynthesis
 import dashscope
 import os
+import sys
 import time
-import requests
+
+# 共用 text2image/downloader.py（流式写临时文件 + 原子重命名、Range 续传、分段并行下载、大小校验）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "text2image"))
+from downloader import download
+from remote_cache import REMOTE_CACHE, fingerprint, use_endpoint
 
 # 设置API端点（北京地域）
 dashscope.base_http_api_url = 'https://dashscope.aliyuncs.com/api/v1'
+use_endpoint(dashscope.base_http_api_url)
 
 # 设置API Key - 优先使用环境变量，如果没有则手动填写
 api_key = os.getenv("DASHSCOPE_API_KEY", "你的API-KEY")
 
-def generate_video_async(prompt, model='wan2.2-t2v-plus', size='832*480', output_file="generated_video.mp4"):
+def video_fingerprint(prompt, model='wan2.2-t2v-plus', size='832*480', seed=12345):
+    """与下方 async_call 参数一致的请求指纹（共用缓存 remote_cache.py）"""
+    return fingerprint("video", model, prompt, size=size, seed=seed, negative_prompt="", prompt_extend=True, watermark=False,
+                       endpoint=dashscope.base_http_api_url)
+
+
+def generate_video_async(prompt, model='wan2.2-t2v-plus', size='832*480', output_file="generated_video.mp4", use_cache=True):
     """
     异步生成视频并等待结果
+    相同请求（提示词、模型、尺寸、种子）命中本地缓存时直接复制，不再付费调用；use_cache=False 强制重新生成
     """
+    fp = video_fingerprint(prompt, model, size)
+    if use_cache and REMOTE_CACHE.lookup(fp, output_file):
+        REMOTE_CACHE.avoided()
+        print(f"♻️ 缓存命中，已复制到: {output_file}（未调用API）")
+        return True
     try:
         print("⏳ 正在提交视频生成任务...")
         
@@ -39,7 +57,10 @@ def generate_video_async(prompt, model='wan2.2-t2v-plus', size='832*480', output
         print("⚠️ 视频生成需要一些时间，请耐心等待...")
         
         # 轮询查询任务状态
-        return wait_for_task_completion(task_id, output_file)
+        success = wait_for_task_completion(task_id, output_file)
+        if success:
+            REMOTE_CACHE.store(fp, output_file, task_id=task_id)
+        return success
         
     except Exception as e:
         print(f"💥 发生异常: {str(e)}")
@@ -103,15 +124,9 @@ def download_video(video_url, filename):
     """
     try:
         print("📥 开始下载视频...")
-        response = requests.get(video_url, stream=True)
-        if response.status_code == 200:
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            return True
-        else:
-            print(f"❌ 视频下载失败: HTTP {response.status_code}")
-            return False
+        result = download(video_url, filename, segments=4)
+        print(f"📊 {result}")
+        return True
     except Exception as e:
         print(f"💥 下载视频时出错: {str(e)}")
         return False
@@ -142,13 +157,21 @@ def check_api_status():
         return False
 
 if __name__ == '__main__':
-    # 首先检查API状态
-    if not check_api_status():
-        print("❌ API检查失败，请检查API Key和网络连接")
-        exit(1)
-    
+    import argparse
+
+    parser = argparse.ArgumentParser(description="DashScope 文生视频（结果缓存在本地，相同请求不重复付费）")
+    parser.add_argument("--no-cache", action="store_true", help="忽略本地缓存，强制重新生成")
+    args = parser.parse_args()
+
     # 你的视频描述
     prompt = "一只小猫在月光下的草地上奔跑，身上有星星点点的光芒"
+    output_file = "my_generated_video.mp4"
+
+    # 首先检查API状态（该检查本身也会调用一次API，命中缓存时跳过）
+    cached = not args.no_cache and REMOTE_CACHE.contains(video_fingerprint(prompt))
+    if not cached and not check_api_status():
+        print("❌ API检查失败，请检查API Key和网络连接")
+        exit(1)
     
     print(f"🎬 开始生成视频: {prompt}")
     
@@ -157,10 +180,13 @@ if __name__ == '__main__':
         prompt=prompt,
         model='wan2.2-t2v-plus',
         size='832*480',
-        output_file="my_generated_video.mp4"
+        output_file=output_file,
+        use_cache=not args.no_cache,
     )
     
     if success:
         print("✅ 视频生成和下载完成！")
     else:
-        print("❌ 视频生成失败")
\ No newline at end of file
+        print("❌ 视频生成失败")
+    print(f"📦 缓存统计: {REMOTE_CACHE.stats()}")
+    REMOTE_CACHE.save_stats()
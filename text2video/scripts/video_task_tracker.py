@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+video_task_tracker.py
+
+批量提交 DashScope 文生视频任务，并用 asyncio 同时跟踪所有任务。
+
+wait_for_task_completion() tracks one task at a time with a fixed 10 s sleep. This
+tracker submits every prompt (same request as VideoSynthesis.async_call, over the
+REST API so it can target a mock) and polls all pending task ids concurrently:
+
+- adaptive polling: PENDING jobs back off geometrically (queue time is unpredictable);
+  RUNNING jobs sleep until the expected finish, using a running average of observed
+  run times, then poll at the minimum interval; every delay gets +-20% jitter so
+  jobs do not poll in lockstep
+- throttled / failed polls are retried with exponential backoff (dashscope_batch.py);
+  a submit is retried only when throttled or never sent, so a read timeout or 5xx
+  cannot create a second paid task (the job fails instead)
+- a job's download (downloader.py: resumable, segmented) starts as soon as it succeeds
+- identical seeded requests are served from the shared remote cache (remote_cache.py; off
+  with --mock or a custom --base-url)
+- per-job latency breakdown: submit, queue (PENDING), run (RUNNING), detect lag
+  (finished -> noticed), download, total; written to tracker_report.json
+- a task that hits --task-timeout or keeps failing to poll is still running (and billed)
+  on the server, so it is recorded as ABANDONED with its task_id instead of failed;
+  --resume picks those tasks up again without resubmitting
+
+  python video_task_tracker.py --prompts-file prompts.txt --out-dir videos
+  python video_task_tracker.py --prompts-file prompts.txt --mock      # offline, local mock task API
+  python video_task_tracker.py --prompts-file prompts.txt --out-dir videos --resume videos/tracker_report.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+# 共用 text2image 下的 REST 客户端、下载器和结果缓存
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "text2image"))
+from dashscope_batch import DEFAULT_BASE_URL, FINAL_STATUSES, BatchStats, DashScopeClient, load_records, with_backoff
+from downloader import download
+from remote_cache import REMOTE_CACHE, fingerprint, use_endpoint
+
+REPORT_COLUMNS = ["index", "status", "polls", "submit_s", "queue_s", "run_s", "detect_lag_s", "download_s", "total_s"]
+
+
+def parse_server_time(value: Optional[str]) -> Optional[float]:
+    """DashScope task timestamps ('2025-01-08 16:43:23.123', server local time) as epoch seconds."""
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+class VideoJob:
+    def __init__(self, rec: dict, out_path: str, model: str, endpoint: str = DEFAULT_BASE_URL):
+        self.index = rec["index"]
+        self.prompt = rec["prompt"]
+        self.size = rec.get("size")
+        self.seed = rec.get("seed")
+        self.negative_prompt = rec.get("negative_prompt") or ""
+        self.params = {"prompt_extend": rec.get("prompt_extend", True), "watermark": False, "duration": rec.get("duration")}
+        self.out = out_path
+        self.model = model
+        self.fp = fingerprint("video", model, self.prompt, size=self.size, seed=self.seed,
+                              negative_prompt=self.negative_prompt, endpoint=endpoint, **self.params)
+        self.task_id = None
+        self.status = "new"
+        self.last_status = None
+        self.error = None
+        self.polls = 0
+        self.polls_in_state = 0
+        # Local monotonic clock
+        self.t_start = time.monotonic()
+        self.t_submitted = None
+        self.t_running = None
+        self.t_detected = None
+        self.t_downloaded = None
+        # Server clock (only differences are used)
+        self.server_submit = None
+        self.server_scheduled = None
+        self.server_end = None
+
+    def observe(self, output: dict):
+        status = output.get("task_status")
+        self.polls += 1
+        self.polls_in_state = self.polls_in_state + 1 if status == self.status else 0
+        if status == "RUNNING" and self.t_running is None:
+            self.t_running = time.monotonic()
+        self.status = status
+        self.server_submit = parse_server_time(output.get("submit_time")) or self.server_submit
+        self.server_scheduled = parse_server_time(output.get("scheduled_time")) or self.server_scheduled
+        self.server_end = parse_server_time(output.get("end_time")) or self.server_end
+
+    @property
+    def queue_s(self) -> Optional[float]:
+        if self.server_submit is not None and self.server_scheduled is not None:
+            return self.server_scheduled - self.server_submit
+        if self.t_submitted is not None and self.t_running is not None:
+            return self.t_running - self.t_submitted
+        return None
+
+    @property
+    def run_s(self) -> Optional[float]:
+        if self.server_scheduled is not None and self.server_end is not None:
+            return self.server_end - self.server_scheduled
+        if self.t_running is not None and self.t_detected is not None:
+            return self.t_detected - self.t_running
+        return None
+
+    def breakdown(self) -> dict:
+        def span(a, b):
+            return b - a if a is not None and b is not None else None
+
+        detect_lag = None
+        if self.server_submit is not None and self.server_end is not None and self.t_detected is not None:
+            # Time from server-side completion until a poll noticed it (submit is the shared reference point)
+            detect_lag = max(0.0, span(self.t_submitted, self.t_detected) - (self.server_end - self.server_submit))
+        return {"index": self.index, "status": self.status, "last_status": self.last_status, "task_id": self.task_id, "polls": self.polls,
+                "submit_s": span(self.t_start, self.t_submitted), "queue_s": self.queue_s, "run_s": self.run_s,
+                "detect_lag_s": detect_lag, "download_s": span(self.t_detected, self.t_downloaded),
+                "total_s": span(self.t_start, self.t_downloaded or self.t_detected), "out": self.out, "error": self.error}
+
+
+class PollPolicy:
+    """Adaptive poll delays shared by all jobs of a batch."""
+
+    def __init__(self, min_s: float = 2.0, max_s: float = 30.0, factor: float = 1.6, jitter: float = 0.2):
+        self.min_s = min_s
+        self.max_s = max_s
+        self.factor = factor
+        self.jitter = jitter
+        self.run_estimate: Optional[float] = None
+
+    def record_run(self, seconds: Optional[float]):
+        if seconds is None or seconds <= 0:
+            return
+        self.run_estimate = seconds if self.run_estimate is None else 0.7 * self.run_estimate + 0.3 * seconds
+
+    def delay(self, job: VideoJob) -> float:
+        backoff = min(self.max_s, self.min_s * self.factor ** job.polls_in_state)
+        if job.status == "RUNNING" and self.run_estimate is not None and job.t_running is not None:
+            remaining = self.run_estimate - (time.monotonic() - job.t_running)
+            # Sleep up to the expected finish, then poll tightly until it shows up
+            base = min(self.max_s, remaining) if remaining > self.min_s else self.min_s
+        elif job.status == "RUNNING":
+            base = min(backoff, 4 * self.min_s)
+        else:
+            base = backoff
+        return base * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class TrackerStats(BatchStats):
+    def __init__(self):
+        super().__init__()
+        self.polls = 0
+        self.videos = 0
+        self.abandoned = 0
+
+
+async def poll_until_final(client: DashScopeClient, job: VideoJob, policy: PollPolicy, stats: TrackerStats, limits: dict,
+                           timeout: float) -> dict:
+    """Poll job.task_id until it reaches a final status; TimeoutError once the deadline passes."""
+    deadline = job.t_submitted + timeout
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            raise TimeoutError(f"still {job.status} after {timeout:.0f}s")
+        # Never sleep past the deadline: one last poll happens right at it
+        await asyncio.sleep(min(policy.delay(job), deadline - now))
+        async with limits["poll"]:
+            output = await with_backoff(stats, client.task, job.task_id, deadline=deadline)
+        stats.polls += 1
+        previous = job.status
+        job.observe(output)
+        if job.status != previous:
+            print(f"[{job.index}] {previous} -> {job.status}")
+        if job.status in FINAL_STATUSES:
+            return output
+
+
+async def track_job(client: DashScopeClient, job: VideoJob, policy: PollPolicy, stats: TrackerStats, limits: dict,
+                    segments: int, timeout: float, use_cache: bool):
+    if use_cache and REMOTE_CACHE.lookup(job.fp, job.out):
+        REMOTE_CACHE.avoided()
+        job.status = "CACHED"
+        stats.cached += 1
+        print(f"[{job.index}] 缓存命中: {job.out}")
+        return
+    try:
+        if job.task_id is None:
+            async with limits["submit"]:
+                submit = functools.partial(client.submit_video, job.model, job.prompt, job.size, job.negative_prompt, job.seed, **job.params)
+                # Paid and not idempotent: only retried when no task can have been created
+                job.task_id = await with_backoff(stats, submit, idempotent=False)
+            job.status = "PENDING"
+            stats.calls += 1
+            print(f"[{job.index}] 已提交 task {job.task_id}")
+        else:
+            print(f"[{job.index}] 继续跟踪 task {job.task_id}")
+        job.t_submitted = time.monotonic()
+
+        try:
+            output = await poll_until_final(client, job, policy, stats, limits, timeout)
+        except Exception as e:
+            # The paid task keeps running server side: keep its id so --resume can still collect the video
+            job.error = f"{type(e).__name__}: {e}"
+            job.last_status = job.status
+            job.status = "ABANDONED"
+            stats.abandoned += 1
+            print(f"[{job.index}] 已放弃跟踪 task {job.task_id}（{job.last_status}）: {job.error}")
+            return
+        job.t_detected = time.monotonic()
+        if job.status != "SUCCEEDED" or not output.get("video_url"):
+            raise RuntimeError(f"task {job.status}: {output.get('code')} {output.get('message')}")
+        policy.record_run(job.run_s)
+
+        # Download right away; other jobs keep polling meanwhile
+        async with limits["download"]:
+            result = await asyncio.to_thread(download, output["video_url"], job.out, None, segments)
+        job.t_downloaded = time.monotonic()
+        stats.videos += 1
+        stats.bytes += result.size
+        REMOTE_CACHE.store(job.fp, job.out, task_id=job.task_id, url=output["video_url"])
+        print(f"[{job.index}] 已下载 {result}")
+    except Exception as e:
+        job.error = f"{type(e).__name__}: {e}"
+        stats.failed += 1
+        print(f"[{job.index}] 失败: {job.error}")
+
+
+async def run_tracker(client: DashScopeClient, jobs, policy: PollPolicy, stats: TrackerStats, submit_concurrency: int,
+                      poll_concurrency: int, download_concurrency: int, segments: int, timeout: float, use_cache: bool):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=submit_concurrency + poll_concurrency + download_concurrency))
+    limits = {"submit": asyncio.Semaphore(submit_concurrency), "poll": asyncio.Semaphore(poll_concurrency),
+              "download": asyncio.Semaphore(download_concurrency)}
+    await asyncio.gather(*(track_job(client, job, policy, stats, limits, segments, timeout, use_cache) for job in jobs))
+
+
+def print_report(rows):
+    def fmt(value):
+        return "-" if value is None else f"{value:.1f}" if isinstance(value, float) else str(value)
+
+    cells = [[fmt(row.get(col)) for col in REPORT_COLUMNS] for row in rows]
+    widths = [max([len(col)] + [len(r[i]) for r in cells]) for i, col in enumerate(REPORT_COLUMNS)]
+    print("  ".join(col.ljust(w) for col, w in zip(REPORT_COLUMNS, widths)))
+    for r in cells:
+        print("  ".join(c.ljust(w) for c, w in zip(r, widths)))
+
+
+def mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="并发提交并跟踪多个 DashScope 文生视频任务")
+    parser.add_argument("--prompts-file", type=str, required=True, help="每行一个提示词，或 JSONL（prompt, size, seed, duration, negative_prompt, out）")
+    parser.add_argument("--out-dir", type=str, default="", help="输出目录（默认按时间命名）")
+    parser.add_argument("--model", type=str, default="wan2.2-t2v-plus")
+    parser.add_argument("--size", type=str, default="832*480")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--submit-concurrency", type=int, default=4, help="同时进行的提交请求数")
+    parser.add_argument("--poll-concurrency", type=int, default=8, help="同时进行的查询请求数")
+    parser.add_argument("--download-concurrency", type=int, default=2, help="同时下载的视频数")
+    parser.add_argument("--segments", type=int, default=4, help="每个视频的并行分段下载数")
+    parser.add_argument("--min-poll", type=float, default=2.0, help="最短轮询间隔（秒）")
+    parser.add_argument("--max-poll", type=float, default=30.0, help="最长轮询间隔（秒）")
+    parser.add_argument("--task-timeout", type=float, default=1800.0)
+    parser.add_argument("--no-cache", action="store_true", help="忽略本地缓存，强制重新生成")
+    parser.add_argument("--resume", type=str, default="", help="tracker_report.json: 只继续跟踪其中 ABANDONED 的任务（不重新提交）")
+    parser.add_argument("--api-key", type=str, default=None, help="默认读取 $DASHSCOPE_API_KEY")
+    parser.add_argument("--base-url", type=str, default=os.getenv("DASHSCOPE_BASE_URL", DEFAULT_BASE_URL))
+    parser.add_argument("--mock", action="store_true", help="连接进程内的 mock_dashscope 服务（离线测试）")
+    parser.add_argument("--mock-slots", type=int, default=3, help="--mock: 同时运行的视频任务数，其余排队")
+    parser.add_argument("--mock-seconds", type=float, default=6.0, help="--mock: 视频任务平均运行时间")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    base_url, api_key, server = args.base_url, args.api_key or os.getenv("DASHSCOPE_API_KEY"), None
+    if args.mock:
+        from mock_dashscope import MockState, serve
+        server, base_url = serve(state=MockState(video_slots=args.mock_slots, video_seconds=args.mock_seconds, video_bytes=24 << 20))
+        api_key = api_key or "sk-mock"
+        print(f"使用 mock DashScope: {base_url}")
+    if not api_key:
+        raise SystemExit("please provide dashscope api key (--api-key or DASHSCOPE_API_KEY).")
+    if not use_endpoint(base_url, args.mock):
+        print(f"远程结果缓存已关闭: {base_url}")
+
+    out_dir = args.out_dir or "videos_" + datetime.now().strftime("%Y%m%d-%H%M%S")
+    records = load_records(args.prompts_file, {"size": args.size, "seed": args.seed})
+    jobs = [VideoJob(rec, rec.get("out") or os.path.join(out_dir, f"{rec['index']:03d}.mp4"), args.model, base_url) for rec in records]
+    if args.resume:
+        with open(args.resume, "r", encoding="utf-8") as f:
+            abandoned = {row["index"]: row for row in json.load(f)["jobs"] if row.get("status") == "ABANDONED" and row.get("task_id")}
+        jobs = [job for job in jobs if job.index in abandoned]
+        for job in jobs:
+            job.task_id = abandoned[job.index]["task_id"]
+            job.status = abandoned[job.index].get("last_status") or "PENDING"
+        print(f"继续跟踪 {len(jobs)} 个已放弃的任务")
+    print(f"{len(jobs)} 个视频任务，提交并发 {args.submit_concurrency}，查询并发 {args.poll_concurrency}")
+
+    stats = TrackerStats()
+    policy = PollPolicy(args.min_poll, args.max_poll)
+    client = DashScopeClient(api_key, base_url, pool_size=args.submit_concurrency + args.poll_concurrency)
+    try:
+        asyncio.run(run_tracker(client, jobs, policy, stats, max(1, args.submit_concurrency), max(1, args.poll_concurrency),
+                                max(1, args.download_concurrency), args.segments, args.task_timeout, not args.no_cache))
+    finally:
+        client.close()
+        if server is not None:
+            server.shutdown()
+
+    rows = [job.breakdown() for job in jobs]
+    print_report(rows)
+    wall = time.perf_counter() - stats.start
+    summary = {"videos": stats.videos, "cached": stats.cached, "failed": stats.failed, "abandoned": stats.abandoned, "polls": stats.polls,
+               "retries": stats.retries, "throttled": stats.throttled, "wall_s": wall,
+               "videos_per_min": 60.0 * stats.videos / wall if wall else None,
+               "mean": {col: mean(row[col] for row in rows) for col in REPORT_COLUMNS[3:]}}
+    print(f"{stats.videos} 个视频 / {wall:.1f}s，{stats.polls} 次查询，{stats.retries} 次重试，"
+          f"{stats.cached} 个命中缓存，{stats.failed} 个失败，{stats.abandoned} 个已放弃")
+    if stats.abandoned:
+        print(f"已放弃的任务仍在服务器上运行，可用 --resume {os.path.join(out_dir, 'tracker_report.json')} 继续跟踪")
+    means = [f"{k}={v:.1f}s" for k, v in summary["mean"].items() if v is not None]
+    if means:
+        print("平均耗时: " + ", ".join(means))
+    summary["remote_cache"] = REMOTE_CACHE.stats()
+    REMOTE_CACHE.save_stats()
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "tracker_report.json"), "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "jobs": rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()